@@ -22,9 +22,12 @@ EC2/S3 Utility Classes
 import os
 import re
 import time
+import atexit
 import base64
+import random
 import string
 import tempfile
+import threading
 
 import boto
 import boto.ec2
@@ -39,11 +42,206 @@ from starcluster import spinner
 from starcluster import sshutils
 from starcluster import webtools
 from starcluster import exception
+from starcluster import threadpool
 from starcluster import progressbar
 from starcluster.utils import print_timing
 from starcluster.logger import log
 
 
+class TokenBucket(object):
+    """
+    Thread-safe token bucket that allows rate requests/sec on average with
+    bursts of up to burst requests. The rate is halved (down to min_rate)
+    each time throttled() is called and slowly restored to max_rate by
+    succeeded().
+    """
+    def __init__(self, rate, burst, min_rate=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._last = time.time()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._last)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+    def throttled(self, backoff):
+        """
+        Halve the rate, empty the bucket and block all callers for backoff
+        seconds
+        """
+        self._lock.acquire()
+        try:
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = 0
+            self._blocked_until = max(self._blocked_until,
+                                      time.time() + backoff)
+        finally:
+            self._lock.release()
+
+    def succeeded(self):
+        if self.rate >= self.max_rate:
+            return
+        self._lock.acquire()
+        try:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0)
+        finally:
+            self._lock.release()
+
+
+class EC2RateLimiter(object):
+    """
+    Process-wide rate limiter for EC2 API requests
+
+    Describe* requests and all other (mutating) requests draw from separate
+    token buckets. When EC2 responds with a throttling error the bucket's
+    rate is reduced and all requests in that bucket back off before the
+    request is retried. Call counts per API action are logged at exit.
+    """
+    def __init__(self, describe_rate=10, describe_burst=20, mutate_rate=5,
+                 mutate_burst=10, backoff=1, max_backoff=20):
+        self.buckets = dict(describe=TokenBucket(describe_rate,
+                                                 describe_burst),
+                            mutate=TokenBucket(mutate_rate, mutate_burst))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.calls = {}
+        self.throttles = {}
+        self._num_throttled = 0
+        self._lock = threading.Lock()
+        atexit.register(self.report)
+
+    def get_bucket(self, action):
+        if action and action.startswith(('Describe', 'Get')):
+            return self.buckets['describe']
+        return self.buckets['mutate']
+
+    def _incr(self, counts, action):
+        self._lock.acquire()
+        try:
+            counts[action] = counts.get(action, 0) + 1
+        finally:
+            self._lock.release()
+
+    def acquire(self, action):
+        self._incr(self.calls, action)
+        self.get_bucket(action).acquire()
+
+    def throttled(self, action):
+        """
+        Record a throttled request and back off exponentially (with jitter)
+        based on the number of consecutive throttling errors
+        """
+        self._lock.acquire()
+        try:
+            self.throttles[action] = self.throttles.get(action, 0) + 1
+            self._num_throttled += 1
+            num_throttled = self._num_throttled
+        finally:
+            self._lock.release()
+        # cap the exponent so that many concurrent failures can't overflow
+        delay = min(self.backoff * 2 ** min(num_throttled - 1, 30),
+                    self.max_backoff)
+        delay *= 0.5 + random.random() / 2
+        bucket = self.get_bucket(action)
+        bucket.throttled(delay)
+        log.debug("EC2 throttled %s request - backing off %.1fs (rate: "
+                  "%.1f req/s)" % (action, delay, bucket.rate))
+        return delay
+
+    def succeeded(self, action):
+        self._lock.acquire()
+        try:
+            self._num_throttled = 0
+        finally:
+            self._lock.release()
+        self.get_bucket(action).succeeded()
+
+    def _is_throttled(self, response):
+        if response.status < 400:
+            return False
+        # boto caches the body so callers can still read the response
+        body = response.read()
+        for code in threadpool.THROTTLING_ERROR_CODES:
+            if '<Code>%s</Code>' % code in body:
+                return True
+        return False
+
+    def wrap(self, conn):
+        """
+        Route all requests made by the boto connection conn through this
+        limiter. This includes requests made by boto objects (e.g.
+        Instance.update) that reference conn.
+        """
+        mexe = conn._mexe
+
+        def _mexe(request, sender=None, override_num_retries=None,
+                  retry_handler=None):
+            action = request.params.get('Action')
+            num_retries = override_num_retries
+            if num_retries is None:
+                num_retries = boto_config.getint('Boto', 'num_retries',
+                                                 conn.num_retries)
+
+            def handler(response, i, next_sleep):
+                if i < num_retries and self._is_throttled(response):
+                    self.throttled(action)
+                    self.get_bucket(action).acquire()
+                    return ('retrying throttled %s request' % action, i + 1,
+                            0)
+                if response.status < 400:
+                    self.succeeded(action)
+                if callable(retry_handler):
+                    return retry_handler(response, i, next_sleep)
+            self.acquire(action)
+            return mexe(request, sender=sender,
+                        override_num_retries=override_num_retries,
+                        retry_handler=handler)
+        conn._mexe = _mexe
+        return conn
+
+    def report(self):
+        if not self.calls:
+            return
+        total = sum(self.calls.values())
+        lines = ["EC2 API calls (total: %d, throttled: %d):" %
+                 (total, sum(self.throttles.values()))]
+        for action in sorted(self.calls, key=self.calls.get, reverse=True):
+            line = "%s: %d" % (action, self.calls[action])
+            if action in self.throttles:
+                line += " (throttled: %d)" % self.throttles[action]
+            lines.append(line)
+        log.debug('\n'.join(lines))
+
+
+# shared by all EasyEC2 connections in this process
+ec2_limiter = EC2RateLimiter()
+
+
 class EasyAWS(object):
     def __init__(self, aws_access_key_id, aws_secret_access_key,
                  connection_authenticator, **kwargs):
@@ -63,6 +261,7 @@ class EasyAWS(object):
         self.connection_authenticator = connection_authenticator
         self._conn = None
         self._kwargs = kwargs
+        self._rate_limiter = None
 
     def reload(self):
         self._conn = None
@@ -93,6 +292,8 @@ class EasyAWS(object):
                 self.aws_access_key_id, self.aws_secret_access_key,
                 **self._kwargs)
             self._conn.https_validate_certificates = validate_certs
+            if self._rate_limiter:
+                self._rate_limiter.wrap(self._conn)
         return self._conn
 
 
@@ -115,6 +316,7 @@ class EasyEC2(EasyAWS):
         super(EasyEC2, self).__init__(aws_access_key_id, aws_secret_access_key,
                                       boto.connect_vpc, **kwds)
         self._conn = kwargs.get('connection')
+        self._rate_limiter = ec2_limiter
         kwds = dict(aws_s3_host=aws_s3_host, aws_s3_path=aws_s3_path,
                     aws_port=aws_port, aws_is_secure=aws_is_secure,
                     aws_proxy=aws_proxy, aws_proxy_port=aws_proxy_port,
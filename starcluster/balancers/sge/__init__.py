@@ -141,15 +141,17 @@ class SGEStats(object):
         """
         This method parses qacct -j output and makes a neat array and
         calculates some statistics.
-        Takes the string to parse, and a datetime object of the remote
-        host's current time.
+        Takes the string (or an iterable of lines) to parse, and a datetime
+        object of the remote host's current time.
         """
         job_id = None
         qd = None
         start = None
         end = None
         counter = 0
-        lines = string.split('\n')
+        lines = string
+        if isinstance(string, basestring):
+            lines = string.split('\n')
         for l in lines:
             l = l.strip()
             if l.find('jobnumber') != -1:
@@ -529,19 +531,18 @@ class SGELoadBalancer(LoadBalancer):
         qstat_cmd = 'qstat -u \* -xml -f -r'
         qhostxml = '\n'.join(master.ssh.execute('qhost -xml'))
         qstatxml = '\n'.join(master.ssh.execute(qstat_cmd))
+        self.stat.parse_qhost(qhostxml)
+        self.stat.parse_qstat(qstatxml)
+        log.debug("sizes: qhost: %d, qstat: %d" %
+                  (len(qhostxml), len(qstatxml)))
         try:
-            qacct = '\n'.join(master.ssh.execute(qacct_cmd))
+            # parse qacct's output as it arrives - it can be very large
+            self.stat.parse_qacct(master.ssh.execute_iter(qacct_cmd), now)
         except exception.RemoteCommandFailed:
             if master.ssh.isfile('/opt/sge6/default/common/accounting'):
                 raise
             else:
                 log.info("No jobs have completed yet!")
-                qacct = ''
-        self.stat.parse_qhost(qhostxml)
-        self.stat.parse_qstat(qstatxml)
-        self.stat.parse_qacct(qacct, now)
-        log.debug("sizes: qhost: %d, qstat: %d, qacct: %d" %
-                  (len(qhostxml), len(qstatxml), len(qacct)))
         return self.stat
 
     @utils.print_timing("Fetching SGE stats", debug=True)
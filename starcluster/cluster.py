@@ -18,9 +18,11 @@
 import os
 import re
 import time
+import pipes
 import string
 import pprint
 import warnings
+import binascii
 import datetime
 
 import iptools
@@ -39,6 +41,7 @@ from starcluster import clustersetup
 from starcluster.node import Node
 from starcluster.plugins import sge
 from starcluster.utils import print_timing
+from starcluster.templates import relay
 from starcluster.templates import user_msgs
 from starcluster.logger import log
 
@@ -382,6 +385,16 @@ class ClusterManager(managers.Manager):
 
 class Cluster(object):
 
+    # batch plugin hooks and the per-node hooks they fall back to for plugins
+    # that don't subclass ClusterSetup and only implement the per-node hooks
+    _batch_plugin_hooks = {'on_add_nodes': 'on_add_node',
+                           'on_remove_nodes': 'on_remove_node'}
+
+    # node attributes that can be used to look up nodes via get_node(s)
+    _node_index_attrs = ['alias', 'id', 'spot_id', 'dns_name', 'ip_address',
+                         'private_ip_address', 'public_dns_name',
+                         'private_dns_name']
+
     def __init__(self,
                  ec2_conn=None,
                  spot_bid=None,
@@ -405,13 +418,19 @@ class Cluster(object):
                  userdata_scripts=[],
                  refresh_interval=30,
                  disable_queue=False,
-                 num_threads=20,
+                 num_threads=None,
                  disable_threads=False,
+                 node_cache_ttl=10,
+                 stream_setup=False,
                  cluster_group=None,
                  force_spot_master=False,
                  disable_cloudinit=False,
                  subnet_id=None,
                  public_ips=None,
+                 cluster_dns=False,
+                 host_key_ca=False,
+                 setup_timeout=1800,
+                 launch_timeout=3600,
                  **kwargs):
         # update class vars with given vars
         _vars = locals().copy()
@@ -438,6 +457,9 @@ class Cluster(object):
         self._zone = None
         self._master = None
         self._nodes = []
+        self._nodes_updated = None
+        # lookup table used by get_nodes - rebuilt on demand when None
+        self._node_index = None
         self._pool = None
         self._progress_bar = None
         self.__default_plugin = None
@@ -504,7 +526,9 @@ class Cluster(object):
         if not self.__default_plugin:
             self.__default_plugin = clustersetup.DefaultClusterSetup(
                 disable_threads=self.disable_threads,
-                num_threads=self.num_threads)
+                num_threads=self.num_threads, cluster_dns=self.cluster_dns,
+                host_key_ca=self.host_key_ca,
+                setup_timeout=self.setup_timeout)
         return self.__default_plugin
 
     @property
@@ -699,6 +723,11 @@ class Cluster(object):
                              subnet_id=self.subnet_id,
                              public_ips=self.public_ips,
                              disable_queue=self.disable_queue,
+                             cluster_dns=self.cluster_dns,
+                             host_key_ca=self.host_key_ca,
+                             setup_timeout=self.setup_timeout,
+                             launch_timeout=self.launch_timeout,
+                             node_cache_ttl=self.node_cache_ttl,
                              disable_cloudinit=self.disable_cloudinit)
         user_settings = dict(cluster_user=self.cluster_user,
                              cluster_shell=self.cluster_shell,
@@ -745,6 +774,19 @@ class Cluster(object):
 
     @property
     def nodes(self):
+        """
+        Returns the list of cluster nodes. The list is cached for
+        node_cache_ttl seconds - use refresh() to force an update from EC2
+        """
+        updated = self._nodes_updated
+        if updated is None or time.time() - updated > self.node_cache_ttl:
+            self.refresh()
+        return self._nodes
+
+    def refresh(self):
+        """
+        Update the cached list of cluster nodes from EC2
+        """
         states = ['pending', 'running', 'stopping', 'stopped']
         filters = {'instance-state-name': states,
                    'instance.group-name': self._security_group}
@@ -772,55 +814,68 @@ class Cluster(object):
                 else:
                     self._nodes.append(n)
         self._nodes.sort(key=lambda n: n.alias)
+        self._node_index = None
+        self._nodes_updated = time.time()
         log.debug('returning self._nodes = %s' % self._nodes)
         return self._nodes
 
-    def get_nodes_or_raise(self):
-        nodes = self.nodes
+    def invalidate(self):
+        """
+        Mark the cached list of cluster nodes as stale so that the next access
+        to self.nodes updates it from EC2
+        """
+        self._nodes_updated = None
+
+    def get_nodes_or_raise(self, refresh=False):
+        nodes = self.refresh() if refresh else self.nodes
         if not nodes:
             filters = {'instance.group-name': self._security_group}
             terminated_nodes = self.ec2.get_all_instances(filters=filters)
             raise exception.NoClusterNodesFound(terminated_nodes)
         return nodes
 
+    def _get_node_index(self, nodes):
+        """
+        Returns a dictionary mapping each node's unique instance attributes
+        (see get_node) to the node
+        """
+        index = {}
+        for node in nodes:
+            for attr in self._node_index_attrs:
+                key = getattr(node, attr)
+                if key:
+                    index.setdefault(key, node)
+        return index
+
     def get_node(self, identifier, nodes=None):
         """
         Returns a node if the identifier specified matches any unique instance
         attribute (e.g. instance id, alias, spot id, dns name, private ip,
         public ip, etc.)
         """
-        nodes = nodes or self.nodes
-        for node in self.nodes:
-            if node.alias == identifier:
-                return node
-            if node.id == identifier:
-                return node
-            if node.spot_id == identifier:
-                return node
-            if node.dns_name == identifier:
-                return node
-            if node.ip_address == identifier:
-                return node
-            if node.private_ip_address == identifier:
-                return node
-            if node.public_dns_name == identifier:
-                return node
-            if node.private_dns_name == identifier:
-                return node
-        raise exception.InstanceDoesNotExist(identifier, label='node')
+        return self.get_nodes([identifier], nodes=nodes)[0]
 
     def get_nodes(self, identifiers, nodes=None):
         """
         Same as get_node but takes a list of identifiers and returns a list of
         nodes.
         """
-        nodes = nodes or self.nodes
+        if nodes:
+            index = self._get_node_index(nodes)
+        else:
+            # refreshes the index if the node cache is stale
+            nodes = self.nodes
+            index = self._node_index
+            if index is None:
+                index = self._node_index = self._get_node_index(nodes)
         node_list = []
+        seen = set()
         for i in identifiers:
-            n = self.get_node(i, nodes=nodes)
-            if n in node_list:
-                continue
-            else:
+            n = index.get(i)
+            if n is None:
+                raise exception.InstanceDoesNotExist(i, label='node')
+            if n.id not in seen:
+                seen.add(n.id)
                 node_list.append(n)
         return node_list
 
@@ -966,6 +1021,7 @@ class Cluster(object):
             resvs.append(self.ec2.request_instances(image_id, **kwargs))
         for resv in resvs:
             log.info(str(resv), extra=dict(__raw__=True))
+        self.invalidate()
         return resvs
 
     def _get_next_node_num(self):
@@ -1035,11 +1091,11 @@ class Cluster(object):
                 self.ec2.wait_for_propagation(spot_requests=resp)
             else:
                 self.ec2.wait_for_propagation(instances=resp[0].instances)
+        self.invalidate()
         self.wait_for_cluster(msg="Waiting for node(s) to come up...")
         log.debug("Adding node(s): %s" % aliases)
-        for alias in aliases:
-            node = self.get_node(alias)
-            self.run_plugins(method_name="on_add_node", node=node)
+        nodes = self.get_nodes(aliases)
+        self.run_plugins(method_name="on_add_nodes", node=nodes)
 
     def remove_node(self, node=None, terminate=True, force=False):
         """
@@ -1070,16 +1126,16 @@ class Cluster(object):
                 if node.is_master():
                     raise exception.InvalidOperation(
                         "cannot remove master node")
-        for node in nodes:
-            try:
-                self.run_plugins(method_name="on_remove_node", node=node,
-                                 reverse=True)
-            except:
-                if not force:
-                    raise
-            if not terminate:
-                continue
-            node.terminate()
+        try:
+            self.run_plugins(method_name="on_remove_nodes", node=nodes,
+                             reverse=True)
+        except:
+            if not force:
+                raise
+        if terminate:
+            for node in nodes:
+                node.terminate()
+        self.invalidate()
 
     def _get_launch_map(self, reverse=False):
         """
@@ -1353,8 +1409,9 @@ class Cluster(object):
     @property
     def pool(self):
         if not self._pool:
-            self._pool = threadpool.get_thread_pool(
-                size=self.num_threads, disable_threads=self.disable_threads)
+            self._pool = threadpool.get_cluster_thread_pool(
+                num_nodes=self.cluster_size, num_threads=self.num_threads,
+                disable_threads=self.disable_threads)
         return self._pool
 
     @property
@@ -1417,17 +1474,67 @@ class Cluster(object):
                         node.terminate()
                 else:
                     time.sleep(self.refresh_interval)
-                nodes = self.get_nodes_or_raise()
+                nodes = self.get_nodes_or_raise(refresh=True)
         pbar.reset()
 
+    def _update_instances(self, nodes):
+        """
+        Update the instance data of each node in nodes from EC2 using a
+        single describe request (per 200 nodes - EC2's limit on the number of
+        filter values)
+        """
+        instances = {}
+        for i in range(0, len(nodes), 200):
+            ids = [n.id for n in nodes[i:i + 200]]
+            for inst in self.ec2.get_all_instances(
+                    filters={'instance-id': ids}):
+                instances[inst.id] = inst
+        for node in nodes:
+            if node.id in instances:
+                node.instance = instances[node.id]
+        # the nodes' addresses may have changed
+        self._node_index = None
+
+    def _probe_ssh(self, nodes, update=True):
+        """
+        Returns the nodes in nodes that are running and accept SSH
+        connections. Makes one describe request for all nodes and only
+        attempts a full SSH handshake with the nodes whose sshd sent its
+        banner.
+
+        update - if False use the nodes' current instance data rather than
+                 making a describe request
+        """
+        if update:
+            self._update_instances(nodes)
+        running = [n for n in nodes if n.state == 'running' and n.addr]
+        listening = sshutils.scan_ssh_banners([n.addr for n in running])
+        ready = [n for n in running if n.addr in listening]
+        futures = [self.pool.submit(n.is_up, kwargs=dict(update=False),
+                                    jobid=n.alias) for n in ready]
+        return [n for n, f in zip(ready, futures) if f.result()]
+
     def wait_for_ssh(self, nodes=None):
         """
-        Wait until all cluster nodes are in a 'running' state
+        Wait until SSH is up on all cluster nodes
+
+        The nodes that aren't up yet are probed every refresh_interval (see
+        _probe_ssh) rather than each node polling EC2 and SSH on its own.
         """
         log.info("Waiting for SSH to come up on all nodes...")
         nodes = nodes or self.get_nodes_or_raise()
-        self.pool.map(lambda n: n.wait(interval=self.refresh_interval), nodes,
-                      jobid_fn=lambda n: n.alias)
+        pbar = self.progress_bar.reset()
+        pbar.maxval = len(nodes)
+        pbar.update(0)
+        pending = list(nodes)
+        while pending:
+            up = set(n.id for n in self._probe_ssh(pending))
+            pending = [n for n in pending if n.id not in up]
+            pbar.update(len(nodes) - len(pending))
+            if pending:
+                log.debug("waiting for SSH on %d nodes" % len(pending))
+                time.sleep(self.refresh_interval)
+        pbar.reset()
 
     @print_timing("Waiting for cluster to come up")
     def wait_for_cluster(self, msg="Waiting for cluster to come up..."):
@@ -1556,6 +1663,7 @@ class Cluster(object):
         self.detach_volumes()
         for node in nodes:
             node.shutdown()
+        self.invalidate()
 
     def terminate_cluster(self, force=False):
         """
@@ -1574,6 +1682,7 @@ class Cluster(object):
         nodes = self.nodes
         for node in nodes:
             node.terminate()
+        self.invalidate()
         for spot in self.spot_requests:
             if spot.state not in ['cancelled', 'closed']:
                 log.info("Canceling spot instance request: %s" % spot.id)
@@ -1646,6 +1755,7 @@ class Cluster(object):
             for node in self.stopped_nodes:
                 log.info("Starting stopped node: %s" % node.alias)
                 node.start()
+            self.invalidate()
         if create_only:
             return
         self.setup_cluster()
@@ -1654,11 +1764,92 @@ class Cluster(object):
         """
         Waits for all nodes to come up and then runs the default
         StarCluster setup routines followed by any additional plugin setup
-        routines
+        routines. If stream_setup is True each node is configured as soon as
+        it comes up instead (see _stream_setup_cluster)
         """
+        if self.stream_setup:
+            return self._stream_setup_cluster()
         self.wait_for_cluster()
         self._setup_cluster()
 
+    def _get_pending_spot_requests(self, nodes):
+        """
+        Returns spot requests that have not been fulfilled yet or whose
+        instances are not yet included in nodes
+        """
+        ids = [n.id for n in nodes]
+        return [s for s in self.spot_requests
+                if s.state == 'open' or s.instance_id not in ids]
+
+    @print_timing("Configuring cluster")
+    def _stream_setup_cluster(self):
+        """
+        Configures each node as soon as its SSH daemon comes up rather than
+        waiting for all nodes. The master is configured first by running the
+        plugins' run() methods on the master and any workers that are already
+        up. Workers that come up later are added in batches using the plugins'
+        on_add_nodes() methods.
+
+        All nodes that aren't up yet are probed once per refresh_interval
+        using a single describe request (see _probe_ssh). Workers that aren't
+        up within launch_timeout seconds of calling this method are skipped
+        and NodeTimeout is raised if the master isn't.
+        """
+        interval = self.refresh_interval
+        timeout = self.launch_timeout
+        deadline = timeout and time.time() + timeout
+        log.info("Configuring nodes as they come up (updating every %ds)..." %
+                 interval)
+        configured = []
+        skipped = set()
+        master = None
+        while True:
+            nodes = self.refresh()
+            done = set([n.id for n in configured]) | skipped
+            pending = [n for n in nodes if n.id not in done]
+            ready = self._probe_ssh(pending, update=False) if pending else []
+            expired = deadline and time.time() > deadline
+            if expired:
+                ready_ids = set([n.id for n in ready])
+                for node in pending:
+                    if node.id in ready_ids:
+                        continue
+                    if node.is_master():
+                        raise exception.NodeTimeout(node.alias, timeout)
+                    log.error("%s did not come up within %d seconds - "
+                              "skipping" % (node.alias, timeout))
+                    skipped.add(node.id)
+                if master is None and not [n for n in ready
+                                           if n.is_master()]:
+                    # the master's instance doesn't even exist (yet)
+                    raise exception.NodeTimeout(
+                        self._make_alias(master=True), timeout)
+            if master is None:
+                master = ([n for n in ready if n.is_master()] or [None])[0]
+                if master:
+                    log.info("The master node is %s" % master.dns_name)
+                    if self.volumes:
+                        self.attach_volumes_to_master()
+                    log.info("Configuring master and %d worker node(s)..." %
+                             (len(ready) - 1))
+                    self.run_plugins(nodes=ready)
+                    configured.extend(ready)
+            elif ready:
+                log.info("Adding %d node(s) that came up: %s" %
+                         (len(ready), ', '.join([n.alias for n in ready])))
+                self.run_plugins(method_name="on_add_nodes", node=ready,
+                                 nodes=configured + ready)
+                configured.extend(ready)
+            done = set([n.id for n in configured]) | skipped
+            if master and not [n for n in nodes if n.id not in done]:
+                if not self._get_pending_spot_requests(nodes):
+                    break
+                if expired:
+                    log.error("Not all spot requests were fulfilled within "
+                              "%d seconds - giving up" % timeout)
+                    break
+            time.sleep(interval)
+
     @print_timing("Configuring cluster")
     def _setup_cluster(self):
         """
@@ -1672,10 +1863,11 @@ class Cluster(object):
         self.run_plugins()
 
     def run_plugins(self, plugins=None, method_name="run", node=None,
-                    reverse=False):
+                    reverse=False, nodes=None):
         """
         Run all plugins specified in this Cluster object's self.plugins list
-        Uses plugins list instead of self.plugins if specified.
+        Uses plugins list instead of self.plugins if specified. Plugins are
+        passed nodes instead of all cluster nodes if specified.
 
         plugins must be a tuple: the first element is the plugin's name, the
         second element is the plugin object (a subclass of ClusterSetup)
@@ -1687,27 +1879,35 @@ class Cluster(object):
         if reverse:
             plugs.reverse()
         for plug in plugs:
-            self.run_plugin(plug, method_name=method_name, node=node)
+            self.run_plugin(plug, method_name=method_name, node=node,
+                            nodes=nodes)
 
-    def run_plugin(self, plugin, name='', method_name='run', node=None):
+    def run_plugin(self, plugin, name='', method_name='run', node=None,
+                   nodes=None):
         """
         Run a StarCluster plugin.
 
         plugin - an instance of the plugin's class
         name - a user-friendly label for the plugin
         method_name - the method to run within the plugin (default: "run")
-        node - optional node to pass as first argument to plugin method (used
-        for on_add_node/on_remove_node)
+        node - optional node (or list of nodes) to pass as first argument to
+        plugin method (used for on_add_node(s)/on_remove_node(s))
+        nodes - nodes to pass to the plugin method (default: all nodes)
         """
         plugin_name = name or getattr(plugin, '__name__',
                                       utils.get_fq_class_name(plugin))
         try:
             func = getattr(plugin, method_name, None)
+            per_node_hook = self._batch_plugin_hooks.get(method_name)
+            if not func and getattr(plugin, per_node_hook or '', None):
+                func = self._get_per_node_hook(plugin, per_node_hook)
             if not func:
                 log.warn("Plugin %s has no %s method...skipping" %
                          (plugin_name, method_name))
                 return
-            args = [self.nodes, self.master_node, self.cluster_user,
+            master = self.master_node
+            self._limit_master_channels(master)
+            args = [nodes or self.nodes, master, self.cluster_user,
                     self.cluster_shell, self.volumes]
             if node:
                 args.insert(0, node)
@@ -1724,6 +1924,27 @@ class Cluster(object):
             log.error("Error occured while running plugin '%s':" % plugin_name)
             raise
 
+    def _get_per_node_hook(self, plugin, method_name):
+        """
+        Returns a function that takes a list of nodes followed by the usual
+        plugin arguments and calls plugin's method_name for each node
+        """
+        method = getattr(plugin, method_name)
+
+        def run_for_each_node(nodes, *args):
+            for node in nodes:
+                method(node, *args)
+        return run_for_each_node
+
+    def _limit_master_channels(self, master):
+        """
+        Limit the number of concurrent ssh channels to the master so that
+        plugins fanning out across the cluster don't overload its sshd
+        """
+        limits = threadpool.host_limits
+        if limits.get_limit(master.addr) != threadpool.MASTER_CHANNEL_LIMIT:
+            limits.set_limit(master.addr, threadpool.MASTER_CHANNEL_LIMIT)
+
     def ssh_to_master(self, user='root', command=None, forward_x11=False,
                       forward_agent=False, pseudo_tty=False):
         return self.master_node.shell(user=user, command=command,
@@ -1739,6 +1960,127 @@ class Cluster(object):
                           pseudo_tty=pseudo_tty,
                           command=command)
 
+    def execute_all(self, command, nodes=None, user=None, relay=False,
+                    source_profile=True, fanout=64):
+        """
+        Execute command on all nodes (or the given list of nodes) in parallel
+        and return a dictionary mapping each node's alias to an (output,
+        exit_status, seconds) tuple. An exit_status of -1 means the command
+        could not be run on the node and output contains the error instead.
+
+        user - run the command as user instead of the nodes' default user
+        relay - run the command on the master and have the master ssh to the
+                other nodes rather than connecting to every node from this
+                machine
+        fanout - max number of nodes the master runs the command on at the
+                 same time when relay=True
+        """
+        nodes = nodes or self.get_nodes_or_raise()
+        if relay:
+            return self._execute_all_via_master(command, nodes, user=user,
+                                                source_profile=source_profile,
+                                                fanout=fanout)
+        results = self.pool.map(
+            lambda n: self._execute_on_node(n, command, user=user,
+                                            source_profile=source_profile),
+            nodes, jobid_fn=lambda n: n.alias)
+        return dict(zip([n.alias for n in nodes], results))
+
+    def _restore_user(self, ssh, user):
+        """
+        Switch ssh back to user after running a command as someone else. If
+        ssh wasn't connected before (user is None) it is closed instead so
+        that it reconnects as its default user when next used.
+        """
+        try:
+            if user:
+                ssh.switch_user(user)
+            else:
+                ssh.close()
+        except exception.BaseException, e:
+            log.debug("unable to switch back to user %s: %s" % (user, e))
+            ssh.close()
+
+    def _execute_on_node(self, node, command, user=None, source_profile=True):
+        start = time.time()
+        ssh = node.ssh
+        orig_user = ssh.get_current_user()
+        try:
+            if user:
+                ssh.switch_user(user)
+            output = ssh.execute(command, source_profile=source_profile,
+                                 ignore_exit_status=True)
+            status = ssh.get_last_status()
+        except exception.BaseException, e:
+            output, status = [str(e)], -1
+        finally:
+            if user:
+                self._restore_user(ssh, orig_user)
+        return output, status, time.time() - start
+
+    def _execute_all_via_master(self, command, nodes, user=None,
+                                source_profile=True, fanout=64):
+        master = self.master_node
+        if not user:
+            return self._relay_command(master, command, nodes,
+                                       source_profile=source_profile,
+                                       fanout=fanout)
+        orig_user = master.ssh.get_current_user()
+        try:
+            master.ssh.switch_user(user)
+            return self._relay_command(master, command, nodes,
+                                       source_profile=source_profile,
+                                       fanout=fanout)
+        finally:
+            self._restore_user(master.ssh, orig_user)
+
+    def _relay_command(self, master, command, nodes, source_profile=True,
+                       fanout=64):
+        if source_profile:
+            command = "source /etc/profile && %s" % command
+        marker = '__starcluster_node_%s__' % binascii.hexlify(os.urandom(8))
+        aliases = ' '.join(n.alias for n in nodes)
+        script = relay.relay_template % dict(
+            command=pipes.quote(command), master=master.alias,
+            aliases=aliases, fanout=fanout, marker=marker)
+        log.debug("relaying command to %s via %s: %s" %
+                  (aliases, master.alias, command))
+        start = time.time()
+        try:
+            lines = master.ssh.execute(script, source_profile=False,
+                                       ignore_exit_status=True,
+                                       log_output=False)
+        except exception.BaseException, e:
+            elapsed = time.time() - start
+            return dict((n.alias, ([str(e)], -1, elapsed)) for n in nodes)
+        results = {}
+        output = []
+        for line in lines:
+            index = line.find(marker)
+            if index < 0:
+                output.append(line)
+                continue
+            # the marker follows the node's output on the same line if the
+            # output does not end with a newline
+            if index > 0:
+                output.append(line[:index])
+            fields = line[index:].split()[1:]
+            try:
+                alias, status, msecs = fields
+                results[alias] = (output, int(status), int(msecs) / 1000.0)
+            except ValueError:
+                # the node's status wasn't (completely) written, e.g. because
+                # its ssh connection was killed
+                log.debug("unable to parse relay status line: %s" % line)
+                if fields:
+                    results[fields[0]] = (output, -1, time.time() - start)
+            output = []
+        for node in nodes:
+            if node.alias not in results:
+                msg = "no output received from %s" % master.alias
+                results[node.alias] = ([msg], -1, time.time() - start)
+        return results
+
 
 class ClusterValidator(validators.Validator):
 
@@ -18,6 +18,7 @@
 """
 clustersetup.py
 """
+import stat
 import posixpath
 
 from starcluster import utils
@@ -50,6 +51,28 @@ class ClusterSetup(object):
         """
         raise NotImplementedError('on_remove_node method not implemented')
 
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
+        """
+        This method gets executed after a batch of nodes has been added to the
+        cluster. Defaults to calling on_add_node for each node in new_nodes.
+        Plugins should override this method if they can configure many nodes
+        at once more efficiently.
+        """
+        for node in new_nodes:
+            self.on_add_node(node, nodes, master, user, user_shell, volumes)
+
+    def on_remove_nodes(self, remove_nodes, nodes, master, user, user_shell,
+                        volumes):
+        """
+        This method gets executed before a batch of nodes is about to be
+        removed from the cluster. Defaults to calling on_remove_node for each
+        node in remove_nodes.
+        """
+        for node in remove_nodes:
+            self.on_remove_node(node, nodes, master, user, user_shell,
+                                volumes)
+
     def on_restart(self, nodes, master, user, user_shell, volumes):
         """
         This method gets executed before restart the cluster
@@ -88,7 +111,8 @@ class DefaultClusterSetup(ClusterSetup):
     """
     Default ClusterSetup implementation for StarCluster
     """
-    def __init__(self, disable_threads=False, num_threads=20):
+    def __init__(self, disable_threads=False, num_threads=None,
+                 cluster_dns=False, host_key_ca=False, setup_timeout=None):
         self._nodes = None
         self._master = None
         self._user = None
@@ -96,13 +120,19 @@ class DefaultClusterSetup(ClusterSetup):
         self._volumes = None
         self._disable_threads = disable_threads
         self._num_threads = num_threads
+        self._cluster_dns = cluster_dns
+        self._host_key_ca = host_key_ca
+        # number of seconds a single setup step may run on a node
+        self._setup_timeout = setup_timeout
         self._pool = None
 
     @property
     def pool(self):
         if not self._pool:
-            self._pool = threadpool.get_thread_pool(self._num_threads,
-                                                    self._disable_threads)
+            num_nodes = len(self._nodes) if self._nodes else None
+            self._pool = threadpool.get_cluster_thread_pool(
+                num_nodes=num_nodes, num_threads=self._num_threads,
+                disable_threads=self._disable_threads)
         return self._pool
 
     @property
@@ -120,7 +150,8 @@ class DefaultClusterSetup(ClusterSetup):
         nodes = nodes or self._nodes
         log.info("Configuring hostnames...")
         for node in nodes:
-            self.pool.simple_job(node.set_hostname, (), jobid=node.alias)
+            self.pool.simple_job(node.set_hostname, (), jobid=node.alias,
+                                 timeout=self._setup_timeout)
         self.pool.wait(numtasks=len(nodes))
 
     def _get_max_unused_user_id(self):
@@ -130,9 +161,10 @@ class DefaultClusterSetup(ClusterSetup):
         umap = self._master.get_user_map(key_by_uid=True)
         uid_db = {}
         files = mconn.ls('/home')
+        attrs = mconn.stat_many(files)
         for file in files:
-            if mconn.isdir(file):
-                f = mconn.stat(file)
+            f = attrs.get(file)
+            if f and stat.S_ISDIR(f.st_mode):
                 uid_db[f.st_uid] = (file, f.st_gid)
         if uid_db.keys():
             max_uid = max(uid_db.keys())
@@ -180,6 +212,15 @@ class DefaultClusterSetup(ClusterSetup):
         the new user to be the existing uid/gid of the dir in EBS rather than
         chowning potentially terabytes of data.
         """
+        uid, gid = self._get_cluster_user_id(user)
+        self._add_user_to_nodes(uid, gid, self._nodes)
+
+    def _get_cluster_user_id(self, user=None):
+        """
+        Returns the (uid, gid) to use for the cluster user (see
+        _get_new_user_id). Raises an exception if either the uid or gid is
+        root's.
+        """
         user = user or self._user
         uid, gid = self._get_new_user_id(user)
         if uid == 0 or gid == 0:
@@ -190,7 +231,7 @@ class DefaultClusterSetup(ClusterSetup):
                 "instance is still up.".format(user, uid, gid))
         log.info("Creating cluster user: %s (uid: %d, gid: %d)" %
                  (user, uid, gid))
-        self._add_user_to_nodes(uid, gid, self._nodes)
+        return uid, gid
 
     def _add_user_to_node(self, uid, gid, node):
         existing_user = node.getpwuid(uid)
@@ -213,23 +254,22 @@ class DefaultClusterSetup(ClusterSetup):
         nodes = nodes or self._nodes
         for node in nodes:
             self.pool.simple_job(self._add_user_to_node, (uid, gid, node),
-                                 jobid=node.alias)
+                                 jobid=node.alias, timeout=self._setup_timeout)
         self.pool.wait(numtasks=len(nodes))
 
     def _setup_scratch_on_node(self, node, users=None):
-        nconn = node.ssh
         users = users or [self._user]
+        scratch = '/scratch'
+        cmds = ['mkdir -p %s' % scratch]
         for user in users:
             user_scratch = '/mnt/%s' % user
-            if not nconn.path_exists(user_scratch):
-                nconn.mkdir(user_scratch)
-            nconn.execute('chown -R %(user)s:%(user)s /mnt/%(user)s' %
-                          {'user': user})
-            scratch = '/scratch'
-            if not nconn.path_exists(scratch):
-                nconn.mkdir(scratch)
-            if not nconn.path_exists(posixpath.join(scratch, user)):
-                nconn.execute('ln -s %s %s' % (user_scratch, scratch))
+            user_link = posixpath.join(scratch, user)
+            cmds.extend([
+                'mkdir -p %s' % user_scratch,
+                'chown -R %(user)s:%(user)s /mnt/%(user)s' % {'user': user},
+                '[ -e %s ] || ln -s %s %s' % (user_link, user_scratch,
+                                              scratch)])
+        node.ssh.execute_many(cmds)
 
     def _setup_scratch(self, nodes=None, users=None):
         """ Configure scratch space on all StarCluster nodes """
@@ -239,35 +279,98 @@ class DefaultClusterSetup(ClusterSetup):
         nodes = nodes or self._nodes
         for node in nodes:
             self.pool.simple_job(self._setup_scratch_on_node, (node, users),
-                                 jobid=node.alias)
+                                 jobid=node.alias, timeout=self._setup_timeout)
         self.pool.wait(numtasks=len(nodes))
 
-    def _setup_etc_hosts(self, nodes=None):
-        """ Configure /etc/hosts on all StarCluster nodes"""
-        log.info("Configuring /etc/hosts on each node")
+    def _setup_etc_hosts(self, nodes=None, new_nodes=None):
+        """
+        Configure /etc/hosts on all StarCluster nodes
+
+        If new_nodes is specified the nodes that aren't new only get the
+        entries for new_nodes added
+        """
         nodes = nodes or self._nodes
+        if self._cluster_dns:
+            return self._setup_cluster_dns(nodes, new_nodes=new_nodes)
+        log.info("Configuring /etc/hosts on each node")
+        new_ids = [n.id for n in new_nodes or nodes]
         for node in nodes:
-            self.pool.simple_job(node.add_to_etc_hosts, (nodes, ),
-                                 jobid=node.alias)
+            entries = nodes if node.id in new_ids else new_nodes
+            self.pool.simple_job(node.add_to_etc_hosts, (entries, ),
+                                 jobid=node.alias, timeout=self._setup_timeout)
         self.pool.wait(numtasks=len(nodes))
 
+    def _setup_cluster_dns(self, nodes=None, new_nodes=None):
+        """
+        Configure the master's DNS server to resolve all StarCluster nodes and
+        point the worker nodes at it
+
+        If new_nodes is specified only the records for new_nodes are added on
+        the master and only new_nodes are pointed at the master's DNS server
+        """
+        log.info("Configuring DNS on the master")
+        master = self._master
+        nodes = nodes or self._nodes
+        master.add_to_etc_hosts(new_nodes or nodes)
+        if new_nodes:
+            master.reload_dns_server()
+        else:
+            master.start_dns_server()
+        workers = [n for n in new_nodes or nodes if not n.is_master()]
+        for node in workers:
+            self.pool.simple_job(self._use_cluster_dns_on_node, (node,),
+                                 jobid=node.alias, timeout=self._setup_timeout)
+        self.pool.wait(numtasks=len(workers))
+
+    def _use_cluster_dns_on_node(self, node):
+        """
+        Point node at the master's DNS server. The node keeps /etc/hosts
+        entries for itself and the master so that both resolve even if the
+        DNS server is unreachable.
+        """
+        node.add_to_etc_hosts([self._master, node])
+        node.use_dns_server(self._master)
+
     def _setup_passwordless_ssh(self, nodes=None):
         """
         Properly configure passwordless ssh for root and CLUSTER_USER on all
         StarCluster nodes
         """
-        log.info("Configuring passwordless ssh for root")
         master = self._master
         nodes = nodes or self.nodes
+        if self._host_key_ca:
+            self._setup_host_certificates(nodes)
+        log.info("Configuring passwordless ssh for root")
         master.generate_key_for_user('root', auth_new_key=True,
                                      auth_conn_key=True)
-        master.enable_passwordless_ssh('root', nodes)
+        if self._host_key_ca:
+            master.copy_ssh_files_to_nodes('root', nodes, known_hosts=False)
+        else:
+            master.enable_passwordless_ssh('root', nodes)
         # generate public/private keys, authorized_keys, and known_hosts files
         # for cluster_user once on master node...NFS takes care of the rest
         log.info("Configuring passwordless ssh for %s" % self._user)
         master.generate_key_for_user(self._user, auth_new_key=True,
                                      auth_conn_key=True)
-        master.add_to_known_hosts(self._user, nodes)
+        if not self._host_key_ca:
+            master.add_to_known_hosts(self._user, nodes)
+
+    def _setup_host_certificates(self, nodes):
+        """
+        Sign the ssh host keys of each node in nodes with the master's host
+        certificate authority and have each node trust the CA
+        """
+        log.info("Signing ssh host keys on %d node(s)" % len(nodes))
+        ca_pubkey = self._master.generate_host_ca()
+        for node in nodes:
+            self.pool.simple_job(self._setup_host_certificate,
+                                 (node, ca_pubkey), jobid=node.alias,
+                                 timeout=self._setup_timeout)
+        self.pool.wait(numtasks=len(nodes))
+
+    def _setup_host_certificate(self, node, ca_pubkey):
+        certs = self._master.sign_host_keys(node, node.get_host_keys())
+        node.install_host_certificates(certs, ca_pubkey)
 
     def _setup_ebs_volumes(self):
         """
@@ -349,7 +452,7 @@ class DefaultClusterSetup(ClusterSetup):
         for node in nodes:
             self.pool.simple_job(node.mount_nfs_shares,
                                  (self._master, export_paths),
-                                 jobid=node.alias)
+                                 jobid=node.alias, timeout=self._setup_timeout)
         self.pool.wait(numtasks=len(nodes))
 
     @print_timing("Setting up NFS")
@@ -367,6 +470,89 @@ class DefaultClusterSetup(ClusterSetup):
             master.export_fs_to_nodes(nodes, export_paths)
             self._mount_nfs_shares(nodes, export_paths=export_paths)
 
+    def _start_nfs_server(self, nodes, export_paths):
+        self._master.start_nfs_server()
+        if nodes:
+            self._master.export_fs_to_nodes(nodes, export_paths)
+
+    def _get_setup_graph(self):
+        """
+        Returns a threadpool.JobGraph containing the default setup routines
+        for every node. Each node moves through its own setup steps (hostname,
+        user, scratch, /etc/hosts, NFS mounts, ssh keys) as soon as the steps
+        it depends on have finished. The only cross-node dependencies are on
+        the master: the cluster user's uid/gid and NFS exports require the EBS
+        volumes to be mounted on the master and NFS mounts on the workers
+        require the master's NFS server (and, with cluster_dns, the master's
+        DNS server).
+        """
+        master = self._master
+        nodes = self.nodes
+        user = self._user
+        export_paths = self._get_nfs_export_paths()
+        kg_kwargs = dict(auth_new_key=True, auth_conn_key=True)
+        # retry steps that fail due to transient ssh connection errors
+        graph = threadpool.JobGraph(self.pool, timeout=self._setup_timeout,
+                                    retry=threadpool.RetryPolicy())
+        graph.add_job('ebs', self._setup_ebs_volumes)
+        graph.add_job('uid', self._get_cluster_user_id, (user,), deps=['ebs'])
+        graph.add_job('nfs-server', self._start_nfs_server,
+                      (nodes, export_paths),
+                      deps=['ebs', 'etc-hosts:%s' % master.alias])
+        graph.add_job('root-key', master.generate_key_for_user, ('root',),
+                      kg_kwargs)
+        graph.add_job('user-key', master.generate_key_for_user, (user,),
+                      kg_kwargs, deps=['user:%s' % master.alias])
+        if self._host_key_ca:
+            # every node trusts the CA so known_hosts files aren't needed
+            graph.add_job('host-ca', master.generate_host_ca)
+            root_ssh_deps = ['root-key']
+        else:
+            graph.add_job('root-known-hosts', master.add_to_known_hosts,
+                          ('root', nodes[:]), deps=['root-key'])
+            graph.add_job('user-known-hosts', master.add_to_known_hosts,
+                          (user, nodes[:]), deps=['user-key'])
+            root_ssh_deps = ['root-known-hosts']
+        for node in self._nodes:
+            alias = node.alias
+            graph.add_job('hostname:' + alias, node.set_hostname)
+            graph.add_job('user:' + alias, self._add_cluster_user_to_node,
+                          (node, graph), deps=['uid', 'hostname:' + alias])
+            graph.add_job('scratch:' + alias, self._setup_scratch_on_node,
+                          (node,), deps=['user:' + alias])
+            if not self._cluster_dns or node.is_master():
+                graph.add_job('etc-hosts:' + alias, node.add_to_etc_hosts,
+                              (self._nodes,), deps=['hostname:' + alias])
+            else:
+                graph.add_job('etc-hosts:' + alias,
+                              self._use_cluster_dns_on_node, (node,),
+                              deps=['hostname:' + alias, 'dns-server'])
+            if self._host_key_ca:
+                graph.add_job('host-cert:' + alias,
+                              self._add_host_certificate_to_node,
+                              (node, graph), deps=['host-ca'])
+        if self._cluster_dns:
+            graph.add_job('dns-server', master.start_dns_server,
+                          deps=['etc-hosts:%s' % master.alias])
+        for node in nodes:
+            alias = node.alias
+            graph.add_job('nfs:' + alias, node.mount_nfs_shares,
+                          (master, export_paths),
+                          deps=['nfs-server', 'etc-hosts:' + alias,
+                                'user:' + alias])
+            graph.add_job('root-ssh:' + alias, master.copy_ssh_files_to_nodes,
+                          ('root', [node]),
+                          dict(known_hosts=not self._host_key_ca),
+                          deps=root_ssh_deps)
+        return graph
+
+    def _add_cluster_user_to_node(self, node, graph):
+        uid, gid = graph.results['uid']
+        self._add_user_to_node(uid, gid, node)
+
+    def _add_host_certificate_to_node(self, node, graph):
+        self._setup_host_certificate(node, graph.results['host-ca'])
+
     def run(self, nodes, master, user, user_shell, volumes):
         """Start cluster configuration"""
         self._nodes = nodes
@@ -374,56 +560,108 @@ class DefaultClusterSetup(ClusterSetup):
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        self._setup_hostnames()
-        self._setup_ebs_volumes()
-        self._setup_cluster_user()
-        self._setup_scratch()
-        self._setup_etc_hosts()
-        self._setup_nfs()
-        self._setup_passwordless_ssh()
-
-    def _remove_from_etc_hosts(self, node):
-        nodes = filter(lambda x: x.id != node.id, self.running_nodes)
+        log.info("Configuring hostnames, cluster user (%s), scratch space, "
+                 "/etc/hosts, NFS, and passwordless ssh on %d node(s)" %
+                 (user, len(nodes)), extra=dict(__textwrap__=True))
+        self._get_setup_graph().run()
+
+    def _get_remaining_nodes(self, remove_nodes):
+        ids = [n.id for n in remove_nodes]
+        return filter(lambda x: x.id not in ids, self.running_nodes)
+
+    def _remove_from_etc_hosts(self, remove_nodes):
+        if self._cluster_dns:
+            # workers only list themselves and the master in /etc/hosts
+            self._master.remove_from_etc_hosts(remove_nodes)
+            self._master.reload_dns_server()
+            return
+        nodes = self._get_remaining_nodes(remove_nodes)
         for n in nodes:
-            n.remove_from_etc_hosts([node])
+            self.pool.simple_job(n.remove_from_etc_hosts, (remove_nodes,),
+                                 jobid=n.alias, timeout=self._setup_timeout)
+        self.pool.wait(numtasks=len(nodes))
+
+    def _remove_nfs_exports(self, remove_nodes):
+        self._master.stop_exporting_fs_to_nodes(remove_nodes)
 
-    def _remove_nfs_exports(self, node):
-        self._master.stop_exporting_fs_to_nodes([node])
+    def _remove_from_known_hosts_on_node(self, node, remove_nodes):
+        node.remove_from_known_hosts('root', remove_nodes)
+        node.remove_from_known_hosts(self._user, remove_nodes)
 
-    def _remove_from_known_hosts(self, node):
-        nodes = filter(lambda x: x.id != node.id, self.running_nodes)
+    def _remove_from_known_hosts(self, remove_nodes):
+        if self._host_key_ca:
+            # nodes are trusted via the host CA rather than known_hosts
+            return
+        nodes = self._get_remaining_nodes(remove_nodes)
         for n in nodes:
-            n.remove_from_known_hosts('root', [node])
-            n.remove_from_known_hosts(self._user, [node])
+            self.pool.simple_job(self._remove_from_known_hosts_on_node,
+                                 (n, remove_nodes), jobid=n.alias,
+                                 timeout=self._setup_timeout)
+        self.pool.wait(numtasks=len(nodes))
+
+    def _overrides(self, method_name):
+        """
+        Returns True if this plugin's class overrides DefaultClusterSetup's
+        method_name
+        """
+        method = getattr(self.__class__, method_name).im_func
+        return method is not getattr(DefaultClusterSetup, method_name).im_func
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        self._remove_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_remove_nodes(self, remove_nodes, nodes, master, user, user_shell,
+                        volumes):
+        if self._overrides('on_remove_node'):
+            # subclasses that only define the per-node hook
+            return ClusterSetup.on_remove_nodes(self, remove_nodes, nodes,
+                                                master, user, user_shell,
+                                                volumes)
+        self._remove_nodes(remove_nodes, nodes, master, user, user_shell,
+                           volumes)
+
+    def _remove_nodes(self, remove_nodes, nodes, master, user, user_shell,
+                      volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Removing node %s (%s)..." % (node.alias, node.id))
-        log.info("Removing %s from known_hosts files" % node.alias)
-        self._remove_from_known_hosts(node)
-        log.info("Removing %s from /etc/hosts" % node.alias)
-        self._remove_from_etc_hosts(node)
-        log.info("Removing %s from NFS" % node.alias)
-        self._remove_nfs_exports(node)
-
-    def _create_user(self, node):
+        aliases = ', '.join([n.alias for n in remove_nodes])
+        log.info("Removing node(s): %s" % aliases)
+        log.info("Removing %s from known_hosts files" % aliases)
+        self._remove_from_known_hosts(remove_nodes)
+        log.info("Removing %s from /etc/hosts" % aliases)
+        self._remove_from_etc_hosts(remove_nodes)
+        log.info("Removing %s from NFS" % aliases)
+        self._remove_nfs_exports(remove_nodes)
+
+    def _create_users(self, nodes):
         user = self._master.getpwnam(self._user)
         uid, gid = user.pw_uid, user.pw_gid
-        self._add_user_to_nodes(uid, gid, nodes=[node])
+        self._add_user_to_nodes(uid, gid, nodes=nodes)
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self._add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
+        if self._overrides('on_add_node'):
+            # subclasses that only define the per-node hook
+            return ClusterSetup.on_add_nodes(self, new_nodes, nodes, master,
+                                             user, user_shell, volumes)
+        self._add_nodes(new_nodes, nodes, master, user, user_shell, volumes)
+
+    def _add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                   volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        self._setup_hostnames(nodes=[node])
-        self._setup_etc_hosts(nodes)
-        self._setup_nfs(nodes=[node], start_server=False)
-        self._create_user(node)
-        self._setup_scratch(nodes=[node])
-        self._setup_passwordless_ssh(nodes=[node])
+        self._setup_hostnames(nodes=new_nodes)
+        self._setup_etc_hosts(nodes, new_nodes=new_nodes)
+        self._setup_nfs(nodes=new_nodes, start_server=False)
+        self._create_users(new_nodes)
+        self._setup_scratch(nodes=new_nodes)
+        self._setup_passwordless_ssh(nodes=new_nodes)
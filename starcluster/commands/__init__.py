@@ -23,6 +23,7 @@ from terminate import CmdTerminate
 from restart import CmdRestart
 from sshmaster import CmdSshMaster
 from sshnode import CmdSshNode
+from clustercmd import CmdClusterCmd
 from sshinstance import CmdSshInstance
 from listclusters import CmdListClusters
 from s3image import CmdS3Image
@@ -62,6 +63,7 @@ all_cmds = [
     CmdListClusters(),
     CmdSshMaster(),
     CmdSshNode(),
+    CmdClusterCmd(),
     CmdPut(),
     CmdGet(),
     CmdAddNode(),
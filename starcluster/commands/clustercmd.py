@@ -0,0 +1,84 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+from completers import ClusterCompleter
+
+
+class CmdClusterCmd(ClusterCompleter):
+    """
+    cmd [options] <cluster_tag> <remote-command>
+
+    Run a command on all nodes in a cluster in parallel
+
+    Nodes that produce the same output and exit status are grouped together.
+    The exit status and run time of the command on each node are reported at
+    the end.
+
+    Examples:
+
+        $ starcluster cmd mycluster 'uptime'
+
+        # Run the command on node001 and node002 as myuser
+        $ starcluster cmd mycluster -n node001,node002 -u myuser 'ls ~'
+
+        # Connect to the master only and have the master ssh to the other
+        # nodes (faster for large clusters)
+        $ starcluster cmd mycluster --relay 'df -h /scratch'
+    """
+    names = ['cmd']
+
+    def addopts(self, parser):
+        parser.add_option("-u", "--user", dest="user", default=None,
+                          help="run the command as USER")
+        parser.add_option("-n", "--nodes", dest="nodes", default=None,
+                          help="comma-separated list of nodes to run the "
+                          "command on (defaults to all nodes)")
+        parser.add_option("-r", "--relay", dest="relay", action="store_true",
+                          default=False, help="run the command on the "
+                          "master and have the master ssh to the other nodes")
+
+    def execute(self, args):
+        if len(args) < 2:
+            self.parser.error("please specify a cluster and a command to run")
+        ctag = args[0]
+        command = ' '.join(args[1:])
+        cl = self.cm.get_cluster(ctag, load_receipt=False)
+        if self.opts.nodes:
+            nodes = cl.get_nodes(self.opts.nodes.split(','))
+        else:
+            nodes = cl.get_nodes_or_raise()
+        results = cl.execute_all(command, nodes=nodes, user=self.opts.user,
+                                 relay=self.opts.relay)
+        groups = {}
+        for node in nodes:
+            output, status, secs = results[node.alias]
+            groups.setdefault((tuple(output), status), []).append(node.alias)
+        for (output, status), aliases in sorted(groups.items(),
+                                                key=lambda g: -len(g[1])):
+            print '>>> %s (exit status %d):' % (', '.join(aliases), status)
+            for line in output:
+                print line
+            print
+        width = max(len(node.alias) for node in nodes)
+        print '%-*s  %6s  %8s' % (width, 'node', 'status', 'time')
+        for node in nodes:
+            output, status, secs = results[node.alias]
+            print '%-*s  %6d  %7.2fs' % (width, node.alias, status, secs)
+        if [r for r in results.values() if r[1] != 0]:
+            sys.exit(1)
@@ -41,6 +41,9 @@ class CmdGet(ClusterCompleter):
         # Copy a file or dir from a node (node001 in this example)
         $ starcluster get mycluster --node node001 /remote/path /local/path
 
+        # Only copy what changed since the last get
+        $ starcluster get mycluster --sync /remote/path /local/dir
+
     """
     names = ['get']
 
@@ -49,6 +52,17 @@ class CmdGet(ClusterCompleter):
                           help="Transfer files as USER ")
         parser.add_option("-n", "--node", dest="node", default="master",
                           help="Transfer files from NODE (defaults to master)")
+        parser.add_option("-s", "--sync", dest="sync", action="store_true",
+                          default=False, help="only transfer files (and "
+                          "blocks of files) that have changed")
+        parser.add_option("-c", "--checksum", dest="checksum",
+                          action="store_true", default=False,
+                          help="with --sync, also compare files whose size "
+                          "and modification time are unchanged")
+        parser.add_option("-d", "--delete", dest="delete",
+                          action="store_true", default=False,
+                          help="with --sync, delete destination files that "
+                          "do not exist in the source")
 
     def execute(self, args):
         if len(args) < 3:
@@ -65,4 +79,5 @@ class CmdGet(ClusterCompleter):
             if not glob.has_magic(rpath) and not node.ssh.path_exists(rpath):
                 raise exception.BaseException(
                     "Remote file or directory does not exist: %s" % rpath)
-        node.ssh.get(rpaths, lpath)
+        node.ssh.get(rpaths, lpath, sync=self.opts.sync,
+                     checksum=self.opts.checksum, delete=self.opts.delete)
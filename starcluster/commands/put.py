@@ -41,6 +41,10 @@ class CmdPut(ClusterCompleter):
         # Copy a file or dir to a node (node001 in this example)
         $ starcluster put mycluster --node node001 /local/path /remote/path
 
+        # Only copy what changed since the last put (and remove remote files
+        # that no longer exist locally)
+        $ starcluster put mycluster --sync --delete /local/dir /remote/path
+
 
     This will copy a file or directory to the remote server
     """
@@ -51,6 +55,17 @@ class CmdPut(ClusterCompleter):
                           help="Transfer files as USER ")
         parser.add_option("-n", "--node", dest="node", default="master",
                           help="Transfer files to NODE (defaults to master)")
+        parser.add_option("-s", "--sync", dest="sync", action="store_true",
+                          default=False, help="only transfer files (and "
+                          "blocks of files) that have changed")
+        parser.add_option("-c", "--checksum", dest="checksum",
+                          action="store_true", default=False,
+                          help="with --sync, also compare files whose size "
+                          "and modification time are unchanged")
+        parser.add_option("-d", "--delete", dest="delete",
+                          action="store_true", default=False,
+                          help="with --sync, delete destination files that "
+                          "do not exist in the source")
 
     def execute(self, args):
         if len(args) < 3:
@@ -70,4 +85,5 @@ class CmdPut(ClusterCompleter):
         if len(lpaths) > 1 and not node.ssh.isdir(rpath):
             raise exception.BaseException("Remote path does not exist: %s" %
                                           rpath)
-        node.ssh.put(lpaths, rpath)
+        node.ssh.put(lpaths, rpath, sync=self.opts.sync,
+                     checksum=self.opts.checksum, delete=self.opts.delete)
@@ -89,6 +89,24 @@ class CmdStart(ClusterCompleter):
                           help="Do not launch the master node as a spot "
                           "instance when a spot cluster is requested. "
                           "(default)")
+        parser.add_option("--stream-setup", dest="stream_setup",
+                          action="store_true", default=None,
+                          help="configure each node as soon as it comes up "
+                          "instead of waiting for all nodes. the master is "
+                          "configured first and worker nodes are added to "
+                          "the cluster as they come up")
+        parser.add_option("--cluster-dns", dest="cluster_dns",
+                          action="store_true", default=None,
+                          help="run a DNS server (dnsmasq) on the master that "
+                          "resolves the names of all cluster nodes instead "
+                          "of copying every node's name to /etc/hosts on "
+                          "every node")
+        parser.add_option("--host-key-ca", dest="host_key_ca",
+                          action="store_true", default=None,
+                          help="sign each node's ssh host keys with a "
+                          "certificate authority on the master and trust "
+                          "the CA on all nodes instead of adding every node "
+                          "to every user's known_hosts file")
         parser.add_option("--public-ips", dest="public_ips",
                           default=None, action='store_true',
                           help="Assign public IPs to all VPC nodes "
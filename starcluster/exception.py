@@ -72,6 +72,12 @@ class SSHNoCredentialsError(SSHError):
         self.msg = "No password or key specified"
 
 
+class SSHBrokerUnavailable(SSHError):
+    """Raised when the ssh broker is not running and cannot be started"""
+    def __init__(self, socket_path):
+        self.msg = "ssh broker is not available on %s" % socket_path
+
+
 class RemoteCommandFailed(SSHError):
     def __init__(self, msg, command, exit_status, output):
         self.msg = msg
@@ -532,6 +538,30 @@ class ThreadPoolException(BaseException):
         return '\n'.join(excs)
 
 
+class JobTimeout(BaseException):
+    """Raised when a ThreadPool job runs longer than its timeout"""
+    def __init__(self, jobid, timeout):
+        self.jobid = jobid
+        self.timeout = timeout
+        self.msg = "job (id=%s) timed out after %s seconds" % (jobid, timeout)
+
+
+class NodeTimeout(BaseException):
+    """Raised when a node does not come up within the allowed time"""
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+        self.msg = "node %s did not come up within %s seconds" % (
+            alias, timeout)
+
+
+class JobCancelled(BaseException):
+    """Raised when a ThreadPool job is cancelled before it runs"""
+    def __init__(self, jobid):
+        self.jobid = jobid
+        self.msg = "job (id=%s) was cancelled" % jobid
+
+
 class IncompatibleCluster(BaseException):
     default_msg = """\
 INCOMPATIBLE CLUSTER: %(tag)s
@@ -15,11 +15,16 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
 import time
 import stat
+import pipes
+import json
 import base64
 import socket
+import binascii
+import threading
 import posixpath
 import subprocess
 
@@ -30,9 +35,111 @@ from starcluster import awsutils
 from starcluster import managers
 from starcluster import userdata
 from starcluster import exception
+from starcluster.templates import broadcast
 from starcluster.logger import log
 
 
+# facts that don't change for the life of an instance. These are cached per
+# instance id and instance type in memory and in static.NODE_FACTS_DIR (see
+# Node.facts)
+STATIC_FACTS = ['num_processors', 'memory', 'os', 'os_version', 'os_family',
+                'package_provider']
+_facts_cache = {}
+_facts_lock = threading.Lock()
+
+# host certificate authority used to sign every node's ssh host keys (see
+# Node.generate_host_ca)
+HOST_CA_KEY = '/etc/ssh/starcluster_host_ca'
+SSH_KNOWN_HOSTS = '/etc/ssh/ssh_known_hosts'
+
+FACTS_MARKER = '__starcluster_fact__'
+FACTS_SCRIPT = """
+echo "%(m)s num_processors"; grep -c ^processor /proc/cpuinfo
+echo "%(m)s memory"; free -m | awk '/^Mem/ {print $2}'
+echo "%(m)s os"
+if [ -f /etc/os-release ]; then
+    (. /etc/os-release; echo "$ID"; echo "$VERSION_ID"; echo "$ID_LIKE")
+elif [ -f /etc/redhat-release ]; then
+    echo redhat; sed 's/[^0-9.]//g' /etc/redhat-release; echo rhel
+elif [ -f /etc/debian_version ]; then
+    echo debian; cat /etc/debian_version; echo debian
+fi
+echo "%(m)s package_provider"
+if [ -f /usr/bin/apt-get ]; then echo apt
+elif [ -f /usr/bin/yum ]; then echo yum; fi
+echo "%(m)s mounts"; mount
+echo "%(m)s fdisk"; fdisk -l 2>/dev/null
+echo "%(m)s partitions"; cat /proc/partitions
+""" % dict(m=FACTS_MARKER)
+
+
+def _get_cached_facts(key):
+    _facts_lock.acquire()
+    try:
+        facts = _facts_cache.get(key)
+        if facts is None:
+            path = os.path.join(static.NODE_FACTS_DIR, key)
+            try:
+                facts = json.load(open(path))
+                _facts_cache[key] = facts
+            except (IOError, ValueError):
+                pass
+        return facts
+    finally:
+        _facts_lock.release()
+
+
+def _set_cached_facts(key, facts):
+    _facts_lock.acquire()
+    try:
+        _facts_cache[key] = facts
+        path = os.path.join(static.NODE_FACTS_DIR, key)
+        try:
+            if not os.path.isdir(static.NODE_FACTS_DIR):
+                os.makedirs(static.NODE_FACTS_DIR)
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(facts, f)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            log.debug("unable to save facts for %s: %s" % (key, e))
+    finally:
+        _facts_lock.release()
+
+
+def _parse_mount_map(lines):
+    mount_map = {}
+    for line in lines:
+        dev, on_label, path, type_label, fstype, options = line.split()
+        mount_map[dev] = [path, fstype, options]
+    return mount_map
+
+
+def _parse_device_map(fdiskout, proc_parts):
+    dev_regex = '/dev/[A-Za-z0-9/]+'
+    r = re.compile('Disk (%s):' % dev_regex)
+    devmap = {}
+    for dev in r.findall(fdiskout):
+        short_name = dev.replace('/dev/', '')
+        r = re.compile("(\d+)\s+%s(?:\s+|$)" % short_name)
+        devmap[dev] = int(r.findall(proc_parts)[0])
+    return devmap
+
+
+def _parse_partition_map(fdiskout):
+    part_regex = '/dev/[A-Za-z0-9/]+'
+    r = re.compile('(%s)\s+\*?\s+'
+                   '(\d+)(?:[-+])?\s+'
+                   '(\d+)(?:[-+])?\s+'
+                   '(\d+)(?:[-+])?\s+'
+                   '([\da-fA-F][\da-fA-F]?)' % part_regex)
+    partmap = {}
+    for match in r.findall(fdiskout):
+        part, start, end, blocks, sys_id = match
+        partmap[part] = [int(start), int(end), int(blocks), sys_id]
+    return partmap
+
+
 class NodeManager(managers.Manager):
     """
     Manager class for Node objects
@@ -90,9 +197,13 @@ class Node(object):
         self._alias = alias
         self._groups = None
         self._ssh = None
-        self._num_procs = None
-        self._memory = None
         self._user_data = None
+        self._nss_cache = {}
+        self._nss_lock = threading.Lock()
+        # username -> aliases of nodes this node has copied the user's ssh
+        # keys to (i.e. that user can ssh from here to them without a
+        # password)
+        self._ssh_trusted = {}
 
     def __repr__(self):
         return '<Node: %s (%s)>' % (self.alias, self.id)
@@ -221,21 +332,72 @@ class Node(object):
         except IndexError:
             pass
 
+    @property
+    def _facts_key(self):
+        return '%s.%s' % (self.id, self.instance_type)
+
+    @property
+    def facts(self):
+        """
+        Returns a dictionary of the facts about this node's hardware and OS
+        that don't change for the life of the instance (see STATIC_FACTS).
+        The facts are gathered with a single remote command the first time
+        they're needed and cached, including on disk, so later runs don't need
+        to probe the node again. The cache is keyed on both the instance id
+        and the instance type given that a stopped EBS-backed instance can be
+        restarted as a different instance type.
+        """
+        facts = _get_cached_facts(self._facts_key)
+        if facts is None:
+            facts = self.gather_facts()
+            facts = dict((k, facts[k]) for k in STATIC_FACTS)
+        return facts
+
+    def gather_facts(self):
+        """
+        Collects facts about this node using a single remote command and
+        updates the cached facts (see facts). In addition to STATIC_FACTS the
+        result contains the node's current 'mounts', 'devices' and
+        'partitions' (see get_mount_map, get_device_map and
+        get_partition_map).
+        """
+        sections = {}
+        lines = None
+        for line in self.ssh.execute(FACTS_SCRIPT, log_output=False):
+            if line.startswith(FACTS_MARKER):
+                lines = sections[line.split()[1]] = []
+            elif lines is not None:
+                lines.append(line)
+        os_info = sections.get('os', []) + ['', '', '']
+        os_name, os_version, os_like = [i.strip() for i in os_info[:3]]
+        os_family = None
+        for family in ['debian', 'rhel', 'fedora', 'suse']:
+            if family in [os_name] + os_like.split():
+                os_family = family == 'fedora' and 'rhel' or family
+                break
+        provider = sections.get('package_provider')
+        facts = dict(
+            num_processors=int(sections['num_processors'][0]),
+            memory=float(sections['memory'][0]),
+            os=os_name or None, os_version=os_version or None,
+            os_family=os_family,
+            package_provider=provider and provider[0] or None)
+        _set_cached_facts(self._facts_key, facts)
+        fdiskout = '\n'.join(sections.get('fdisk', []))
+        facts = dict(facts)
+        facts['mounts'] = _parse_mount_map(sections.get('mounts', []))
+        facts['devices'] = _parse_device_map(
+            fdiskout, '\n'.join(sections.get('partitions', [])))
+        facts['partitions'] = _parse_partition_map(fdiskout)
+        return facts
+
     @property
     def num_processors(self):
-        if not self._num_procs:
-            self._num_procs = int(
-                self.ssh.execute(
-                    'cat /proc/cpuinfo | grep processor | wc -l')[0])
-        return self._num_procs
+        return self.facts['num_processors']
 
     @property
     def memory(self):
-        if not self._memory:
-            self._memory = float(
-                self.ssh.execute(
-                    "free -m | grep -i mem | awk '{print $2}'")[0])
-        return self._memory
+        return self.facts['memory']
 
     @property
     def ip_address(self):
@@ -376,9 +538,54 @@ class Node(object):
             raise exception.BaseException("user %s does not exist" % user)
         if group in self.get_group_map():
             self.ssh.execute('gpasswd -a %s %s' % (user, 'utmp'))
+            self.invalidate_nss_cache()
         else:
             raise exception.BaseException("group %s does not exist" % group)
 
+    def _get_nss_db(self, path, parse):
+        """
+        Returns a (by_name, by_id) tuple of dictionaries parsed from the
+        remote file path (/etc/passwd or /etc/group) using parse(). The result
+        is cached until the file's mtime or size changes or the cache is
+        invalidated (see invalidate_nss_cache) so that a batch of lookups
+        only needs to stat the file rather than download it every time.
+        """
+        sts = self.ssh.stat(path)
+        version = (sts.st_mtime, sts.st_size)
+        self._nss_lock.acquire()
+        try:
+            cached = self._nss_cache.get(path)
+            if cached and cached[0] == version:
+                return cached[1]
+        finally:
+            self._nss_lock.release()
+        rfile = self.ssh.remote_file(path, 'r')
+        lines = rfile.readlines()
+        rfile.close()
+        by_name = {}
+        by_id = {}
+        for line in lines:
+            entry = parse(line.strip().split(':'))
+            by_name[entry[0]] = entry
+            by_id[entry[2]] = entry
+        self._nss_lock.acquire()
+        try:
+            self._nss_cache[path] = (version, (by_name, by_id))
+        finally:
+            self._nss_lock.release()
+        return by_name, by_id
+
+    def invalidate_nss_cache(self):
+        """
+        Discard the cached /etc/passwd and /etc/group data (see get_user_map
+        and get_group_map)
+        """
+        self._nss_lock.acquire()
+        try:
+            self._nss_cache.clear()
+        finally:
+            self._nss_lock.release()
+
     def get_group_map(self, key_by_gid=False):
         """
         Returns dictionary where keys are remote group names and values are
@@ -387,19 +594,12 @@ class Node(object):
         key_by_gid=True will use the integer gid as the returned dictionary's
         keys instead of the group's name
         """
-        grp_file = self.ssh.remote_file('/etc/group', 'r')
-        groups = [l.strip().split(':') for l in grp_file.readlines()]
-        grp_file.close()
-        grp_map = {}
-        for group in groups:
+        def parse(group):
             name, passwd, gid, mems = group
-            gid = int(gid)
-            mems = mems.split(',')
-            key = name
-            if key_by_gid:
-                key = gid
-            grp_map[key] = utils.struct_group([name, passwd, gid, mems])
-        return grp_map
+            return utils.struct_group([name, passwd, int(gid),
+                                       mems.split(',')])
+        by_name, by_gid = self._get_nss_db('/etc/group', parse)
+        return dict(by_gid if key_by_gid else by_name)
 
     def get_user_map(self, key_by_uid=False):
         """
@@ -409,20 +609,12 @@ class Node(object):
         key_by_uid=True will use the integer uid as the returned dictionary's
         keys instead of the user's login name
         """
-        etc_passwd = self.ssh.remote_file('/etc/passwd', 'r')
-        users = [l.strip().split(':') for l in etc_passwd.readlines()]
-        etc_passwd.close()
-        user_map = {}
-        for user in users:
+        def parse(user):
             name, passwd, uid, gid, gecos, home, shell = user
-            uid = int(uid)
-            gid = int(gid)
-            key = name
-            if key_by_uid:
-                key = uid
-            user_map[key] = utils.struct_passwd([name, passwd, uid, gid, gecos,
-                                                 home, shell])
-        return user_map
+            return utils.struct_passwd([name, passwd, int(uid), int(gid),
+                                        gecos, home, shell])
+        by_name, by_uid = self._get_nss_db('/etc/passwd', parse)
+        return dict(by_uid if key_by_uid else by_name)
 
     def getgrgid(self, gid):
         """
@@ -469,8 +661,6 @@ class Node(object):
         gid - optional group id to use when creating new user
         shell - optional shell assign to new user (default: bash)
         """
-        if gid:
-            self.ssh.execute('groupadd -o -g %s %s' % (gid, name))
         user_add_cmd = 'useradd -o '
         if uid:
             user_add_cmd += '-u %s ' % uid
@@ -479,7 +669,12 @@ class Node(object):
         if shell:
             user_add_cmd += '-s `which %s` ' % shell
         user_add_cmd += "-m %s" % name
-        self.ssh.execute(user_add_cmd)
+        try:
+            if gid:
+                self.ssh.execute('groupadd -o -g %s %s' % (gid, name))
+            self.ssh.execute(user_add_cmd)
+        finally:
+            self.invalidate_nss_cache()
 
     def generate_key_for_user(self, username, ignore_existing=False,
                               auth_new_key=False, auth_conn_key=False):
@@ -595,62 +790,255 @@ class Node(object):
             regex = '|'.join(hostnames)
             self.ssh.remove_lines_from_file(known_hosts_file, regex)
 
+    def has_host_ca(self):
+        """
+        Returns True if this node holds a host certificate authority (see
+        generate_host_ca)
+        """
+        return self.ssh.isfile(HOST_CA_KEY)
+
+    def generate_host_ca(self):
+        """
+        Create a certificate authority for signing ssh host keys on this node
+        (unless it already exists) and return the CA's public key
+        """
+        results = self.ssh.execute_many([
+            '[ -f %s ] || ssh-keygen -q -t rsa -b 2048 -N "" '
+            '-C starcluster-host-ca -f %s' % (HOST_CA_KEY, HOST_CA_KEY),
+            'cat %s.pub' % HOST_CA_KEY])
+        return results[-1][0][-1].strip()
+
+    def get_host_keys(self):
+        """
+        Returns a dictionary mapping the path of each of this node's public ssh
+        host keys to the key
+        """
+        host_keys = {}
+        output = self.ssh.execute(
+            'for f in /etc/ssh/ssh_host_*_key.pub; do '
+            '[ -f $f ] && echo "$f $(cat $f)"; done', ignore_exit_status=True)
+        for line in output:
+            path, key = line.split(' ', 1)
+            host_keys[path] = key
+        return host_keys
+
+    def sign_host_keys(self, node, host_keys):
+        """
+        Sign node's host keys with this node's host certificate authority (see
+        generate_host_ca). The certificates are valid for all of node's
+        network names and addresses.
+
+        node - the node the host keys belong to
+        host_keys - dictionary mapping the path of each of node's public host
+                    keys to the key (see get_host_keys)
+
+        Returns a dictionary mapping the path each certificate should be
+        installed to on node to the certificate
+        """
+        names = [node.alias, node.private_dns_name,
+                 node.private_dns_name_short, node.private_ip_address,
+                 node.public_dns_name, node.ip_address]
+        principals = []
+        for name in names:
+            if name and name not in principals:
+                principals.append(name)
+        principals = pipes.quote(','.join(principals))
+        paths = sorted(host_keys)
+        cmds = []
+        for path in paths:
+            cmds.append(
+                'd=$(mktemp -d) && '
+                "printf '%%s\\n' %(key)s > $d/key.pub && "
+                'ssh-keygen -q -s %(ca)s -I %(id)s -h -n %(names)s '
+                '$d/key.pub > /dev/null && cat $d/key-cert.pub; '
+                's=$?; rm -rf $d; exit $s' %
+                dict(key=pipes.quote(host_keys[path]), ca=HOST_CA_KEY,
+                     id=pipes.quote(node.alias), names=principals))
+        certs = {}
+        for path, (output, status) in zip(paths, self.ssh.execute_many(cmds)):
+            cert_path = path[:-len('.pub')] + '-cert.pub'
+            certs[cert_path] = output[-1].strip()
+        return certs
+
+    def install_host_certificates(self, certs, ca_pubkey):
+        """
+        Install host certificates (see sign_host_keys) for this node's ssh
+        server and trust all host certificates signed by ca_pubkey for all
+        users on this node. This replaces per-host known_hosts entries.
+
+        certs - dictionary mapping the path of each certificate to install to
+                the certificate
+        ca_pubkey - public key of the certificate authority (see
+                    generate_host_ca)
+        """
+        cmds = []
+        # edit and validate a copy of sshd_config so that a config sshd
+        # rejects (e.g. no certificate support) never replaces the original
+        update_config = ['f=/etc/ssh/sshd_config',
+                         't=$(mktemp $f.XXXXXX) || exit 1',
+                         'cat $f > $t']
+        for path in sorted(certs):
+            opt = 'HostCertificate %s' % path
+            cmds.append("printf '%%s\\n' %s > %s" %
+                        (pipes.quote(certs[path]), path))
+            # global options must come before any Match blocks
+            update_config.append("grep -qxF '%s' $t || sed -i '1i %s' $t" %
+                                 (opt, opt))
+        update_config += ['if ! sshd -t -f $t; then rm -f $t; exit 1; fi',
+                          'chmod --reference=$f $t',
+                          'chown --reference=$f $t',
+                          'mv -f $t $f']
+        cmds.append('\n'.join(update_config))
+        cmds.append('service ssh reload || service sshd reload || '
+                    '/etc/init.d/ssh reload || /etc/init.d/sshd reload')
+        self.ssh.execute_many(cmds)
+        self.ssh.update_file_entries(
+            SSH_KNOWN_HOSTS, entries=['@cert-authority * %s' % ca_pubkey],
+            key_fields=(1, 2))
+
     def enable_passwordless_ssh(self, username, nodes):
         """
         Configure passwordless ssh for user between this Node and nodes
         """
+        self.add_to_known_hosts(username, nodes)
+        # exclude this node from copying
+        nodes = filter(lambda n: n.id != self.id, nodes)
+        self.copy_ssh_files_to_nodes(username, nodes)
+
+    def copy_ssh_files_to_nodes(self, username, nodes, known_hosts=True):
+        """
+        Copy user's private/public keys, authorized_keys, and known_hosts
+        files from this Node to each node in nodes
+
+        known_hosts - if False, don't copy the known_hosts file (e.g. when the
+                      nodes trust a host certificate authority instead)
+        """
         user = self.getpwnam(username)
         ssh_folder = posixpath.join(user.pw_dir, '.ssh')
         priv_key_file = posixpath.join(ssh_folder, 'id_rsa')
         pub_key_file = priv_key_file + '.pub'
         known_hosts_file = posixpath.join(ssh_folder, 'known_hosts')
         auth_key_file = posixpath.join(ssh_folder, 'authorized_keys')
-        self.add_to_known_hosts(username, nodes)
-        # exclude this node from copying
-        nodes = filter(lambda n: n.id != self.id, nodes)
         # copy private key and public key to node
         self.copy_remote_file_to_nodes(priv_key_file, nodes)
         self.copy_remote_file_to_nodes(pub_key_file, nodes)
         # copy authorized_keys and known_hosts to node
         self.copy_remote_file_to_nodes(auth_key_file, nodes)
-        self.copy_remote_file_to_nodes(known_hosts_file, nodes)
+        if known_hosts:
+            self.copy_remote_file_to_nodes(known_hosts_file, nodes)
+        trusted = self._ssh_trusted.setdefault(username, set())
+        trusted.update([node.alias for node in nodes])
+
+    def _can_broadcast_to(self, nodes):
+        """
+        Returns True if the current ssh user is known to be able to ssh from
+        this node to each node in nodes (and between them) without a password
+        """
+        user = self.ssh.get_current_user() or self.user
+        trusted = self._ssh_trusted.get(user, set())
+        return all(n.id == self.id or n.alias in trusted for n in nodes)
 
     def copy_remote_file_to_node(self, remote_file, node, dest=None):
         return self.copy_remote_file_to_nodes(remote_file, [node], dest=dest)
 
-    def copy_remote_file_to_nodes(self, remote_file, nodes, dest=None):
+    def copy_remote_file_to_nodes(self, remote_file, nodes, dest=None,
+                                  fanout=2, broadcast=None):
         """
-        Copies a remote file from this Node instance to another Node instance
-        without passwordless ssh between the two.
+        Copies a remote file from this Node instance to each node in nodes
+        keeping the file's mode and owner.
+
+        When broadcasting, the file is streamed from this node over the
+        cluster's internal network with each node forwarding it to at most
+        fanout other nodes while it is still arriving. Nodes that can't be
+        reached that way are copied to through this machine instead.
 
         dest - path to store the data in on the node (defaults to remote_file)
+        fanout - max number of nodes each node forwards the file to
+        broadcast - whether to stream the file between the nodes. By default
+                    only done for more than fanout nodes once passwordless
+                    ssh to them is known to work.
         """
         if not dest:
             dest = remote_file
-        rf = self.ssh.remote_file(remote_file, 'r')
-        contents = rf.read()
-        sts = rf.stat()
-        mode = stat.S_IMODE(sts.st_mode)
-        uid = sts.st_uid
-        gid = sts.st_gid
-        rf.close()
+        targets = []
         for node in nodes:
             if self.id == node.id and remote_file == dest:
                 log.warn("src and destination are the same: %s, skipping" %
                          remote_file)
                 continue
+            targets.append(node)
+        if not targets:
+            return
+        sts = self.ssh.stat(remote_file)
+        mode = stat.S_IMODE(sts.st_mode)
+        uid = sts.st_uid
+        gid = sts.st_gid
+        if broadcast is None:
+            broadcast = (len(targets) > max(fanout, 1) and
+                         self._can_broadcast_to(targets))
+        if broadcast:
+            done = self._broadcast_file(remote_file, dest, targets, mode, uid,
+                                        gid, fanout=fanout)
+            targets = [node for node in targets if node.alias not in done]
+            if not targets:
+                return
+        log.debug("copying %s to %s through this host" %
+                  (remote_file, ', '.join(n.alias for n in targets)))
+        rf = self.ssh.remote_file(remote_file, 'r')
+        contents = rf.read()
+        rf.close()
+        for node in targets:
             nrf = node.ssh.remote_file(dest, 'w')
             nrf.write(contents)
             nrf.chown(uid, gid)
             nrf.chmod(mode)
             nrf.close()
 
+    def _broadcast_file(self, remote_file, dest, nodes, mode, uid, gid,
+                        fanout=2):
+        """
+        Streams remote_file from this node to dest on each node in nodes over
+        ssh connections between the nodes. Returns the set of aliases of the
+        nodes that successfully stored the file.
+        """
+        marker = '__starcluster_copy_%s__' % binascii.hexlify(os.urandom(8))
+        script = base64.b64encode(broadcast.broadcast_template)
+        this = '-'
+        aliases = []
+        for node in nodes:
+            if node.id == self.id:
+                this = self.alias
+            else:
+                aliases.append(node.alias)
+        args = [script, remote_file, dest, '%o' % mode, '%d:%d' % (uid, gid),
+                str(max(fanout, 1)), this, marker] + aliases
+        cmd = 'bash -c "$(echo %s | base64 -d)" _ %s' % (
+            script, ' '.join(map(pipes.quote, args)))
+        log.debug("streaming %s to %s from %s" %
+                  (remote_file, ', '.join(n.alias for n in nodes), self.alias))
+        try:
+            lines = self.ssh.execute(cmd, source_profile=False,
+                                     ignore_exit_status=True,
+                                     log_output=False)
+        except exception.SSHError, e:
+            log.debug("failed to stream %s: %s" % (remote_file, e))
+            return set()
+        done = set()
+        for line in lines:
+            index = line.find(marker)
+            if index >= 0:
+                done.add(line[index:].split()[1])
+        return done
+
     def remove_user(self, name):
         """
         Remove a user from the remote system
         """
-        self.ssh.execute('userdel %s' % name)
-        self.ssh.execute('groupdel %s' % name)
+        try:
+            self.ssh.execute_many(['userdel %s' % name,
+                                   'groupdel %s' % name])
+        finally:
+            self.invalidate_nss_cache()
 
     def export_fs_to_nodes(self, nodes, export_paths):
         """
@@ -665,22 +1053,14 @@ class Node(object):
         $ node.export_fs_to_nodes(nodes=[node1,node2],
                                   export_paths=['/home', '/opt/sge6'])
         """
-        log.debug("Cleaning up potentially stale NFS entries")
-        self.stop_exporting_fs_to_nodes(nodes, paths=export_paths)
         log.info("Configuring NFS exports path(s):\n%s" %
                  ' '.join(export_paths))
         nfs_export_settings = "(async,no_root_squash,no_subtree_check,rw)"
-        etc_exports = self.ssh.remote_file('/etc/exports', 'r')
-        contents = etc_exports.read()
-        etc_exports.close()
-        etc_exports = self.ssh.remote_file('/etc/exports', 'a')
-        for node in nodes:
-            for path in export_paths:
-                export_line = ' '.join(
-                    [path, node.alias + nfs_export_settings + '\n'])
-                if export_line not in contents:
-                    etc_exports.write(export_line)
-        etc_exports.close()
+        export_lines = [' '.join([path, node.alias + nfs_export_settings])
+                        for node in nodes for path in export_paths]
+        # replaces any stale entries for the same path and node
+        self.ssh.update_file_entries('/etc/exports', entries=export_lines,
+                                     key_fields=(1, 2))
         self.ssh.execute('exportfs -fra')
 
     def stop_exporting_fs_to_nodes(self, nodes, paths=None):
@@ -693,33 +1073,35 @@ class Node(object):
         $ node.remove_export_fs_to_nodes(nodes=[node1,node2])
         """
         if paths:
-            regex = '|'.join([' '.join([path, node.alias]) for path in paths
-                              for node in nodes])
+            self.ssh.update_file_entries(
+                '/etc/exports', remove=[(path, node.alias) for path in paths
+                                        for node in nodes],
+                key_fields=(1, 2))
         else:
-            regex = '|'.join([n.alias for n in nodes])
-        self.ssh.remove_lines_from_file('/etc/exports', regex)
+            self.ssh.update_file_entries(
+                '/etc/exports', remove=[(node.alias,) for node in nodes],
+                key_fields=(2,))
         self.ssh.execute('exportfs -fra')
 
     def start_nfs_server(self):
         log.info("Starting NFS server on %s" % self.alias)
-        self.ssh.execute('/etc/init.d/portmap start', ignore_exit_status=True)
-        self.ssh.execute('mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/',
-                         ignore_exit_status=True)
         EXPORTSD = '/etc/exports.d'
         DUMMY_EXPORT_DIR = '/dummy_export_for_broken_init_script'
         DUMMY_EXPORT_LINE = ' '.join([DUMMY_EXPORT_DIR,
                                       '127.0.0.1(ro,no_subtree_check)'])
         DUMMY_EXPORT_FILE = posixpath.join(EXPORTSD, 'dummy.exports')
-        # Hack to get around broken debian nfs-kernel-server script
-        # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
-        self.ssh.execute("mkdir -p %s" % EXPORTSD)
-        self.ssh.execute("mkdir -p %s" % DUMMY_EXPORT_DIR)
-        with self.ssh.remote_file(DUMMY_EXPORT_FILE, 'w') as dummyf:
-            dummyf.write(DUMMY_EXPORT_LINE)
-        self.ssh.execute('/etc/init.d/nfs start')
-        self.ssh.execute('rm -f %s' % DUMMY_EXPORT_FILE)
-        self.ssh.execute('rm -rf %s' % DUMMY_EXPORT_DIR)
-        self.ssh.execute('exportfs -fra')
+        self.ssh.execute_many([
+            '/etc/init.d/portmap start || true',
+            'mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/ || true',
+            # Hack to get around broken debian nfs-kernel-server script
+            # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
+            'mkdir -p %s' % EXPORTSD,
+            'mkdir -p %s' % DUMMY_EXPORT_DIR,
+            "printf '%%s' '%s' > %s" % (DUMMY_EXPORT_LINE, DUMMY_EXPORT_FILE),
+            '/etc/init.d/nfs start',
+            'rm -f %s' % DUMMY_EXPORT_FILE,
+            'rm -rf %s' % DUMMY_EXPORT_DIR,
+            'exportfs -fra'])
 
     def mount_nfs_shares(self, server_node, remote_paths):
         """
@@ -744,43 +1126,32 @@ class Node(object):
             else:
                 mount_paths.append(path)
         remote_paths = mount_paths
-        remote_paths_regex = '|'.join(map(lambda x: x.center(len(x) + 2),
-                                          remote_paths))
-        self.ssh.remove_lines_from_file('/etc/fstab', remote_paths_regex)
-        fstab = self.ssh.remote_file('/etc/fstab', 'a')
         mount_opts = 'rw,exec,noauto'
+        if remote_paths:
+            self.ssh.update_file_entries(
+                '/etc/fstab', entries=['%s:%s %s nfs %s 0 0' %
+                                       (server_node.alias, path, path,
+                                        mount_opts)
+                                       for path in remote_paths],
+                key_fields=(2,))
+        cmds = []
         for path in remote_paths:
-            fstab.write('%s:%s %s nfs %s 0 0\n' %
-                        (server_node.alias, path, path, mount_opts))
-        fstab.close()
-        for path in remote_paths:
-            if not self.ssh.path_exists(path):
-                self.ssh.makedirs(path)
-            self.ssh.execute('mount %s' % path)
+            cmds.extend(['mkdir -p %s' % path, 'mount %s' % path])
+        if cmds:
+            self.ssh.execute_many(cmds)
 
     def get_mount_map(self):
-        mount_map = {}
-        mount_lines = self.ssh.execute('mount')
-        for line in mount_lines:
-            dev, on_label, path, type_label, fstype, options = line.split()
-            mount_map[dev] = [path, fstype, options]
-        return mount_map
+        return _parse_mount_map(self.ssh.execute('mount'))
 
     def get_device_map(self):
         """
         Returns a dictionary mapping devices->(# of blocks) based on
         'fdisk -l' and /proc/partitions
         """
-        dev_regex = '/dev/[A-Za-z0-9/]+'
-        r = re.compile('Disk (%s):' % dev_regex)
-        fdiskout = '\n'.join(self.ssh.execute("fdisk -l 2>/dev/null"))
-        proc_parts = '\n'.join(self.ssh.execute("cat /proc/partitions"))
-        devmap = {}
-        for dev in r.findall(fdiskout):
-            short_name = dev.replace('/dev/', '')
-            r = re.compile("(\d+)\s+%s(?:\s+|$)" % short_name)
-            devmap[dev] = int(r.findall(proc_parts)[0])
-        return devmap
+        fdiskout, proc_parts = self.ssh.execute_many(
+            ["fdisk -l 2>/dev/null", "cat /proc/partitions"])
+        return _parse_device_map('\n'.join(fdiskout[0]),
+                                 '\n'.join(proc_parts[0]))
 
     def get_partition_map(self, device=None):
         """
@@ -789,28 +1160,15 @@ class Node(object):
         """
         fdiskout = '\n'.join(self.ssh.execute("fdisk -l %s 2>/dev/null" %
                                               (device or '')))
-        part_regex = '/dev/[A-Za-z0-9/]+'
-        r = re.compile('(%s)\s+\*?\s+'
-                       '(\d+)(?:[-+])?\s+'
-                       '(\d+)(?:[-+])?\s+'
-                       '(\d+)(?:[-+])?\s+'
-                       '([\da-fA-F][\da-fA-F]?)' % part_regex)
-        partmap = {}
-        for match in r.findall(fdiskout):
-            part, start, end, blocks, sys_id = match
-            partmap[part] = [int(start), int(end), int(blocks), sys_id]
-        return partmap
+        return _parse_partition_map(fdiskout)
 
     def mount_device(self, device, path):
         """
         Mount device to path
         """
-        self.ssh.remove_lines_from_file('/etc/fstab',
-                                        path.center(len(path) + 2))
-        master_fstab = self.ssh.remote_file('/etc/fstab', mode='a')
-        master_fstab.write("%s %s auto noauto,defaults 0 0\n" %
-                           (device, path))
-        master_fstab.close()
+        self.ssh.update_file_entries(
+            '/etc/fstab', entries=["%s %s auto noauto,defaults 0 0" %
+                                   (device, path)], key_fields=(2,))
         if not self.ssh.path_exists(path):
             self.ssh.makedirs(path)
         self.ssh.execute('mount %s' % path)
@@ -819,19 +1177,65 @@ class Node(object):
         """
         Adds all names for node in nodes arg to this node's /etc/hosts file
         """
-        self.remove_from_etc_hosts(nodes)
-        host_file = self.ssh.remote_file('/etc/hosts', 'a')
-        for node in nodes:
-            print >> host_file, node.get_hosts_entry()
-        host_file.close()
+        self.ssh.update_file_entries(
+            '/etc/hosts', entries=[node.get_hosts_entry() for node in nodes],
+            key_fields=(2,))
 
     def remove_from_etc_hosts(self, nodes):
         """
         Remove all network names for node in nodes arg from this node's
         /etc/hosts file
         """
-        aliases = map(lambda x: x.alias, nodes)
-        self.ssh.remove_lines_from_file('/etc/hosts', '|'.join(aliases))
+        self.ssh.update_file_entries(
+            '/etc/hosts', remove=[(node.alias,) for node in nodes],
+            key_fields=(2,))
+
+    def start_dns_server(self):
+        """
+        Install (if needed) and start dnsmasq on this node so that nodes using
+        it as their resolver (see use_dns_server) can look up every name in
+        this node's /etc/hosts file. Other queries are forwarded to this
+        node's own upstream nameservers.
+        """
+        log.info("Starting DNS server on %s" % self.alias)
+        if not self.ssh.path_exists('/usr/sbin/dnsmasq'):
+            self.package_install('dnsmasq')
+        DNSMASQD = '/etc/dnsmasq.d'
+        DNSMASQ_CONF = posixpath.join(DNSMASQD, 'starcluster.conf')
+        # never forward bare cluster aliases upstream
+        self.ssh.execute_many([
+            'mkdir -p %s' % DNSMASQD,
+            "printf '%%s\\n' 'domain-needed' > %s" % DNSMASQ_CONF,
+            '(update-rc.d dnsmasq enable || chkconfig dnsmasq on) '
+            '> /dev/null 2>&1 || true',
+            'service dnsmasq restart || /etc/init.d/dnsmasq restart'])
+
+    def reload_dns_server(self):
+        """
+        Make this node's DNS server re-read /etc/hosts after it has changed
+        """
+        self.ssh.execute('pkill -HUP -x dnsmasq', ignore_exit_status=True)
+
+    def use_dns_server(self, server_node):
+        """
+        Make server_node (see start_dns_server) this node's first nameserver.
+        The nameserver is also registered with dhclient and resolvconf, if
+        present, so that it survives DHCP lease renewals and reboots.
+        """
+        ip = server_node.private_ip_address
+        ns = 'nameserver %s' % ip
+        dhcp = 'prepend domain-name-servers %s;' % ip
+        cmds = []
+        for conf, line in [('/etc/dhcp/dhclient.conf', dhcp),
+                           ('/etc/dhcp3/dhclient.conf', dhcp),
+                           ('/etc/resolvconf/resolv.conf.d/head', ns)]:
+            cmds.append("if [ -f %(f)s ] && ! grep -qxF '%(l)s' %(f)s; then "
+                        "echo '%(l)s' >> %(f)s; fi" % dict(f=conf, l=line))
+        # write through the file (not mv) in case resolv.conf is a symlink
+        cmds.append("(echo '%s'; grep -vxF '%s' /etc/resolv.conf || true) > "
+                    "/tmp/resolv.conf.sc && cat /tmp/resolv.conf.sc > "
+                    "/etc/resolv.conf && rm -f /tmp/resolv.conf.sc" % (ns, ns))
+        self.ssh.execute_many(cmds)
 
     def set_hostname(self, hostname=None):
         """
@@ -1019,8 +1423,14 @@ class Node(object):
         while not self.is_up():
             time.sleep(interval)
 
-    def is_up(self):
-        if self.update() != 'running':
+    def is_up(self, update=True):
+        """
+        Returns True if this instance is running and SSH is up
+
+        update - update the instance's state from EC2 first
+        """
+        state = self.update() if update else self.state
+        if state != 'running':
             return False
         if not self.is_ssh_up():
             return False
@@ -1177,10 +1587,7 @@ class Node(object):
         /usr/bin/apt exists on the node, and use apt if it exists. Otherwise
         test to see if /usr/bin/yum exists and use that.
         """
-        if self.ssh.isfile('/usr/bin/apt-get'):
-            return "apt"
-        elif self.ssh.isfile('/usr/bin/yum'):
-            return "yum"
+        return self.facts['package_provider']
 
     def package_install(self, pkgs):
         """
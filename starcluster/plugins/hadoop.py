@@ -118,12 +118,14 @@ class Hadoop(clustersetup.ClusterSetup):
         self.ubuntu_alt_cmd = 'update-alternatives'
         self.map_to_proc_ratio = float(map_to_proc_ratio)
         self.reduce_to_proc_ratio = float(reduce_to_proc_ratio)
+        self._num_nodes = None
         self._pool = None
 
     @property
     def pool(self):
         if self._pool is None:
-            self._pool = threadpool.get_thread_pool(20, disable_threads=False)
+            self._pool = threadpool.get_cluster_thread_pool(
+                num_nodes=self._num_nodes)
         return self._pool
 
     def _get_java_home(self, node):
@@ -317,6 +319,7 @@ class Hadoop(clustersetup.ClusterSetup):
                                                       cidr_ip='0.0.0.0/0')
 
     def run(self, nodes, master, user, user_shell, volumes):
+        self._num_nodes = len(nodes)
         self._configure_hadoop(master, nodes, user)
         self._start_hadoop(master, nodes)
         self._open_ports(master)
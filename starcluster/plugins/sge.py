@@ -36,13 +36,13 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
             self.slots_per_host = int(slots_per_host)
         super(SGEPlugin, self).__init__(**kwargs)
 
-    def _add_sge_submit_host(self, node):
+    def _add_sge_submit_hosts(self, nodes):
         mssh = self._master.ssh
-        mssh.execute('qconf -as %s' % node.alias)
+        mssh.execute('qconf -as %s' % ','.join([n.alias for n in nodes]))
 
-    def _add_sge_admin_host(self, node):
+    def _add_sge_admin_hosts(self, nodes):
         mssh = self._master.ssh
-        mssh.execute('qconf -ah %s' % node.alias)
+        mssh.execute('qconf -ah %s' % ','.join([n.alias for n in nodes]))
 
     def _setup_sge_profile(self, node):
         sge_profile = node.ssh.remote_file(self.SGE_PROFILE, "w")
@@ -165,8 +165,6 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         master.ssh.execute('qconf -dconf %s' % node.alias)
         master.ssh.execute('qconf -de %s' % node.alias)
         node.ssh.execute('pkill -9 sge_execd')
-        nodes = filter(lambda n: n.alias != node.alias, self._nodes)
-        self._create_sge_pe(nodes=nodes)
 
     def run(self, nodes, master, user, user_shell, volumes):
         if not master.ssh.isdir(self.SGE_FRESH):
@@ -181,25 +179,39 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._setup_sge()
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Adding %s to SGE" % node.alias)
-        self._setup_nfs(nodes=[node], export_paths=[self.SGE_ROOT],
+        log.info("Adding %s to SGE" % ', '.join([n.alias for n in new_nodes]))
+        self._setup_nfs(nodes=new_nodes, export_paths=[self.SGE_ROOT],
                         start_server=False)
-        self._add_sge_admin_host(node)
-        self._add_sge_submit_host(node)
-        self._add_to_sge(node)
+        self._add_sge_admin_hosts(new_nodes)
+        self._add_sge_submit_hosts(new_nodes)
+        for node in new_nodes:
+            self.pool.simple_job(self._add_to_sge, (node,), jobid=node.alias)
+        self.pool.wait(numtasks=len(new_nodes))
         self._create_sge_pe()
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_remove_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_remove_nodes(self, remove_nodes, nodes, master, user, user_shell,
+                        volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Removing %s from SGE" % node.alias)
-        self._remove_from_sge(node)
-        self._remove_nfs_exports(node)
+        log.info("Removing %s from SGE" %
+                 ', '.join([n.alias for n in remove_nodes]))
+        for node in remove_nodes:
+            self._remove_from_sge(node)
+        ids = [n.id for n in remove_nodes]
+        self._create_sge_pe(nodes=filter(lambda n: n.id not in ids, nodes))
+        self._remove_nfs_exports(remove_nodes)
@@ -75,12 +75,15 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         self.pool.wait(numtasks=len(nodes))
         log.info("Configuring passwordless ssh for %d cluster users" %
                  self._num_users)
+        # nodes signed by the host CA don't need known_hosts entries
+        host_ca = master.has_host_ca()
         pbar = self.pool.progress_bar.reset()
         pbar.maxval = self._num_users
         for i, user in enumerate(self._usernames):
             master.generate_key_for_user(user, auth_new_key=True,
                                          auth_conn_key=True)
-            master.add_to_known_hosts(user, nodes)
+            if not host_ca:
+                master.add_to_known_hosts(user, nodes)
             pbar.update(i + 1)
         pbar.finish()
         self._setup_scratch(nodes, self._usernames)
@@ -156,14 +159,15 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         newusers = self._get_newusers_batch_file(master, self._usernames,
                                                  user_shell)
         node.ssh.execute("echo -n '%s' | newusers" % newusers)
-        log.info("Adding %s to known_hosts for %d users" %
-                 (node.alias, self._num_users))
-        pbar = self.pool.progress_bar.reset()
-        pbar.maxval = self._num_users
-        for i, user in enumerate(self._usernames):
-            master.add_to_known_hosts(user, [node])
-            pbar.update(i + 1)
-        pbar.finish()
+        if not master.has_host_ca():
+            log.info("Adding %s to known_hosts for %d users" %
+                     (node.alias, self._num_users))
+            pbar = self.pool.progress_bar.reset()
+            pbar.maxval = self._num_users
+            for i, user in enumerate(self._usernames):
+                master.add_to_known_hosts(user, [node])
+                pbar.update(i + 1)
+            pbar.finish()
         self._setup_scratch(nodes=[node], users=self._usernames)
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
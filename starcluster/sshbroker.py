@@ -0,0 +1,677 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent SSH connection broker
+
+The broker is a local process that keeps authenticated paramiko transports to
+cluster nodes alive between StarCluster invocations. Clients talk to it over
+a Unix socket: each socket connection asks the broker to open a single
+channel (exec, subsystem or shell) on its cached transport for the given
+host/user/key and the broker then relays the channel's data over the socket.
+Repeated commands against a running cluster therefore skip the TCP connect,
+key exchange and authentication entirely.
+
+The broker is disabled by default. Set STARCLUSTER_SSH_BROKER=1 to have
+SSHClient open its channels through the broker (the broker is started
+automatically if it is not already running). Transports that have been idle
+for TRANSPORT_IDLE_TIMEOUT seconds are closed and the broker exits once it
+has had no transports for BROKER_IDLE_TIMEOUT seconds.
+"""
+import os
+import sys
+import time
+import json
+import errno
+import base64
+import select
+import socket
+import struct
+import threading
+import subprocess
+import SocketServer
+
+import paramiko
+from paramiko.channel import ChannelFile, ChannelStderrFile
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+
+from starcluster import static
+from starcluster import exception
+from starcluster.logger import log
+
+# seconds a transport may sit unused before the broker closes it
+TRANSPORT_IDLE_TIMEOUT = 600
+# seconds the broker waits without any transports before exiting
+BROKER_IDLE_TIMEOUT = 1800
+# seconds to wait for a newly spawned broker to accept connections
+BROKER_START_TIMEOUT = 10
+
+# frame types used to multiplex exec channels over the broker socket
+FRAME_STDOUT = 'o'
+FRAME_STDERR = 'e'
+FRAME_STDIN = 'i'
+FRAME_STDIN_EOF = 'c'
+FRAME_EXIT_STATUS = 'x'
+FRAME_HEADER = struct.Struct('!cI')
+
+_KEY_TYPES = {
+    'ssh-rsa': paramiko.RSAKey,
+    'ssh-dss': paramiko.DSSKey,
+}
+
+
+def is_enabled():
+    """
+    Returns True if SSH connections should go through the broker
+    """
+    enabled = os.environ.get('STARCLUSTER_SSH_BROKER', '')
+    return enabled.lower() not in ('', '0', 'false', 'no')
+
+
+def _recv_exactly(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+def _send_frame(sock, ftype, data=''):
+    sock.sendall(FRAME_HEADER.pack(ftype, len(data)) + data)
+
+
+def _recv_frame(sock):
+    ftype, size = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+    return ftype, _recv_exactly(sock, size)
+
+
+def _send_message(sock, msg):
+    sock.sendall(json.dumps(msg) + '\n')
+
+
+def _recv_message(sock):
+    data = []
+    while True:
+        char = sock.recv(1)
+        if not char:
+            raise EOFError()
+        if char == '\n':
+            return json.loads(''.join(data))
+        data.append(char)
+
+
+def _raise_error(reply):
+    """
+    Re-raise an exception that occurred inside the broker
+    """
+    cls = getattr(exception, reply.get('class') or '', None)
+    if not isinstance(cls, type) or \
+       not issubclass(cls, exception.BaseException):
+        cls = exception.SSHError
+    # StarCluster exceptions build their msg in __init__ from arbitrary
+    # arguments so bypass it and set the broker's message directly
+    err = cls.__new__(cls)
+    exception.BaseException.__init__(err, reply['error'])
+    raise err
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        raise exception.SSHBrokerUnavailable(socket_path)
+    return sock
+
+
+def start_broker(socket_path=None, timeout=BROKER_START_TIMEOUT):
+    """
+    Start the broker in a detached process if it is not already running and
+    wait for it to accept connections
+    """
+    socket_path = socket_path or static.SSH_BROKER_SOCKET
+    try:
+        _connect(socket_path).close()
+        return
+    except exception.SSHBrokerUnavailable:
+        pass
+    log.debug("starting ssh broker on %s" % socket_path)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, '-m', 'starcluster.sshbroker',
+                      socket_path], stdin=devnull, stdout=devnull,
+                     stderr=devnull, close_fds=True, preexec_fn=os.setsid,
+                     env=env)
+    devnull.close()
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            _connect(socket_path).close()
+            return
+        except exception.SSHBrokerUnavailable:
+            time.sleep(0.1)
+    raise exception.SSHBrokerUnavailable(socket_path)
+
+
+def stop_broker(socket_path=None):
+    """
+    Ask a running broker to close all of its transports and exit
+    """
+    socket_path = socket_path or static.SSH_BROKER_SOCKET
+    sock = _connect(socket_path)
+    try:
+        _send_message(sock, dict(op='stop'))
+        _recv_message(sock)
+    finally:
+        sock.close()
+
+
+class BrokerChannel(object):
+    """
+    Client side of a channel opened through the broker. Implements the
+    subset of paramiko.Channel used by SSHClient, scp and paramiko's
+    SFTPClient.
+
+    Shells and subsystems are relayed as a raw byte stream. Exec channels
+    are multiplexed (see FRAME_*) so that stdout, stderr and the exit status
+    can be told apart.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.closed = False
+        self._sock = None
+        self._sock_closed = False
+        self._pty = None
+        self._framed = False
+        self._timeout = None
+        self._exit_status = -1
+        self._status_event = threading.Event()
+        self._stdout = BufferedPipe()
+        self._stderr = BufferedPipe()
+        self._send_lock = threading.Lock()
+
+    def _open(self, **request):
+        request.update(self.transport.get_request())
+        try:
+            sock = _connect(self.transport.socket_path)
+        except exception.SSHBrokerUnavailable:
+            # force SSHClient to reconnect (and restart the broker)
+            self.transport.active = False
+            raise
+        try:
+            _send_message(sock, request)
+            reply = _recv_message(sock)
+        except (socket.error, EOFError):
+            sock.close()
+            self.transport.active = False
+            raise exception.SSHBrokerUnavailable(self.transport.socket_path)
+        if 'error' in reply:
+            sock.close()
+            _raise_error(reply)
+        self._sock = sock
+
+    def get_transport(self):
+        return self.transport
+
+    def get_name(self):
+        return 'broker:%s@%s' % (self.transport.username, self.transport.host)
+
+    def get_pty(self, term='vt100', width=80, height=24):
+        self._pty = (term, width, height)
+
+    def invoke_shell(self):
+        self._open(op='shell', pty=self._pty)
+        self._sock.settimeout(self._timeout)
+
+    def invoke_subsystem(self, name):
+        self._open(op='subsystem', name=name)
+        self._sock.settimeout(self._timeout)
+
+    def exec_command(self, command):
+        self._open(op='exec', command=command, pty=self._pty)
+        self._framed = True
+        reader = threading.Thread(target=self._read_frames)
+        reader.daemon = True
+        reader.start()
+
+    def _read_frames(self):
+        try:
+            while True:
+                ftype, data = _recv_frame(self._sock)
+                if ftype == FRAME_STDOUT:
+                    self._stdout.feed(data)
+                elif ftype == FRAME_STDERR:
+                    self._stderr.feed(data)
+                elif ftype == FRAME_EXIT_STATUS:
+                    self._exit_status = struct.unpack('!i', data)[0]
+                    break
+        except (socket.error, EOFError):
+            pass
+        self._stdout.close()
+        self._stderr.close()
+        self._status_event.set()
+        # the remote end has closed the channel
+        self.closed = True
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+        if not self._framed and self._sock:
+            self._sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self._timeout
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _read(self, pipe, nbytes):
+        try:
+            return pipe.read(nbytes, self._timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv(self, nbytes):
+        if not self._framed:
+            return self._sock.recv(nbytes)
+        return self._read(self._stdout, nbytes)
+
+    def recv_stderr(self, nbytes):
+        if not self._framed:
+            return ''
+        return self._read(self._stderr, nbytes)
+
+    def recv_ready(self):
+        return self._framed and self._stdout.read_ready()
+
+    def recv_stderr_ready(self):
+        return self._framed and self._stderr.read_ready()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if not self._framed:
+            self._sock.sendall(data)
+            return
+        self._send_lock.acquire()
+        try:
+            _send_frame(self._sock, FRAME_STDIN, data)
+        finally:
+            self._send_lock.release()
+
+    def shutdown_write(self):
+        if not self._framed:
+            self._sock.shutdown(socket.SHUT_WR)
+            return
+        self._send_lock.acquire()
+        try:
+            _send_frame(self._sock, FRAME_STDIN_EOF)
+        finally:
+            self._send_lock.release()
+
+    def makefile(self, *params):
+        return ChannelFile(*([self] + list(params)))
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(*([self] + list(params)))
+
+    def exit_status_ready(self):
+        return self._status_event.isSet()
+
+    def recv_exit_status(self):
+        while not self._status_event.isSet():
+            self._status_event.wait(1)
+        return self._exit_status
+
+    def close(self):
+        self.closed = True
+        if self._sock and not self._sock_closed:
+            self._sock_closed = True
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+
+class BrokerTransport(object):
+    """
+    Stands in for a paramiko.Transport in SSHClient when channels are opened
+    through the broker. Creating a BrokerTransport makes sure the broker has
+    an authenticated transport for the given host and user.
+    """
+    def __init__(self, host, port, username, private_key,
+                 private_key_pass=None, compress=False, timeout=30,
+                 socket_path=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.private_key = os.path.abspath(os.path.expanduser(private_key))
+        self.private_key_pass = private_key_pass
+        self.compress = compress
+        self.timeout = timeout
+        self.socket_path = socket_path or static.SSH_BROKER_SOCKET
+        self.active = True
+        start_broker(self.socket_path)
+        sock = _connect(self.socket_path)
+        try:
+            request = dict(op='connect')
+            request.update(self.get_request())
+            _send_message(sock, request)
+            reply = _recv_message(sock)
+        except (socket.error, EOFError):
+            raise exception.SSHBrokerUnavailable(self.socket_path)
+        finally:
+            sock.close()
+        if 'error' in reply:
+            _raise_error(reply)
+        key_type, key_data = reply['server_key']
+        key_class = _KEY_TYPES.get(key_type, paramiko.ECDSAKey)
+        self._server_key = key_class(data=base64.b64decode(key_data))
+
+    def get_request(self):
+        return dict(host=self.host, port=self.port, username=self.username,
+                    private_key=self.private_key,
+                    private_key_pass=self.private_key_pass,
+                    compress=self.compress, timeout=self.timeout)
+
+    def open_session(self):
+        return BrokerChannel(self)
+
+    def is_active(self):
+        return self.active
+
+    def get_username(self):
+        return self.username
+
+    def get_remote_server_key(self):
+        return self._server_key
+
+    def close(self):
+        # the broker owns the real transport and expires it when idle
+        self.active = False
+
+
+class SSHBroker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Unix socket server that caches authenticated SSH transports keyed by
+    (host, port, username, private key, compression)
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=None,
+                 idle_timeout=TRANSPORT_IDLE_TIMEOUT,
+                 broker_timeout=BROKER_IDLE_TIMEOUT):
+        self.socket_path = socket_path or static.SSH_BROKER_SOCKET
+        self.idle_timeout = idle_timeout
+        self.broker_timeout = broker_timeout
+        self._clients = {}
+        self._connect_locks = {}
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                                   BrokerRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def _get_key(self, request):
+        return (request['host'], request['port'], request['username'],
+                request['private_key'], request['compress'])
+
+    def get_client(self, request):
+        """
+        Returns an SSHClient with an active transport for the request's
+        host/user creating (or re-creating) the connection if needed
+        """
+        from starcluster import sshutils
+        key = self._get_key(request)
+        self._lock.acquire()
+        try:
+            conn_lock = self._connect_locks.setdefault(key, threading.Lock())
+        finally:
+            self._lock.release()
+        conn_lock.acquire()
+        try:
+            entry = self._clients.get(key)
+            if entry and entry[0].is_active():
+                entry[1] = time.time()
+                return entry[0]
+            log.debug("broker connecting to %s@%s:%d" %
+                      (key[2], key[0], key[1]))
+            client = sshutils.SSHClient(
+                request['host'], username=request['username'],
+                private_key=request['private_key'],
+                private_key_pass=request.get('private_key_pass'),
+                compress=request['compress'], port=request['port'],
+                timeout=request['timeout'], use_broker=False)
+            client.connect()
+            self._lock.acquire()
+            try:
+                self._clients[key] = [client, time.time(), 0]
+            finally:
+                self._lock.release()
+            return client
+        finally:
+            conn_lock.release()
+
+    def checkout(self, request):
+        client = self.get_client(request)
+        self._lock.acquire()
+        try:
+            self._clients[self._get_key(request)][2] += 1
+        finally:
+            self._lock.release()
+        return client
+
+    def checkin(self, request):
+        self._lock.acquire()
+        try:
+            entry = self._clients.get(self._get_key(request))
+            if entry:
+                entry[1] = time.time()
+                entry[2] -= 1
+        finally:
+            self._lock.release()
+
+    def expire(self):
+        """
+        Close transports that have been idle for more than idle_timeout
+        seconds. Returns True if the broker itself has been idle for more
+        than broker_timeout seconds.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key, (client, last_used, nchans) in self._clients.items():
+                if nchans <= 0 and now - last_used > self.idle_timeout:
+                    log.debug("broker closing idle connection to %s@%s" %
+                              (key[2], key[0]))
+                    del self._clients[key]
+                    client.close()
+            if self._clients:
+                self._last_used = now
+            return now - self._last_used > self.broker_timeout
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        self._lock.acquire()
+        try:
+            for client, last_used, nchans in self._clients.values():
+                client.close()
+            self._clients = {}
+        finally:
+            self._lock.release()
+
+    def _reap(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 10))
+            if self.expire():
+                log.debug("ssh broker idle, shutting down")
+                self.shutdown()
+                return
+
+    def serve_forever(self, poll_interval=0.5):
+        reaper = threading.Thread(target=self._reap)
+        reaper.daemon = True
+        reaper.start()
+        try:
+            SocketServer.UnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            self.close_all()
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+class BrokerRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Handles a single client socket: one request, then a relayed channel
+    """
+    def handle(self):
+        sock = self.request
+        try:
+            request = _recv_message(sock)
+        except (socket.error, EOFError, ValueError):
+            return
+        op = request.get('op')
+        if op == 'stop':
+            _send_message(sock, dict(ok=True))
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        try:
+            client = self.server.checkout(request)
+        except Exception, e:
+            log.debug("broker failed to connect", exc_info=True)
+            _send_message(sock, dict(error=str(e),
+                                     **{'class': e.__class__.__name__}))
+            return
+        try:
+            self._handle_op(client, request)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.server.checkin(request)
+
+    def _handle_op(self, client, request):
+        sock = self.request
+        op = request.get('op')
+        if op == 'connect':
+            key = client.get_server_public_key()
+            server_key = [key.get_name(), base64.b64encode(str(key))]
+            _send_message(sock, dict(ok=True, server_key=server_key))
+            return
+        try:
+            chan = client.transport.open_session()
+            if request.get('pty'):
+                chan.get_pty(*request['pty'])
+            if op == 'exec':
+                chan.exec_command(request['command'])
+            elif op == 'subsystem':
+                chan.invoke_subsystem(request['name'])
+            elif op == 'shell':
+                chan.invoke_shell()
+            else:
+                raise exception.SSHError("unknown broker request: %s" % op)
+        except Exception, e:
+            _send_message(sock, dict(error=str(e),
+                                     **{'class': e.__class__.__name__}))
+            return
+        _send_message(sock, dict(ok=True))
+        try:
+            if op == 'exec':
+                self._relay_frames(chan)
+            else:
+                self._relay_raw(chan)
+        finally:
+            chan.close()
+
+    def _relay_raw(self, chan):
+        sock = self.request
+        while not chan.closed:
+            r, w, e = select.select([sock, chan], [], [], 0.5)
+            if sock in r:
+                data = sock.recv(32768)
+                if not data:
+                    return
+                chan.sendall(data)
+            if chan in r:
+                data = chan.recv(32768)
+                if not data:
+                    return
+                sock.sendall(data)
+
+    def _relay_frames(self, chan):
+        sock = self.request
+        while True:
+            # check before draining so that no output received ahead of the
+            # exit status is left behind in the channel's buffers
+            done = chan.closed or (chan.exit_status_ready() and
+                                   chan.eof_received)
+            r, w, e = select.select([sock, chan], [], [], 0 if done else 0.1)
+            if sock in r:
+                try:
+                    ftype, data = _recv_frame(sock)
+                except EOFError:
+                    # client went away
+                    return
+                if ftype == FRAME_STDIN:
+                    chan.sendall(data)
+                elif ftype == FRAME_STDIN_EOF:
+                    chan.shutdown_write()
+            while chan.recv_ready():
+                _send_frame(sock, FRAME_STDOUT, chan.recv(32768))
+            while chan.recv_stderr_ready():
+                _send_frame(sock, FRAME_STDERR, chan.recv_stderr(32768))
+            if done:
+                break
+        status = chan.exit_status if chan.exit_status_ready() else -1
+        _send_frame(sock, FRAME_EXIT_STATUS, struct.pack('!i', status))
+
+
+def main(socket_path=None):
+    from starcluster import logger
+    logger.configure_sc_logging()
+    socket_path = socket_path or static.SSH_BROKER_SOCKET
+    try:
+        _connect(socket_path).close()
+        log.debug("ssh broker already running on %s" % socket_path)
+        return
+    except exception.SSHBrokerUnavailable:
+        pass
+    try:
+        broker = SSHBroker(socket_path)
+    except socket.error, e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        return
+    log.debug("ssh broker listening on %s (pid %d)" %
+              (socket_path, os.getpid()))
+    broker.serve_forever()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
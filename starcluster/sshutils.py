@@ -19,13 +19,19 @@ import os
 import re
 import sys
 import stat
+import time
 import glob
+import errno
+import pipes
 import atexit
+import select
 import string
 import socket
 import fnmatch
 import hashlib
 import warnings
+import binascii
+import threading
 import posixpath
 
 import scp
@@ -41,10 +47,33 @@ try:
 except ImportError:
     HAS_TERMIOS = False
 
+from starcluster import transfer
 from starcluster import exception
+from starcluster import sshbroker
+from starcluster import threadpool
 from starcluster import progressbar
+from starcluster.templates import managed_block
 from starcluster.logger import log
 
+# max number of bytes of a remote command's output to write to the debug log
+MAX_LOGGED_OUTPUT = 64 * 1024
+# max number of paths passed to a single remote stat/find command
+STAT_BATCH = 500
+
+# process-wide caches of parsed private keys, keyed by (path, mtime,
+# passphrase), and of server host keys, keyed by (host, port), so that
+# connecting to many hosts parses the private key only once
+_pkey_cache = {}
+_host_key_cache = {}
+_key_cache_lock = threading.Lock()
+
+
+def _truncate_output(output, max_bytes=MAX_LOGGED_OUTPUT):
+    if len(output) <= max_bytes:
+        return output
+    return output[:max_bytes] + "\n... (%d more bytes not logged)" % (
+        len(output) - max_bytes)
+
 
 class SSHClient(object):
     """
@@ -62,7 +91,8 @@ class SSHClient(object):
                  private_key_pass=None,
                  compress=False,
                  port=22,
-                 timeout=30):
+                 timeout=30,
+                 use_broker=None):
         self._host = host
         self._port = port
         self._pkey = None
@@ -71,11 +101,21 @@ class SSHClient(object):
         self._timeout = timeout
         self._sftp = None
         self._scp = None
+        self._transfer = None
         self._transport = None
         self._progress_bar = None
         self._compress = compress
+        self._private_key = private_key
+        self._private_key_pass = private_key_pass
+        if use_broker is None:
+            use_broker = sshbroker.is_enabled()
+        # the broker only handles key-based authentication
+        self._use_broker = bool(use_broker and private_key)
         if private_key:
-            self._pkey = self.load_private_key(private_key, private_key_pass)
+            if not self._use_broker:
+                # the broker loads the key itself when it first connects
+                self._pkey = self.load_private_key(private_key,
+                                                   private_key_pass)
         elif not password:
             raise exception.SSHNoCredentialsError()
         self._glob = SSHGlob(self)
@@ -83,6 +123,33 @@ class SSHClient(object):
         atexit.register(self.close)
 
     def load_private_key(self, private_key, private_key_pass=None):
+        """
+        Returns the parsed private key. Keys are cached for the life of the
+        process until the key file is modified.
+        """
+        path = os.path.abspath(os.path.expanduser(private_key))
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        cache_key = (path, mtime, private_key_pass)
+        # hold the lock while parsing so that concurrent connections wait
+        # for the first one to load the key rather than all parsing it
+        _key_cache_lock.acquire()
+        try:
+            pkey = _pkey_cache.get(cache_key)
+            if pkey is None:
+                pkey = self._load_private_key(private_key, private_key_pass)
+                if pkey is not None:
+                    for key in _pkey_cache.keys():
+                        if key[0] == path:
+                            del _pkey_cache[key]
+                    _pkey_cache[cache_key] = pkey
+        finally:
+            _key_cache_lock.release()
+        return pkey
+
+    def _load_private_key(self, private_key, private_key_pass=None):
         # Use Private Key.
         log.debug('loading private key %s' % private_key)
         if private_key.endswith('rsa') or private_key.count('rsa'):
@@ -105,9 +172,35 @@ class SSHClient(object):
         password = password or self._password
         compress = compress or self._compress
         port = port if port is not None else self._port
-        pkey = self._pkey
         if private_key:
-            pkey = self.load_private_key(private_key, private_key_pass)
+            self._private_key = private_key
+            self._private_key_pass = private_key_pass
+            self._pkey = None
+        if self._use_broker:
+            log.debug("connecting to host %s on port %d as user %s via the "
+                      "ssh broker" % (host, port, username))
+            try:
+                transport = sshbroker.BrokerTransport(
+                    host, port, username, self._private_key,
+                    private_key_pass=self._private_key_pass,
+                    compress=compress, timeout=timeout)
+            except exception.SSHBrokerUnavailable, e:
+                log.debug("%s - connecting directly" % e)
+                self._use_broker = False
+            else:
+                return self._set_transport(transport, username, host, port)
+        if self._pkey is None and self._private_key:
+            self._pkey = self.load_private_key(self._private_key,
+                                               self._private_key_pass)
+        transport = self._connect_transport(host, port, username, password,
+                                            self._pkey, compress, timeout)
+        return self._set_transport(transport, username, host, port)
+
+    def _connect_transport(self, host, port, username, password, pkey,
+                           compress, timeout):
+        """
+        Open and authenticate a new paramiko Transport to host
+        """
         log.debug("connecting to host %s on port %d as user %s" % (host, port,
                                                                    username))
         try:
@@ -132,8 +225,16 @@ class SSHClient(object):
             raise exception.SSHConnectionError(host, port)
         except Exception, e:
             raise exception.SSHError(str(e))
+        return transport
+
+    def _set_transport(self, transport, username, host, port):
         self.close()
         self._transport = transport
+        _key_cache_lock.acquire()
+        try:
+            _host_key_cache[(host, port)] = transport.get_remote_server_key()
+        finally:
+            _key_cache_lock.release()
         try:
             assert self.sftp is not None
         except paramiko.SFTPError, e:
@@ -155,7 +256,18 @@ class SSHClient(object):
         return self._transport
 
     def get_server_public_key(self):
-        return self.transport.get_remote_server_key()
+        """
+        Returns the server's host key. Host keys are cached for the life of
+        the process whenever a connection is made so this only connects to
+        the host if no client in this process has connected to it yet (or
+        this client is already connected).
+        """
+        if self.is_active():
+            return self._transport.get_remote_server_key()
+        key = _host_key_cache.get((self._host, self._port))
+        if key is None:
+            key = self.transport.get_remote_server_key()
+        return key
 
     def is_active(self):
         if self._transport:
@@ -202,9 +314,26 @@ class SSHClient(object):
         """Establish the SFTP connection."""
         if not self._sftp or self._sftp.sock.closed:
             log.debug("creating sftp connection")
-            self._sftp = paramiko.SFTPClient.from_transport(self.transport)
+            self._sftp = self._open_channel(paramiko.SFTPClient.from_transport)
         return self._sftp
 
+    def open_sftp(self, new_connection=False):
+        """
+        Returns a new SFTP session that is independent of the sftp property.
+
+        If new_connection is True the session gets its own SSH connection (and
+        therefore its own TCP window and cipher) instead of sharing this
+        client's transport. The caller is responsible for closing the session
+        and, if it differs from self.transport, the session's transport.
+        """
+        transport = self.transport
+        if new_connection and isinstance(transport, paramiko.Transport):
+            transport = self._connect_transport(
+                self._host, self._port, transport.get_username(),
+                self._password, self._pkey, self._compress, self._timeout)
+            return paramiko.SFTPClient.from_transport(transport)
+        return self._open_channel(paramiko.SFTPClient.from_transport)
+
     @property
     def scp(self):
         """Initialize the SCP client."""
@@ -310,6 +439,47 @@ class SSHClient(object):
         f.writelines(lines)
         f.close()
 
+    def update_file_entries(self, remote_file, entries=None, remove=None,
+                            key_fields=(1,)):
+        """
+        Idempotently edit the StarCluster-managed block of remote_file (see
+        templates/managed_block.py) with a single remote command. Only the
+        changes are sent over the connection and the file is replaced
+        atomically and only if its contents changed.
+
+        entries - lines that should be present in the file. Any other line
+        with the same key as an entry is removed.
+        remove - keys (tuples of field values) of lines to remove
+        key_fields - the (1-based) whitespace-separated fields that make up a
+        line's key, e.g. (2,) for the mount point of an /etc/fstab entry.
+        Anything from the first '(' in a field on is ignored, e.g. the options
+        of an /etc/exports client.
+
+        Returns True if the file was modified.
+        """
+        env = dict(SC_KEYS=' '.join(map(str, key_fields)),
+                   SC_ENTRIES='\n'.join(entries or []),
+                   SC_REMOVE='\n'.join(' '.join(k) for k in remove or []))
+        script = '\n'.join([
+            'f=$(readlink -f %s) || exit 1' % pipes.quote(remote_file),
+            'export %s' % ' '.join('%s=%s' % (k, pipes.quote(v))
+                                   for k, v in sorted(env.items())),
+            '[ -e "$f" ] || touch "$f" || exit 1',
+            'tmp=$(mktemp "$f.XXXXXX") || exit 1',
+            'awk %s "$f" > "$tmp" || { rm -f "$tmp"; exit 1; }' %
+            pipes.quote(managed_block.managed_block_template),
+            'if cmp -s "$f" "$tmp"; then',
+            '    rm -f "$tmp"; echo unchanged; exit',
+            'fi',
+            'chmod --reference="$f" "$tmp"; chown --reference="$f" "$tmp"',
+            # bind-mounted files (e.g. /etc/hosts in containers) can't be
+            # replaced by a rename
+            'mv -f "$tmp" "$f" 2>/dev/null || { cat "$tmp" > "$f"; '
+            'rm -f "$tmp"; }',
+            'echo changed'])
+        output = self.execute(script, source_profile=False)
+        return bool(output) and output[-1] == 'changed'
+
     def unlink(self, remote_file):
         return self.sftp.unlink(remote_file)
 
@@ -396,6 +566,68 @@ class SSHClient(object):
         """
         return self.sftp.lstat(path)
 
+    def stat_many(self, paths, lstat=False):
+        """
+        Stat many remote paths in a single round trip (per STAT_BATCH paths)
+        rather than one SFTP request per path. Returns a dictionary mapping
+        each existing path to its paramiko.SFTPAttributes. Paths that do not
+        exist are left out.
+
+        lstat - don't follow symlinks
+        """
+        cmd = 'stat %s-c "%%f %%s %%u %%g %%X %%Y %%n" --' % (
+            '' if lstat else '-L ')
+        attrs = {}
+        for i in range(0, len(paths), STAT_BATCH):
+            batch = paths[i:i + STAT_BATCH]
+            lines = self.execute('%s %s 2>/dev/null' %
+                                 (cmd, ' '.join(map(pipes.quote, batch))),
+                                 source_profile=False, ignore_exit_status=True,
+                                 log_output=False)
+            for line in lines:
+                fields = line.split(' ', 6)
+                if len(fields) != 7:
+                    continue
+                attr = paramiko.SFTPAttributes()
+                attr.st_mode = int(fields[0], 16)
+                attr.st_size, attr.st_uid, attr.st_gid, attr.st_atime, \
+                    attr.st_mtime = map(int, fields[1:6])
+                attrs[fields[6]] = attr
+        return attrs
+
+    def ls_many(self, paths):
+        """
+        List many remote directories in a single round trip (per STAT_BATCH
+        directories). Returns a dictionary mapping each directory in paths to
+        the names of its entries. Paths that are not directories are left
+        out.
+        """
+        if len(paths) == 1:
+            try:
+                return {paths[0]: self.sftp.listdir(paths[0])}
+            except IOError:
+                return {}
+        entries = {}
+        for i in range(0, len(paths), STAT_BATCH):
+            batch = paths[i:i + STAT_BATCH]
+            lines = self.execute(
+                'find -H %s -maxdepth 1 -printf "%%d %%y %%H/%%P\\n" '
+                '2>/dev/null' % ' '.join(map(pipes.quote, batch)),
+                source_profile=False, ignore_exit_status=True,
+                log_output=False)
+            for line in lines:
+                fields = line.split(' ', 2)
+                if len(fields) != 3:
+                    continue
+                depth, ftype, path = fields
+                dirname, name = path.rsplit('/', 1)
+                if depth == '0':
+                    if ftype == 'd':
+                        entries.setdefault(dirname, [])
+                else:
+                    entries.setdefault(dirname, []).append(name)
+        return entries
+
     @property
     def progress_bar(self):
         if not self._progress_bar:
@@ -422,9 +654,21 @@ class SSHClient(object):
             return [obj]
         return obj
 
-    def get(self, remotepaths, localpath=''):
+    @property
+    def transfer(self):
+        """Parallel SFTP transfer engine used by get/put"""
+        if not self._transfer:
+            self._transfer = transfer.SFTPTransfer(
+                self, progress=self._file_transfer_progress)
+        return self._transfer
+
+    def get(self, remotepaths, localpath='', sync=False, checksum=False,
+            delete=False):
         """
         Copies one or more files from the remote host to the local host.
+        Large files are split into ranges that are copied in parallel and
+        partially transferred files are resumed. See
+        transfer.SFTPTransfer.put for the sync, checksum and delete kwargs.
         """
         remotepaths = self._make_list(remotepaths)
         localpath = localpath or os.getcwd()
@@ -439,36 +683,31 @@ class SSHClient(object):
         remotepaths = noglobs
         for globresult in globresults:
             remotepaths.extend(globresult)
-        recursive = False
+        attrs = self.stat_many(remotepaths)
         for rpath in remotepaths:
-            if not self.path_exists(rpath):
+            if rpath not in attrs:
                 raise exception.BaseException(
                     "Remote file or directory does not exist: %s" % rpath)
-        for rpath in remotepaths:
-            if self.isdir(rpath):
-                recursive = True
-                break
         try:
-            self.scp.get(remotepaths, local_path=localpath,
-                         recursive=recursive)
+            self.transfer.get(remotepaths, localpath, sync=sync,
+                              checksum=checksum, delete=delete, attrs=attrs)
         except Exception, e:
             log.debug("get failed: remotepaths=%s, localpath=%s",
                       str(remotepaths), localpath)
             raise exception.SCPException(str(e))
 
-    def put(self, localpaths, remotepath='.'):
+    def put(self, localpaths, remotepath='.', sync=False, checksum=False,
+            delete=False):
         """
         Copies one or more files from the local host to the remote host.
+        Large files are split into ranges that are copied in parallel and
+        partially transferred files are resumed. See
+        transfer.SFTPTransfer.put for the sync, checksum and delete kwargs.
         """
         localpaths = self._make_list(localpaths)
-        recursive = False
-        for lpath in localpaths:
-            if os.path.isdir(lpath):
-                recursive = True
-                break
         try:
-            self.scp.put(localpaths, remote_path=remotepath,
-                         recursive=recursive)
+            self.transfer.put(localpaths, remotepath, sync=sync,
+                              checksum=checksum, delete=delete)
         except Exception, e:
             log.debug("put failed: localpaths=%s, remotepath=%s",
                       str(localpaths), remotepath)
@@ -484,6 +723,33 @@ class SSHClient(object):
         return self.execute(command, detach=True,
                             source_profile=source_profile)
 
+    def _open_channel(self, open_fn, *args):
+        """
+        Returns open_fn(self.transport, *args) where open_fn opens a channel
+        on the transport. If the ssh broker died since this client connected
+        to it, reconnect directly (bypassing the broker) and call open_fn once
+        more so that the caller's request doesn't fail.
+        """
+        try:
+            return open_fn(self.transport, *args)
+        except exception.SSHBrokerUnavailable, e:
+            if not self._use_broker:
+                raise
+            log.debug("%s - reconnecting directly" % e)
+            self._use_broker = False
+            self.connect(self._host, self._username, self._password,
+                         port=self._port, timeout=self._timeout,
+                         compress=self._compress)
+            return open_fn(self.transport, *args)
+
+    def _exec_command(self, transport, command):
+        """
+        Open a session channel on transport and run command on it
+        """
+        channel = transport.open_session()
+        channel.exec_command(command)
+        return channel
+
     def get_last_status(self):
         return self.__last_status
 
@@ -491,11 +757,11 @@ class SSHClient(object):
         """
         Execute a remote command and return the exit status
         """
-        channel = self.transport.open_session()
         if source_profile:
             command = "source /etc/profile && %s" % command
-        channel.exec_command(command)
-        self.__last_status = channel.recv_exit_status()
+        with threadpool.host_limits.slot(self._host):
+            channel = self._open_channel(self._exec_command, command)
+            self.__last_status = channel.recv_exit_status()
         return self.__last_status
 
     def _get_output(self, channel, silent=True, only_printable=False):
@@ -548,29 +814,43 @@ class SSHClient(object):
         raise_on_failure - raise exception.SSHError if command fails
         returns List of output lines
         """
-        channel = self.transport.open_session()
         if detach:
             command = "nohup %s &" % command
             if source_profile:
                 command = "source /etc/profile && %s" % command
-            channel.exec_command(command)
-            channel.close()
+            with threadpool.host_limits.slot(self._host):
+                channel = self._open_channel(self._exec_command, command)
+                channel.close()
             self.__last_status = None
             return
         if source_profile:
             command = "source /etc/profile && %s" % command
         log.debug("executing remote command: %s" % command)
-        channel.exec_command(command)
-        output = self._get_output(channel, silent=silent,
-                                  only_printable=only_printable)
-        exit_status = channel.recv_exit_status()
+        with threadpool.host_limits.slot(self._host):
+            channel = self._open_channel(self._exec_command, command)
+            output = self._get_output(channel, silent=silent,
+                                      only_printable=only_printable)
+            exit_status = channel.recv_exit_status()
         self.__last_status = exit_status
         out_str = '\n'.join(output)
+        self._check_exit_status(command, exit_status, out_str,
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=log_output,
+                                raise_on_failure=raise_on_failure)
+        return output
+
+    def _check_exit_status(self, command, exit_status, out_str,
+                           ignore_exit_status=False, log_output=True,
+                           raise_on_failure=True):
+        """
+        Log the output of a remote command and raise RemoteCommandFailed if
+        the command failed (see execute)
+        """
         if exit_status != 0:
             msg = "remote command '%s' failed with status %d"
             msg %= (command, exit_status)
             if log_output:
-                msg += ":\n%s" % out_str
+                msg += ":\n%s" % _truncate_output(out_str)
             else:
                 msg += " (no output log requested)"
             if not ignore_exit_status:
@@ -583,10 +863,133 @@ class SSHClient(object):
                 log.debug("(ignored) " + msg)
         else:
             if log_output:
-                log.debug("output of '%s':\n%s" % (command, out_str))
+                log.debug("output of '%s':\n%s" %
+                          (command, _truncate_output(out_str)))
             else:
                 log.debug("output of '%s' has been hidden" % command)
-        return output
+
+    def execute_iter(self, command, ignore_exit_status=False,
+                     log_output=True, source_profile=True,
+                     raise_on_failure=True):
+        """
+        Same as execute() except that this method is a generator that yields
+        each line of the command's stdout (without the trailing newline) as
+        soon as it arrives instead of returning all output once the command
+        finishes. stderr is read concurrently and is not yielded. At most
+        MAX_LOGGED_OUTPUT bytes of output are kept for the debug log and the
+        RemoteCommandFailed exception raised (once all output has been
+        yielded) if the command fails.
+        """
+        if source_profile:
+            command = "source /etc/profile && %s" % command
+        log.debug("executing remote command: %s" % command)
+        logged = []
+        stderr_lines = []
+        with threadpool.host_limits.slot(self._host):
+            channel = self._open_channel(self._exec_command, command)
+            try:
+                stderr = channel.makefile_stderr('rb', -1)
+                reader = threading.Thread(
+                    target=self._read_lines,
+                    args=(stderr, stderr_lines, MAX_LOGGED_OUTPUT))
+                reader.daemon = True
+                reader.start()
+                stdout = channel.makefile('rb', -1)
+                nbytes = 0
+                for line in iter(stdout.readline, ''):
+                    line = line.rstrip('\r\n')
+                    nbytes += len(line) + 1
+                    if nbytes <= MAX_LOGGED_OUTPUT:
+                        logged.append(line)
+                    yield line
+                reader.join()
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        self.__last_status = exit_status
+        if nbytes > MAX_LOGGED_OUTPUT:
+            logged.append("... (%d more bytes not logged)" %
+                          (nbytes - MAX_LOGGED_OUTPUT))
+        out_str = '\n'.join(logged + stderr_lines)
+        self._check_exit_status(command, exit_status, out_str,
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=log_output,
+                                raise_on_failure=raise_on_failure)
+
+    def _read_lines(self, fileobj, lines, max_bytes):
+        """
+        Read fileobj until EOF and append its lines to lines (only keeping
+        the first max_bytes bytes)
+        """
+        nbytes = 0
+        for line in iter(fileobj.readline, ''):
+            nbytes += len(line)
+            if nbytes <= max_bytes:
+                lines.append(line.rstrip('\r\n'))
+
+    def execute_many(self, commands, source_profile=True,
+                     ignore_exit_status=False, stop_on_failure=True,
+                     log_output=True):
+        """
+        Execute a list of remote commands over a single channel and return a
+        list of (output, exit_status) tuples - one per command that ran.
+
+        Each command runs in its own subshell with stderr merged into stdout
+        so changing directories or setting variables does not affect the
+        commands that follow. Append '|| true' to a command that is allowed
+        to fail.
+
+        kwargs:
+        source_profile - if True "source /etc/profile" once before running
+                         the commands
+        ignore_exit_status - don't raise RemoteCommandFailed if a command
+                             fails
+        stop_on_failure - don't run the remaining commands after a command
+                          fails
+        log_output - log all remote output to the debug file
+        """
+        marker = '__starcluster_status_%s__' % binascii.hexlify(os.urandom(8))
+        script = []
+        if source_profile:
+            script.append('source /etc/profile')
+        for i, command in enumerate(commands):
+            script.append('(\n%s\n) 2>&1' % command)
+            script.append('s=$?; echo "%s %d $s"' % (marker, i))
+            if stop_on_failure:
+                script.append('[ $s -eq 0 ] || exit $s')
+        script = '\n'.join(script)
+        log.debug("executing remote commands: %s" % commands)
+        with threadpool.host_limits.slot(self._host):
+            channel = self._open_channel(self._exec_command, script)
+            stdout = channel.makefile('rb', -1)
+            lines = stdout.readlines()
+            errors = channel.makefile_stderr('rb', -1).readlines()
+            exit_status = channel.recv_exit_status()
+        results = []
+        output = []
+        for line in lines:
+            index = line.find(marker)
+            if index >= 0:
+                # the marker follows the command's output on the same line if
+                # the output does not end with a newline
+                if index > 0:
+                    output.append(line[:index])
+                results.append((output, int(line.split()[-1])))
+                output = []
+            else:
+                output.append(line.rstrip('\r\n'))
+        if errors:
+            log.debug("stderr of remote commands:\n%s" %
+                      _truncate_output(''.join(errors)))
+        if exit_status != 0 and not results:
+            # source /etc/profile failed before any command ran
+            results.append((output, exit_status))
+        for command, (output, status) in zip(commands, results):
+            self.__last_status = status
+            self._check_exit_status(command, status, '\n'.join(output),
+                                    ignore_exit_status=ignore_exit_status,
+                                    log_output=log_output)
+        return results
 
     def has_required(self, progs):
         """
@@ -631,7 +1034,10 @@ class SSHClient(object):
             self._transport.close()
 
     def _invoke_shell(self, term='screen', cols=80, lines=24):
-        chan = self.transport.open_session()
+        return self._open_channel(self._open_shell, term, cols, lines)
+
+    def _open_shell(self, transport, term, cols, lines):
+        chan = transport.open_session()
         chan.get_pty(term, cols, lines)
         chan.invoke_shell()
         return chan
@@ -745,59 +1151,170 @@ class SSHGlob(object):
         self.ssh = ssh_client
 
     def glob(self, pathname):
-        return list(self.iglob(pathname))
+        return self._glob(pathname)
 
     def iglob(self, pathname):
         """
         Return an iterator which yields the paths matching a pathname pattern.
         The pattern may contain simple shell-style wildcards a la fnmatch.
+
+        Each level of the pattern is matched against all candidate
+        directories at once (see SSHClient.ls_many and stat_many) so the
+        number of round trips depends on the depth of the pattern rather
+        than the number of matches.
         """
+        return iter(self._glob(pathname))
+
+    def _glob(self, pathname):
         if not glob.has_magic(pathname):
             if self.ssh.lpath_exists(pathname):
-                yield pathname
-            return
+                return [pathname]
+            return []
         dirname, basename = posixpath.split(pathname)
         if not dirname:
-            for name in self.glob1(posixpath.curdir, basename):
-                yield name
-            return
+            return self.glob1([posixpath.curdir], basename,
+                              join=False)
         if glob.has_magic(dirname):
-            dirs = self.iglob(dirname)
+            dirs = self._glob(dirname)
         else:
             dirs = [dirname]
+        if not dirs:
+            return []
         if glob.has_magic(basename):
-            glob_in_dir = self.glob1
-        else:
-            glob_in_dir = self.glob0
-        for dirname in dirs:
-            for name in glob_in_dir(dirname, basename):
-                yield posixpath.join(dirname, name)
+            return self.glob1(dirs, basename)
+        return self.glob0(dirs, basename)
 
-    def glob0(self, dirname, basename):
+    def glob0(self, dirnames, basename):
+        """
+        Returns the paths of basename in each of dirnames that exist
+        """
+        paths = [posixpath.join(dirname, basename) for dirname in dirnames]
         if basename == '':
             # `os.path.split()` returns an empty basename for paths ending with
             # a directory separator.  'q*x/' should match only directories.
-            if self.ssh.isdir(dirname):
-                return [basename]
+            attrs = self.ssh.stat_many(dirnames)
+            return [path for dirname, path in zip(dirnames, paths)
+                    if dirname in attrs and
+                    stat.S_ISDIR(attrs[dirname].st_mode)]
+        attrs = self.ssh.stat_many(paths, lstat=True)
+        return [path for path in paths if path in attrs]
+
+    def glob1(self, dirnames, pattern, join=True):
+        """
+        Returns the paths of the entries in each of dirnames that match
+        pattern (just the entry names if join is False)
+        """
+        if isinstance(pattern, unicode):
+            dirnames = [d if isinstance(d, unicode) else unicode(d, 'UTF-8')
+                        for d in dirnames]
+        entries = self.ssh.ls_many(dirnames)
+        results = []
+        for dirname in dirnames:
+            names = entries.get(dirname, [])
+            if pattern[0] != '.':
+                names = filter(lambda x: x[0] != '.', names)
+            for name in fnmatch.filter(names, pattern):
+                if join:
+                    name = posixpath.join(dirname, name)
+                results.append(name)
+        return results
+
+
+def scan_ssh_banners(addrs, port=22, timeout=5, batch_size=500):
+    """
+    Returns the set of addresses in addrs that accept a TCP connection on port
+    and send an SSH identification banner within timeout seconds. All
+    addresses (up to batch_size at a time) are probed concurrently using
+    non-blocking sockets and no SSH handshake is attempted.
+    """
+    addrs = list(addrs)
+    ready = set()
+    for i in range(0, len(addrs), batch_size):
+        ready.update(_scan_ssh_banners(addrs[i:i + batch_size], port,
+                                       timeout))
+    return ready
+
+
+def _wait_for_sockets(reading, writing, timeout):
+    """
+    Returns a (readable, writable) tuple of the sockets in reading that can be
+    read from and the sockets in writing that can be written to (or that
+    failed) within timeout seconds. Uses poll() where available given that
+    select() can't handle file descriptors >= FD_SETSIZE.
+    """
+    if not hasattr(select, 'poll'):
+        readable, writable, err = select.select(list(reading), list(writing),
+                                                [], timeout)
+        return readable, writable
+    poller = select.poll()
+    fds = {}
+    for sock in reading:
+        poller.register(sock, select.POLLIN)
+        fds[sock.fileno()] = sock
+    for sock in writing:
+        poller.register(sock, select.POLLOUT)
+        fds[sock.fileno()] = sock
+    readable, writable = [], []
+    for fd, event in poller.poll(timeout * 1000):
+        sock = fds[fd]
+        if sock in writing:
+            writable.append(sock)
         else:
-            if self.ssh.lexists(posixpath.join(dirname, basename)):
-                return [basename]
-        return []
+            readable.append(sock)
+    return readable, writable
 
-    def glob1(self, dirname, pattern):
-        if not dirname:
-            dirname = posixpath.curdir
-        if isinstance(pattern, unicode) and not isinstance(dirname, unicode):
-            # enc = sys.getfilesystemencoding() or sys.getdefaultencoding()
-            # dirname = unicode(dirname, enc)
-            dirname = unicode(dirname, 'UTF-8')
+
+def _scan_ssh_banners(addrs, port, timeout):
+    socks = {}
+    for addr in addrs:
         try:
-            names = [posixpath.basename(n) for n in self.ssh.ls(dirname)]
-        except os.error:
-            return []
-        if pattern[0] != '.':
-            names = filter(lambda x: x[0] != '.', names)
-        return fnmatch.filter(names, pattern)
+            family, socktype, proto, canonname, sockaddr = \
+                socket.getaddrinfo(addr, port, socket.AF_UNSPEC,
+                                   socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+        except socket.error:
+            continue
+        sock.setblocking(0)
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            continue
+        socks[sock] = addr
+    connecting = set(socks)
+    reading = set()
+    banners = {}
+    ready = set()
+    deadline = time.time() + timeout
+    try:
+        while connecting or reading:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, writable = _wait_for_sockets(reading, connecting,
+                                                   remaining)
+            for sock in writable:
+                connecting.discard(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    reading.add(sock)
+            for sock in readable:
+                try:
+                    data = sock.recv(256)
+                except socket.error:
+                    data = ''
+                banner = banners.get(sock, '') + data
+                banners[sock] = banner
+                # servers may send other lines before the identification
+                # string (RFC 4253 section 4.2)
+                lines = banner.split('\n')
+                if [l for l in lines if l.startswith('SSH-')]:
+                    ready.add(socks[sock])
+                    reading.discard(sock)
+                elif not data or len(banner) > 4096:
+                    reading.discard(sock)
+    finally:
+        for sock in socks:
+            sock.close()
+    return ready
 
 
 def insert_char_every_n_chars(string, char='\n', every=64):
@@ -78,6 +78,8 @@ STARCLUSTER_OWNER_ID = 342652561657
 DEBUG_FILE = os.path.join(STARCLUSTER_LOG_DIR, 'debug.log')
 SSH_DEBUG_FILE = os.path.join(STARCLUSTER_LOG_DIR, 'ssh-debug.log')
 AWS_DEBUG_FILE = os.path.join(STARCLUSTER_LOG_DIR, 'aws-debug.log')
+SSH_BROKER_SOCKET = os.path.join(STARCLUSTER_CFG_DIR, 'ssh-broker.sock')
+NODE_FACTS_DIR = os.path.join(STARCLUSTER_CFG_DIR, 'facts')
 CRASH_FILE = os.path.join(STARCLUSTER_LOG_DIR, 'crash-report-%d.txt' % PID)
 
 # StarCluster BASE AMIs (us-east-1)
@@ -309,4 +311,9 @@ CLUSTER_SETTINGS = {
     'force_spot_master': (bool, False, False, None, None),
     'disable_cloudinit': (bool, False, False, None, None),
     'dns_prefix': (bool, False, False, None, None),
+    'cluster_dns': (bool, False, False, None, None),
+    'host_key_ca': (bool, False, False, None, None),
+    'setup_timeout': (int, False, 1800, None, None),
+    'launch_timeout': (int, False, 3600, None, None),
+    'node_cache_ttl': (int, False, 10, None, None),
 }
@@ -0,0 +1,63 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+# Streams a file to a tree of nodes. Each node stores the data it receives on
+# stdin and forwards it to up to `fanout` children over ssh while it is still
+# arriving, splitting the remaining aliases between them. The script is passed
+# to each child base64-encoded so that the command line does not grow with
+# the depth of the tree. Every node that stored the file prints a line
+# containing the marker followed by its alias.
+#
+# Arguments: script (base64), source file ('-' for stdin), destination, mode,
+# uid:gid, fanout, alias of this node ('-' to not store), marker, aliases...
+broadcast_template = """
+b64=$1 src=$2 dest=$3 mode=$4 owner=$5 fanout=$6 self=$7 marker=$8
+shift 8
+hosts=("$@")
+n=${#hosts[@]}
+# keep forwarding to the other children if one of them goes away
+trap '' PIPE
+d=$(mktemp -d) || exit 1
+if [ "$src" != "-" ]; then
+    exec < "$src" || exit 1
+fi
+outs=
+if [ "$self" != "-" ]; then
+    mkfifo $d/store
+    (tmp=$(mktemp "$dest.XXXXXX") && cat > "$tmp" && chmod $mode "$tmp" &&
+     chown $owner "$tmp" && mv -f "$tmp" "$dest" && echo "$marker $self" ||
+     rm -f "$tmp") < $d/store &
+    outs=$d/store
+fi
+i=0
+j=0
+while [ $i -lt $n ]; do
+    size=$(( (n - i + fanout - j - 1) / (fanout - j) ))
+    child=${hosts[$i]}
+    mkfifo $d/$j
+    ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o ConnectTimeout=30 \\
+        $child "bash -c \\"\\$(echo $b64 | base64 -d)\\" _ $b64 - \\
+        $(printf %q "$dest") $mode $owner $fanout $child $marker \\
+        ${hosts[*]:$((i + 1)):$((size - 1))}" < $d/$j &
+    outs="$outs $d/$j"
+    i=$((i + size))
+    j=$((j + 1))
+done
+tee $outs > /dev/null
+wait
+rm -rf $d
+"""
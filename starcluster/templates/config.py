@@ -105,6 +105,25 @@ CLUSTER_SHELL = bash
 # If you choose to enable this option, it's recommended that you enable it in
 # the DEFAULT_TEMPLATE so all nodes will automatically have the prefix
 # DNS_PREFIX = True
+# Uncomment to have the master resolve the names of all cluster nodes via DNS
+# rather than adding every node to /etc/hosts on every node (recommended for
+# large clusters)
+# CLUSTER_DNS = True
+# Uncomment to have the master sign the ssh host keys of all cluster nodes
+# rather than adding every node to each user's known_hosts file (recommended
+# for large clusters and clusters with many users)
+# HOST_KEY_CA = True
+# Number of seconds each setup step on a node (e.g. mounting NFS) may run
+# before it is cancelled so that a hung node can't stall the whole cluster
+# (defaults to 1800)
+# SETUP_TIMEOUT = 1800
+# Number of seconds all nodes have to come up when using --stream-setup before
+# missing workers are skipped (and the launch fails if the master is missing)
+# (defaults to 3600)
+# LAUNCH_TIMEOUT = 3600
+# Number of seconds to cache the list of cluster nodes before asking EC2 again
+# (defaults to 10)
+# NODE_CACHE_TTL = 10
 # AMI to use for cluster nodes. These AMIs are for the us-east-1 region.
 # Use the 'listpublic' command to list StarCluster AMIs in other regions
 # The base i386 StarCluster AMI is %(x86_ami)s
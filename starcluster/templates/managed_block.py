@@ -0,0 +1,100 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+# Markers around the lines StarCluster manages in system files such as
+# /etc/hosts, /etc/exports and /etc/fstab
+BEGIN_MARKER = "# BEGIN STARCLUSTER MANAGED BLOCK"
+END_MARKER = "# END STARCLUSTER MANAGED BLOCK"
+
+# Rewrites a file so that its managed block contains the entries in
+# $SC_ENTRIES (one per line) and no line in the file has a key in $SC_REMOVE
+# or the key of one of the entries unless it is that entry. A line's key is
+# made of the whitespace-separated fields listed in $SC_KEYS with anything
+# from the first '(' on stripped (e.g. "/home node001(rw)" -> "/home
+# node001" for fields "1 2"). Existing entries are left in place so applying
+# the same entries twice produces the same file. Comments and blank lines are
+# never removed. The block is written where it was found or appended to the
+# end of the file.
+managed_block_template = r"""
+function key(line,    f, k, i, v) {
+    split(line, f)
+    k = ""
+    for (i = 1; i <= nk; i++) {
+        v = f[cols[i]]
+        sub(/\(.*/, "", v)
+        k = k (i > 1 ? " " : "") v
+    }
+    return k
+}
+BEGIN {
+    begin_marker = "%(begin)s"
+    end_marker = "%(end)s"
+    nk = split(ENVIRON["SC_KEYS"], cols, " ")
+    n = split(ENVIRON["SC_ENTRIES"], entries, "\n")
+    m = split(ENVIRON["SC_REMOVE"], remove, "\n")
+    for (i = 1; i <= m; i++)
+        if (remove[i] != "")
+            drop[remove[i]] = 1
+    for (i = 1; i <= n; i++)
+        if (entries[i] != "") {
+            want[entries[i]] = 1
+            drop[key(entries[i])] = 1
+        }
+}
+$0 == begin_marker {
+    inblock = 1
+    if (!pos)
+        pos = ++count
+    next
+}
+$0 == end_marker {
+    inblock = 0
+    next
+}
+$0 !~ /^[ \t]*(#|$)/ && (key($0) in drop) {
+    if (inblock && ($0 in want) && !($0 in seen)) {
+        seen[$0] = 1
+        block[++nb] = $0
+    }
+    next
+}
+{
+    if (inblock)
+        block[++nb] = $0
+    else
+        lines[++count] = $0
+}
+END {
+    for (i = 1; i <= n; i++)
+        if (entries[i] != "" && !(entries[i] in seen)) {
+            seen[entries[i]] = 1
+            block[++nb] = entries[i]
+        }
+    if (!pos)
+        pos = ++count
+    for (i = 1; i <= count; i++) {
+        if (i != pos) {
+            print lines[i]
+        } else if (nb) {
+            print begin_marker
+            for (j = 1; j <= nb; j++)
+                print block[j]
+            print end_marker
+        }
+    }
+}
+""" % dict(begin=BEGIN_MARKER, end=END_MARKER)
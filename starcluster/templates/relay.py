@@ -0,0 +1,48 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs a command on a list of nodes from the master. Each node's output is
+# followed by a line containing the marker, the node's alias, the command's
+# exit status and the number of milliseconds it took to run.
+relay_template = """
+d=$(mktemp -d)
+run() {
+    t0=$(date +%%s%%N)
+    if [ "$1" = "%(master)s" ]; then
+        bash -c %(command)s > $d/$1.out 2>&1 < /dev/null
+    else
+        ssh -o BatchMode=yes -o StrictHostKeyChecking=no \\
+            -o ConnectTimeout=30 $1 %(command)s > $d/$1.out 2>&1 < /dev/null
+    fi
+    s=$?
+    echo "$s $(( ($(date +%%s%%N) - t0) / 1000000 ))" > $d/$1.status
+}
+for n in %(aliases)s; do
+    # start the next node as soon as any running one finishes (wait -n needs
+    # bash >= 4.3, older shells poll instead)
+    while [ $(jobs -rp | wc -l) -ge %(fanout)d ]; do
+        wait -n 2> /dev/null || sleep 0.1
+    done
+    run $n &
+done
+wait
+for n in %(aliases)s; do
+    cat $d/$n.out
+    echo "%(marker)s $n $(cat $d/$n.status)"
+done
+rm -rf $d
+"""
@@ -0,0 +1,104 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+from starcluster import awsutils
+
+THROTTLED = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             '</Error></Errors></Response>')
+
+
+class FakeResponse(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeRequest(object):
+    def __init__(self, action):
+        self.params = dict(Action=action)
+
+
+class FakeConnection(object):
+    num_retries = 5
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        i = 0
+        while i <= self.num_retries:
+            response = self.responses.pop(0)
+            if retry_handler:
+                status = retry_handler(response, i, 0)
+                if status:
+                    i = status[1]
+                    continue
+            return response
+
+
+def test_token_bucket():
+    bucket = awsutils.TokenBucket(rate=50, burst=5)
+    start = time.time()
+    for i in range(10):
+        bucket.acquire()
+    # 5 tokens from the burst + 5 more at 50/sec
+    assert 0.05 < time.time() - start < 0.5
+    bucket.throttled(0)
+    assert bucket.rate == 25
+    bucket.succeeded()
+    assert bucket.rate > 25
+
+
+def test_rate_limiter_throttling():
+    limiter = awsutils.EC2RateLimiter(backoff=0.01, max_backoff=0.01)
+    responses = [FakeResponse(503, THROTTLED), FakeResponse(503, THROTTLED),
+                 FakeResponse(200, 'ok')]
+    conn = limiter.wrap(FakeConnection(responses))
+    response = conn._mexe(FakeRequest('DescribeInstances'))
+    assert response.read() == 'ok'
+    assert limiter.calls == {'DescribeInstances': 1}
+    assert limiter.throttles == {'DescribeInstances': 2}
+    describe = limiter.get_bucket('DescribeInstances')
+    assert describe.rate < describe.max_rate
+    mutate = limiter.get_bucket('RunInstances')
+    assert mutate is not describe
+    assert mutate.rate == mutate.max_rate
+
+
+def test_rate_limiter_concurrent_throttling():
+    limiter = awsutils.EC2RateLimiter(backoff=0.01, max_backoff=0.01)
+    limiter.get_bucket('DescribeInstances').throttled = lambda delay: None
+
+    def throttle():
+        for i in range(500):
+            limiter.throttled('DescribeInstances')
+    threads = [threading.Thread(target=throttle) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert limiter.throttles == {'DescribeInstances': 4000}
+    assert limiter._num_throttled == 4000
+    limiter.succeeded('DescribeInstances')
+    assert limiter._num_throttled == 0
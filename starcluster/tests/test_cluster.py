@@ -0,0 +1,525 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import stat
+import shutil
+import tempfile
+
+from boto.ec2.instance import Instance
+from boto.ec2.connection import EC2Connection
+
+from starcluster import sshutils
+from starcluster import exception
+from starcluster import clustersetup
+from starcluster.node import Node
+from starcluster.cluster import Cluster
+
+
+class FakeEC2(object):
+    """
+    Stand-in for EasyEC2 that returns a fixed list of instances and counts
+    the number of describe requests
+    """
+    def __init__(self, aliases):
+        conn = EC2Connection('id', 'secret')
+        self.instances = []
+        for i, alias in enumerate(aliases):
+            inst = Instance(conn)
+            inst.id = 'i-%08d' % i
+            inst.tags = dict(alias=alias, Name=alias)
+            inst._state.name = 'running'
+            inst.dns_name = '%s.example.com' % alias
+            inst.ip_address = '54.0.0.%d' % i
+            inst.private_ip_address = '10.0.0.%d' % i
+            self.instances.append(inst)
+        self.num_describes = 0
+
+    def get_all_instances(self, filters=None):
+        self.num_describes += 1
+        return self.instances[:]
+
+
+def _get_cluster(aliases, **kwargs):
+    ec2 = FakeEC2(aliases)
+    return Cluster(ec2_conn=ec2, cluster_tag='test', **kwargs), ec2
+
+
+def test_nodes_cache():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'])
+    assert [n.alias for n in cl.nodes] == ['master', 'node001', 'node002']
+    cl.nodes
+    cl.running_nodes
+    assert cl.master_node.alias == 'master'
+    assert ec2.num_describes == 1
+    cl.invalidate()
+    cl.nodes
+    assert ec2.num_describes == 2
+    ec2.instances.pop()
+    assert len(cl.refresh()) == 2
+    assert ec2.num_describes == 3
+    cl, ec2 = _get_cluster(['master'], node_cache_ttl=0)
+    cl.nodes
+    cl.nodes
+    assert ec2.num_describes == 2
+
+
+def test_get_nodes():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'])
+    node = cl.get_node('node001')
+    assert cl.get_node(node.id) is node
+    assert cl.get_node('node001.example.com') is node
+    assert cl.get_node(node.private_ip_address) is node
+    nodes = cl.get_nodes(['node002', 'i-00000002', 'master'])
+    assert [n.alias for n in nodes] == ['node002', 'master']
+    assert ec2.num_describes == 1
+    try:
+        cl.get_node('node001', nodes=[cl.master_node])
+        raise Exception("InstanceDoesNotExist not raised")
+    except exception.InstanceDoesNotExist:
+        pass
+    # nodes are found by their new addresses once their instances are updated
+    ec2.instances[1].ip_address = '54.0.1.1'
+    cl._update_instances(cl.nodes)
+    assert cl.get_node('54.0.1.1') is node
+    ec2.instances.pop()
+    cl.refresh()
+    try:
+        cl.get_node('node002')
+        raise Exception("InstanceDoesNotExist not raised")
+    except exception.InstanceDoesNotExist:
+        pass
+
+
+def test_batch_plugin_hooks():
+    class Plugin(clustersetup.ClusterSetup):
+        added = []
+
+        def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+            self.added.append(node)
+
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'])
+    plugin = Plugin()
+    cl.run_plugin(plugin, method_name='on_add_nodes', node=cl.nodes[1:])
+    assert [n.alias for n in plugin.added] == ['node001', 'node002']
+    # on_remove_node is not implemented so on_remove_nodes is skipped
+    cl.run_plugin(plugin, method_name='on_remove_nodes', node=cl.nodes[1:])
+
+    class DuckTypedPlugin(object):
+        removed = []
+
+        def on_remove_node(self, node, nodes, master, user, user_shell,
+                           volumes):
+            self.removed.append(node)
+
+    # plugins that only define the per-node hooks still run
+    plugin = DuckTypedPlugin()
+    cl.run_plugin(plugin, method_name='on_remove_nodes', node=cl.nodes[1:])
+    assert [n.alias for n in plugin.removed] == ['node001', 'node002']
+    cl.run_plugin(plugin, method_name='on_add_nodes', node=cl.nodes[1:])
+
+    class DefaultPlugin(clustersetup.DefaultClusterSetup):
+        added = []
+
+        def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+            self.added.append(node)
+
+        def _add_nodes(self, *args):
+            raise Exception("default node setup should not run")
+
+    # DefaultClusterSetup subclasses keep their per-node hooks
+    plugin = DefaultPlugin()
+    cl.run_plugin(plugin, method_name='on_add_nodes', node=cl.nodes[1:])
+    assert [n.alias for n in plugin.added] == ['node001', 'node002']
+
+
+def test_stream_setup():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002', 'node003'],
+                           stream_setup=True, refresh_interval=0.05,
+                           launch_timeout=0.2)
+    rounds = []
+    calls = []
+
+    def scan_ssh_banners(addrs, port=22, timeout=5):
+        rounds.append(sorted(addrs))
+        # node002 comes up in the second round and node003 never does
+        up = ['master', 'node001']
+        if len(rounds) > 1:
+            up.append('node002')
+        return set(['%s.example.com' % alias for alias in up])
+
+    def run_plugins(method_name='run', node=None, nodes=None):
+        calls.append((method_name, [n.alias for n in node or []],
+                      [n.alias for n in nodes]))
+
+    cl.run_plugins = run_plugins
+    cl._get_pending_spot_requests = lambda nodes: []
+    scan = sshutils.scan_ssh_banners
+    sshutils.scan_ssh_banners = scan_ssh_banners
+    Node.is_ssh_up, node_is_ssh_up = lambda node: True, Node.is_ssh_up
+    try:
+        cl.setup_cluster()
+        assert calls == [
+            ('run', [], ['master', 'node001']),
+            ('on_add_nodes', ['node002'], ['master', 'node001', 'node002'])]
+        # one describe request per round for all nodes
+        assert ec2.num_describes == len(rounds)
+        assert rounds[1] == ['node002.example.com', 'node003.example.com']
+        # the master must come up in time
+        sshutils.scan_ssh_banners = lambda addrs, port=22, timeout=5: set()
+        # even if its instance never shows up
+        for aliases in (['master', 'node001'], ['node001']):
+            cl, ec2 = _get_cluster(aliases, stream_setup=True,
+                                   refresh_interval=0.05, launch_timeout=0.1)
+            cl.run_plugins = run_plugins
+            try:
+                cl.setup_cluster()
+                raise Exception("NodeTimeout not raised")
+            except exception.NodeTimeout, e:
+                assert e.alias == 'master'
+    finally:
+        sshutils.scan_ssh_banners = scan
+        Node.is_ssh_up = node_is_ssh_up
+
+
+def _record_node_calls(names, calls, results={}):
+    """
+    Replace each Node method in names with a stub that appends (name, alias,
+    args...) to calls and returns results.get(name). Node and list arguments
+    are recorded by alias. Returns the original methods.
+    """
+    def record(name):
+        def method(self, *args, **kwargs):
+            calls.append((name, self.alias) + tuple(
+                [n.alias for n in arg] if type(arg) is list else
+                getattr(arg, 'alias', arg) for arg in args))
+            return results.get(name)
+        return method
+    orig = dict([(name, getattr(Node, name)) for name in names])
+    for name in names:
+        setattr(Node, name, record(name))
+    return orig
+
+
+def test_cluster_dns():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002', 'node003'])
+    master, nodes = cl.master_node, cl.nodes
+    calls = []
+    names = ['add_to_etc_hosts', 'remove_from_etc_hosts', 'start_dns_server',
+             'reload_dns_server', 'use_dns_server']
+    orig = _record_node_calls(names, calls)
+    try:
+        plugin = clustersetup.DefaultClusterSetup(disable_threads=True,
+                                                  cluster_dns=True)
+        plugin._nodes, plugin._master = nodes[:3], master
+        plugin._volumes = {}
+        plugin._setup_etc_hosts()
+        assert sorted(calls) == sorted([
+            ('add_to_etc_hosts', 'master', ['master', 'node001', 'node002']),
+            ('start_dns_server', 'master'),
+            ('add_to_etc_hosts', 'node001', ['master', 'node001']),
+            ('use_dns_server', 'node001', 'master'),
+            ('add_to_etc_hosts', 'node002', ['master', 'node002']),
+            ('use_dns_server', 'node002', 'master')])
+        # only the master and the new node are touched when adding a node
+        del calls[:]
+        plugin._setup_etc_hosts(nodes, new_nodes=nodes[3:])
+        assert sorted(calls) == sorted([
+            ('add_to_etc_hosts', 'master', ['node003']),
+            ('reload_dns_server', 'master'),
+            ('add_to_etc_hosts', 'node003', ['master', 'node003']),
+            ('use_dns_server', 'node003', 'master')])
+        del calls[:]
+        plugin._remove_from_etc_hosts(nodes[1:2])
+        assert calls == [('remove_from_etc_hosts', 'master', ['node001']),
+                         ('reload_dns_server', 'master')]
+    finally:
+        for name in names:
+            setattr(Node, name, orig[name])
+    graph = plugin._get_setup_graph()
+    assert 'dns-server' in graph._jobs['etc-hosts:node001'][3]
+
+
+def test_host_key_ca():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'])
+    master, nodes = cl.master_node, cl.nodes
+    calls = []
+    names = ['generate_host_ca', 'get_host_keys', 'sign_host_keys',
+             'install_host_certificates', 'generate_key_for_user',
+             'copy_ssh_files_to_nodes', 'add_to_known_hosts']
+    results = dict(generate_host_ca='ssh-rsa CA', get_host_keys='keys',
+                   sign_host_keys='certs')
+    orig = _record_node_calls(names, calls, results)
+    try:
+        plugin = clustersetup.DefaultClusterSetup(disable_threads=True,
+                                                  host_key_ca=True,
+                                                  setup_timeout=600)
+        plugin._nodes, plugin._master = nodes, master
+        plugin._user, plugin._volumes = 'sgeadmin', {}
+        # adding nodes only signs the new nodes' host keys and never touches
+        # known_hosts
+        plugin._setup_passwordless_ssh(nodes=nodes[2:])
+        assert ('add_to_known_hosts', 'master', 'sgeadmin',
+                ['node002']) not in calls
+        assert sorted([c for c in calls if 'host' in c[0]]) == [
+            ('generate_host_ca', 'master'),
+            ('get_host_keys', 'node002'),
+            ('install_host_certificates', 'node002', 'certs', 'ssh-rsa CA'),
+            ('sign_host_keys', 'master', 'node002', 'keys')]
+        assert ('copy_ssh_files_to_nodes', 'master', 'root',
+                ['node002']) in calls
+    finally:
+        for name in names:
+            setattr(Node, name, orig[name])
+    graph = plugin._get_setup_graph()
+    assert 'root-known-hosts' not in graph._jobs
+    assert 'user-known-hosts' not in graph._jobs
+    assert graph._jobs['root-ssh:node001'][2] == dict(known_hosts=False)
+    for node in nodes:
+        assert graph._jobs['host-cert:' + node.alias][3] == ['host-ca']
+    # every setup step has a deadline so a hung node can't stall setup
+    assert set([job[4] for job in graph._jobs.values()]) == set([600])
+    assert cl._default_plugin._setup_timeout == 1800
+
+
+def test_wait_for_ssh():
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'], cluster_size=3,
+                           refresh_interval=0.01)
+    rounds = []
+
+    def scan_ssh_banners(addrs, port=22, timeout=5):
+        rounds.append(sorted(addrs))
+        # node002's sshd comes up in the third round
+        return set(a for a in addrs
+                   if len(rounds) > 2 or not a.startswith('node002'))
+
+    handshakes = []
+
+    def is_ssh_up(node):
+        handshakes.append(node.alias)
+        return True
+    scan = sshutils.scan_ssh_banners
+    sshutils.scan_ssh_banners = scan_ssh_banners
+    Node.is_ssh_up, node_is_ssh_up = is_ssh_up, Node.is_ssh_up
+    try:
+        nodes = cl.nodes
+        ec2.num_describes = 0
+        cl.wait_for_ssh(nodes)
+    finally:
+        sshutils.scan_ssh_banners = scan
+        Node.is_ssh_up = node_is_ssh_up
+    addrs = ['master.example.com', 'node001.example.com',
+             'node002.example.com']
+    assert rounds == [addrs, addrs[2:], addrs[2:]]
+    # one describe per round and one handshake per node
+    assert ec2.num_describes == 3
+    assert sorted(handshakes) == ['master', 'node001', 'node002']
+
+
+def test_node_facts():
+    from starcluster import node
+    from starcluster import static
+    from starcluster.tests.test_sshutils import _get_client
+    cl, ec2 = _get_cluster(['master', 'node001'])
+    tmpdir = tempfile.mkdtemp()
+    facts_dir = static.NODE_FACTS_DIR
+    static.NODE_FACTS_DIR = os.path.join(tmpdir, 'facts')
+    try:
+        master = cl.nodes[0]
+        master._ssh = _get_client()
+        facts = master.gather_facts()
+        assert facts['num_processors'] >= 1
+        assert facts['memory'] > 0
+        assert isinstance(facts['mounts'], dict)
+        assert master.num_processors == facts['num_processors']
+        assert sorted(master.facts) == sorted(node.STATIC_FACTS)
+        # the facts are cached per instance id in memory and on disk
+        master._ssh = None
+        node._facts_cache.clear()
+        new_master = Node(master.instance, None)
+        assert new_master.memory == facts['memory']
+        key = '%s.%s' % (master.id, master.instance_type)
+        assert os.listdir(static.NODE_FACTS_DIR) == [key]
+        # the instance was restarted as a different instance type
+        master.instance.instance_type = 'c3.8xlarge'
+        assert node._get_cached_facts(master._facts_key) is None
+    finally:
+        static.NODE_FACTS_DIR = facts_dir
+        node._facts_cache.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_nss_cache():
+    from starcluster.tests.test_sshutils import _get_client
+    from starcluster.tests.test_transfer import LocalSFTP
+    opened = []
+
+    class SFTP(LocalSFTP):
+        def open(self, path, mode):
+            opened.append(path)
+            return LocalSFTP.open(self, path, mode)
+    cl, ec2 = _get_cluster(['master'])
+    master = cl.nodes[0]
+    master._ssh = _get_client()
+    master._ssh._sftp = SFTP()
+    root = master.getpwnam('root')
+    assert root.pw_uid == 0 and root.pw_dir
+    assert master.getpwuid(0) == root
+    assert master.get_user_map(key_by_uid=True)[0] == root
+    assert master.getgrgid(0).gr_name == master.getgrnam('root').gr_name
+    assert master.getpwnam('no-such-user') is None
+    # each file is only downloaded once
+    assert sorted(opened) == ['/etc/group', '/etc/passwd']
+    master.invalidate_nss_cache()
+    assert master.getpwnam('root') == root
+    assert opened[-1] == '/etc/passwd' and len(opened) == 3
+
+
+def test_execute_all():
+    from starcluster.tests.test_sshutils import _get_client
+    cl, ec2 = _get_cluster(['master', 'node001', 'node002'])
+    for node in cl.nodes:
+        node._ssh = _get_client()
+    cmd = 'echo hello; printf world; [ -n "$FAIL" ] && exit 3'
+    results = cl.execute_all(cmd, source_profile=False)
+    assert sorted(results) == ['master', 'node001', 'node002']
+    for output, status, secs in results.values():
+        assert output == ['hello', 'world']
+        assert status == 1
+        assert secs >= 0
+    # the master runs the command itself and fails to ssh to node001
+    # (which does not resolve)
+    results = cl.execute_all('FAIL=1; ' + cmd, nodes=cl.nodes[:2],
+                             relay=True, source_profile=False)
+    assert results['master'][:2] == (['hello', 'world'], 3)
+    assert results['node001'][1] != 0
+    # commands run as another user switch back to the original user after
+    switched = []
+    for node in cl.nodes:
+        node.ssh.switch_user = lambda user, alias=node.alias: \
+            switched.append((alias, user))
+    cl.execute_all('true', user='bob', source_profile=False)
+    assert sorted(switched) == [('master', 'bob'), ('master', 'root'),
+                                ('node001', 'bob'), ('node001', 'root'),
+                                ('node002', 'bob'), ('node002', 'root')]
+    del switched[:]
+    cl.execute_all('true', nodes=cl.nodes[:1], user='bob', relay=True,
+                   source_profile=False)
+    assert switched == [('master', 'bob'), ('master', 'root')]
+
+    # nodes whose status line is missing or truncated are reported as failed
+    def execute(script, **kwargs):
+        marker = re.search(r'__starcluster_node_\w+__', script).group(0)
+        return ['a', '%s master 0 5' % marker, 'b', '%s node001' % marker,
+                'c%s node002 1' % marker]
+    cl.master_node.ssh.execute = execute
+    results = cl.execute_all('true', relay=True)
+    assert results['master'] == (['a'], 0, 0.005)
+    assert results['node001'][:2] == (['b'], -1)
+    assert results['node002'][:2] == (['c'], -1)
+
+
+def test_relay_fanout():
+    import pipes
+    import subprocess
+    from starcluster.templates import relay
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fake_ssh = os.path.join(tmpdir, 'ssh')
+        with open(fake_ssh, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'H=${@:(-2):1} exec bash -c "${@:(-1)}"\n')
+        os.chmod(fake_ssh, 0755)
+        # node001 only finishes once node003 has run, which never happens if
+        # each batch of two has to finish before the next one starts
+        cmd = ('if [ $H = node001 ]; then for i in $(seq 50); do '
+               '[ -e %s/node003 ] && exit 0; sleep 0.1; done; exit 1; '
+               'else touch %s/$H; fi' % (tmpdir, tmpdir))
+        script = relay.relay_template % dict(
+            command=pipes.quote(cmd), master='master', fanout=2,
+            aliases='node001 node002 node003', marker='MARK')
+        env = dict(os.environ, PATH=tmpdir + os.pathsep + os.environ['PATH'])
+        proc = subprocess.Popen(['bash', '-c', script], env=env,
+                                stdout=subprocess.PIPE)
+        lines = proc.communicate()[0].splitlines()
+        assert [l.split()[:3] for l in lines] == [
+            ['MARK', 'node001', '0'], ['MARK', 'node002', '0'],
+            ['MARK', 'node003', '0']]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_copy_remote_file_to_nodes():
+    from starcluster.tests.test_sshutils import _get_client
+    from starcluster.tests.test_transfer import LocalSFTP
+    aliases = ['master'] + ['node%03d' % i for i in range(1, 7)]
+    cl, ec2 = _get_cluster(aliases)
+    for node in cl.nodes:
+        node._ssh = _get_client()
+        node._ssh._sftp = LocalSFTP()
+    tmpdir = tempfile.mkdtemp()
+    path = os.environ['PATH']
+    try:
+        # fake ssh that runs the command in a directory named after the host
+        # and refuses connections to node005
+        bindir = os.path.join(tmpdir, 'bin')
+        os.mkdir(bindir)
+        fake_ssh = os.path.join(bindir, 'ssh')
+        with open(fake_ssh, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'host=${@:(-2):1}\n'
+                    '[ $host = node005 ] && exit 255\n'
+                    'mkdir -p %s/$host && cd %s/$host && '
+                    'exec bash -c "${@:(-1)}"\n' % (tmpdir, tmpdir))
+        os.chmod(fake_ssh, 0755)
+        os.environ['PATH'] = bindir + os.pathsep + path
+        src = os.path.join(tmpdir, 'src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(100000))
+        os.chmod(src, 0640)
+        master = cl.master_node
+        sts = os.stat(src)
+        done = master._broadcast_file(src, 'dest', cl.nodes[1:], 0640,
+                                      sts.st_uid, sts.st_gid)
+        # node005 is a leaf of the tree (fanout=2) so only it is missed
+        assert done == set(aliases[1:]) - set(['node005'])
+        for alias in done:
+            dest = os.path.join(tmpdir, alias, 'dest')
+            assert open(dest, 'rb').read() == open(src, 'rb').read()
+            assert stat.S_IMODE(os.stat(dest).st_mode) == 0640
+        assert not os.listdir(os.path.join(tmpdir, 'node001'))[1:]
+        # only broadcast to more than fanout nodes once passwordless ssh to
+        # them is known to work
+        broadcasts = []
+
+        def broadcast_file(remote_file, dest, nodes, *args, **kwargs):
+            broadcasts.append([n.alias for n in nodes])
+            return set([n.alias for n in nodes])
+        master._broadcast_file = broadcast_file
+        copy = os.path.join(tmpdir, 'copy')
+        master.copy_remote_file_to_nodes(src, cl.nodes[1:], dest=copy)
+        assert open(copy, 'rb').read() == open(src, 'rb').read()
+        assert broadcasts == []
+        master._ssh_trusted['root'] = set(aliases)
+        master.copy_remote_file_to_nodes(src, cl.nodes[1:3], dest=copy)
+        assert broadcasts == []
+        master.copy_remote_file_to_nodes(src, cl.nodes, dest=copy)
+        assert broadcasts == [aliases]
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(tmpdir)
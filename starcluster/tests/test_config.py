@@ -128,6 +128,8 @@ class TestStarClusterConfig(tests.StarClusterTest):
         assert 'c1' in self.config.clusters
         assert 'c2' in self.config.clusters
         assert 'c3' in self.config.clusters
+        assert self.config.get_cluster_template('c1').node_cache_ttl == 10
+        assert self.config.get_cluster_template('c1').launch_timeout == 3600
 
     def test_extends(self):
         c1 = self.config.clusters.get('c1')
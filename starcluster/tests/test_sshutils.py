@@ -0,0 +1,377 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import paramiko
+
+from starcluster import static
+from starcluster import sshutils
+from starcluster import sshbroker
+from starcluster import exception
+
+
+class LocalChannel(object):
+    """
+    Fake paramiko channel that runs commands with the local shell
+    """
+    proc = None
+
+    def exec_command(self, command):
+        self.proc = subprocess.Popen(['bash', '-c', command],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def makefile(self, mode, bufsize):
+        return self.proc.stdout
+
+    def makefile_stderr(self, mode, bufsize):
+        return self.proc.stderr
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        pass
+
+
+class LocalTransport(object):
+    def is_active(self):
+        return True
+
+    def open_session(self):
+        return LocalChannel()
+
+    def get_username(self):
+        return 'root'
+
+    def close(self):
+        pass
+
+
+def _get_client():
+    ssh = sshutils.SSHClient('localhost', username='root', password='secret')
+    ssh._transport = LocalTransport()
+    return ssh
+
+
+def test_execute_many():
+    ssh = _get_client()
+    results = ssh.execute_many(['echo one; echo two', 'printf three',
+                                'cd /; echo $PWD >&2', 'pwd'],
+                               source_profile=False)
+    assert results == [(['one', 'two'], 0), (['three'], 0), (['/'], 0),
+                       ([results[3][0][0]], 0)]
+    assert results[3][0][0] != '/'
+    try:
+        ssh.execute_many(['true', 'echo fail; false', 'echo skipped'],
+                         source_profile=False)
+        raise Exception("RemoteCommandFailed not raised")
+    except exception.RemoteCommandFailed, e:
+        assert e.exit_status == 1
+        assert e.output == 'fail'
+    results = ssh.execute_many(['false', 'echo ok'], source_profile=False,
+                               ignore_exit_status=True, stop_on_failure=False)
+    assert results == [([], 1), (['ok'], 0)]
+    assert ssh.get_last_status() == 0
+    # only the first MAX_LOGGED_OUTPUT bytes of the output are logged
+    nbytes = sshutils.MAX_LOGGED_OUTPUT * 2
+    try:
+        ssh.execute_many(['head -c %d /dev/zero | tr "\\0" "x"; exit 1' %
+                          nbytes], source_profile=False)
+        raise Exception("RemoteCommandFailed not raised")
+    except exception.RemoteCommandFailed, e:
+        assert len(e.output) == nbytes
+        assert len(e.msg) < sshutils.MAX_LOGGED_OUTPUT + 200
+
+
+def test_execute_iter():
+    ssh = _get_client()
+    cmd = 'echo one; echo error >&2; sleep 0.1; printf two'
+    lines = ssh.execute_iter(cmd, source_profile=False)
+    assert lines.next() == 'one'
+    assert list(lines) == ['two']
+    lines = ssh.execute_iter('seq 3; echo boom >&2; exit 2',
+                             source_profile=False)
+    try:
+        for line in lines:
+            pass
+        raise Exception("RemoteCommandFailed not raised")
+    except exception.RemoteCommandFailed, e:
+        assert e.exit_status == 2
+        assert e.output == '1\n2\n3\nboom'
+    nbytes = sshutils.MAX_LOGGED_OUTPUT * 2
+    lines = ssh.execute_iter('head -c %d /dev/zero | tr "\\0" "x"; exit 1' %
+                             nbytes, source_profile=False,
+                             ignore_exit_status=True)
+    assert len(''.join(lines)) == nbytes
+
+
+def test_batched_stat_and_glob():
+    from starcluster.tests.test_transfer import LocalSFTP
+    ssh = _get_client()
+    ssh._sftp = LocalSFTP()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for d in ['a', 'b', 'c', 'c/d', 'e']:
+            os.mkdir(os.path.join(tmpdir, d))
+        for f in ['a/f1', 'a/g1', 'b/f2', 'c/f3', 'c/.f4', 'x y']:
+            open(os.path.join(tmpdir, f), 'w').close()
+        os.symlink('missing', os.path.join(tmpdir, 'b', 'broken'))
+        paths = [os.path.join(tmpdir, p)
+                 for p in ['a', 'a/f1', 'x y', 'nope', 'b/broken']]
+        attrs = ssh.stat_many(paths)
+        assert sorted(attrs) == sorted(paths[:3])
+        assert stat.S_ISDIR(attrs[paths[0]].st_mode)
+        assert stat.S_ISREG(attrs[paths[1]].st_mode)
+        assert attrs[paths[1]].st_uid == os.getuid()
+        assert paths[4] in ssh.stat_many(paths, lstat=True)
+        dirs = [os.path.join(tmpdir, p) for p in ['a', 'c', 'e', 'x y']]
+        entries = ssh.ls_many(dirs)
+        assert sorted(entries) == sorted(dirs[:3])
+        assert sorted(entries[dirs[1]]) == ['.f4', 'd', 'f3']
+        assert entries[dirs[2]] == []
+
+        def glob(pattern):
+            return sorted(p[len(tmpdir) + 1:]
+                          for p in ssh.glob(os.path.join(tmpdir, pattern)))
+        assert glob('*/f*') == ['a/f1', 'b/f2', 'c/f3']
+        assert glob('*/') == ['a/', 'b/', 'c/', 'e/']
+        assert glob('*/broken') == ['b/broken']
+        assert glob('[ab]/?1') == ['a/f1', 'a/g1']
+        assert glob('c/.*') == ['c/.f4']
+        assert glob('x *') == ['x y']
+        assert glob('*/nope') == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_update_file_entries():
+    ssh = _get_client()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        exports = os.path.join(tmpdir, 'exports')
+        with open(exports, 'w') as f:
+            f.write('# comment\n/home node001(ro)\n/opt node0010(rw)\n')
+        os.chmod(exports, 0640)
+        entries = ['/home node001(rw)', '/home node002(rw)']
+        assert ssh.update_file_entries(exports, entries, key_fields=(1, 2))
+        managed = ['# BEGIN STARCLUSTER MANAGED BLOCK'] + entries + \
+            ['# END STARCLUSTER MANAGED BLOCK']
+        assert open(exports).read().splitlines() == \
+            ['# comment', '/opt node0010(rw)'] + managed
+        assert stat.S_IMODE(os.stat(exports).st_mode) == 0640
+        # applying the same entries again doesn't touch the file
+        os.utime(exports, (0, 0))
+        assert not ssh.update_file_entries(exports, entries[::-1],
+                                           key_fields=(1, 2))
+        assert os.stat(exports).st_mtime == 0
+        assert ssh.update_file_entries(exports, remove=[('node001',)],
+                                       key_fields=(2,))
+        assert open(exports).read().splitlines() == \
+            ['# comment', '/opt node0010(rw)'] + managed[:1] + \
+            entries[1:] + managed[-1:]
+        # missing files are created
+        fstab = os.path.join(tmpdir, 'fstab')
+        assert ssh.update_file_entries(fstab, ["it's /mnt auto 0 0"],
+                                       key_fields=(2,))
+        assert "it's /mnt auto 0 0\n" in open(fstab).read()
+        assert not [name for name in os.listdir(tmpdir) if '.' in name]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class LocalServer(paramiko.ServerInterface):
+    """
+    Minimal SSH server that accepts any key and runs exec requests with the
+    local shell
+    """
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._run, args=(channel, command)).start()
+        return True
+
+    def _run(self, channel, command):
+        proc = subprocess.Popen(['bash', '-c', command],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        channel.sendall(out)
+        channel.sendall_stderr(err)
+        channel.send_exit_status(proc.returncode)
+        channel.close()
+
+
+def _start_ssh_server():
+    host_key = paramiko.RSAKey.generate(1024)
+    lsock = socket.socket()
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(5)
+    connections = []
+
+    def accept():
+        while True:
+            sock, addr = lsock.accept()
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            paramiko.SFTPServerInterface)
+            try:
+                transport.start_server(server=LocalServer())
+            except (paramiko.SSHException, EOFError, socket.error):
+                # e.g. scan_ssh_banners hangs up after reading the banner
+                continue
+            connections.append(transport)
+    server = threading.Thread(target=accept)
+    server.daemon = True
+    server.start()
+    return lsock.getsockname()[1], connections
+
+
+def test_ssh_broker():
+    port, connections = _start_ssh_server()
+    tmpdir = tempfile.mkdtemp()
+    key = os.path.join(tmpdir, 'id_rsa')
+    paramiko.RSAKey.generate(1024).write_private_key_file(key)
+    orig_socket = static.SSH_BROKER_SOCKET
+    static.SSH_BROKER_SOCKET = os.path.join(tmpdir, 'broker.sock')
+    broker = sshbroker.SSHBroker()
+    server = threading.Thread(target=broker.serve_forever)
+    server.daemon = True
+    server.start()
+    try:
+        for i in range(3):
+            ssh = sshutils.SSHClient('127.0.0.1', username='root',
+                                     private_key=key, port=port,
+                                     use_broker=True)
+            cmd = 'echo one; echo two >&2; printf three'
+            assert ssh.execute(cmd, source_profile=False) == ['one', 'three',
+                                                              'two']
+            assert list(ssh.execute_iter('seq 2', source_profile=False)) == \
+                ['1', '2']
+            assert ssh.get_status('exit 3', source_profile=False) == 3
+            assert isinstance(ssh.transport, sshbroker.BrokerTransport)
+            ssh.close()
+        # all three clients shared the broker's transport
+        assert len(connections) == 1
+        try:
+            bad = sshutils.SSHClient('127.0.0.1', username='root',
+                                     private_key=key, port=1,
+                                     use_broker=True)
+            bad.connect()
+            raise Exception("SSHConnectionError not raised")
+        except exception.SSHConnectionError:
+            pass
+        broker.idle_timeout = -1
+        # the broker notices closed channels asynchronously
+        for i in range(50):
+            broker.expire()
+            if not connections[0].is_active():
+                break
+            time.sleep(0.1)
+        assert not connections[0].is_active()
+        ssh = sshutils.SSHClient('127.0.0.1', username='root',
+                                 private_key=key, port=port, use_broker=True)
+        assert ssh.execute('echo ok', source_profile=False) == ['ok']
+        assert len(connections) == 2
+    finally:
+        sshbroker.stop_broker()
+        server.join(10)
+        static.SSH_BROKER_SOCKET = orig_socket
+    assert not os.path.exists(os.path.join(tmpdir, 'broker.sock'))
+    # the last client outlived the broker and falls back to a direct
+    # connection without failing the command
+    assert ssh.execute('echo ok', source_profile=False) == ['ok']
+    assert isinstance(ssh.transport, paramiko.Transport)
+    assert len(connections) == 3
+    ssh.close()
+
+
+def test_key_caches():
+    port, connections = _start_ssh_server()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        key = os.path.join(tmpdir, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(key)
+        clients = [sshutils.SSHClient('127.0.0.1', username='root',
+                                      private_key=key, port=port,
+                                      use_broker=False) for i in range(3)]
+        # the key file is parsed once and shared by all clients
+        assert clients[0]._pkey is clients[1]._pkey is clients[2]._pkey
+        clients[0].execute('true', source_profile=False)
+        assert len(connections) == 1
+        host_key = clients[0].get_server_public_key()
+        # other clients get the host key without connecting
+        assert clients[1].get_server_public_key() == host_key
+        assert len(connections) == 1
+        # modifying the key file invalidates the cached key
+        os.utime(key, (0, 0))
+        ssh = sshutils.SSHClient('127.0.0.1', username='root',
+                                 private_key=key, port=port, use_broker=False)
+        assert ssh._pkey is not clients[0]._pkey
+        assert ssh._pkey == clients[0]._pkey
+        for client in clients:
+            client.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_scan_ssh_banners():
+    port, connections = _start_ssh_server()
+    # a port that accepts connections but never sends an SSH banner
+    lsock = socket.socket()
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(5)
+    silent_port = lsock.getsockname()[1]
+    # a port that refuses connections
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    try:
+        assert sshutils.scan_ssh_banners(['127.0.0.1'], port=port) == \
+            set(['127.0.0.1'])
+        assert sshutils.scan_ssh_banners(['127.0.0.1'], port=silent_port,
+                                         timeout=0.5) == set()
+        assert sshutils.scan_ssh_banners(['127.0.0.1'],
+                                         port=closed_port) == set()
+        assert sshutils.scan_ssh_banners(['no.such.host.invalid']) == set()
+        # works with file descriptors >= FD_SETSIZE
+        fds = [os.open(os.devnull, os.O_RDONLY) for i in range(1100)]
+        try:
+            assert sshutils.scan_ssh_banners(['127.0.0.1'], port=port) == \
+                set(['127.0.0.1'])
+        finally:
+            for fd in fds:
+                os.close(fd)
+    finally:
+        lsock.close()
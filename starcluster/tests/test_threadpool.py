@@ -15,8 +15,10 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import logging
 import tempfile
+import threading
 logging.disable(logging.WARN)
 
 from starcluster import tests
@@ -137,3 +139,188 @@ class TestThreadPool(tests.StarClusterTest):
         except exception.ThreadPoolException, e:
             assert len(e.exceptions) == r
             assert self.pool._exception_queue.qsize() == 0
+
+    def test_wait_does_not_poll(self):
+        start = time.time()
+        for i in range(self._jobs):
+            self.pool.simple_job(self._no_args, jobid=i)
+        self.pool.wait(numtasks=self._jobs, return_results=False)
+        assert time.time() - start < 1
+
+    def test_map_is_ordered(self):
+        r = 20
+        ref = map(lambda x: x ** 2, range(r))
+        calc = self.pool.map(lambda x: time.sleep(0.001 * (r - x)) or x ** 2,
+                             range(r))
+        assert ref == calc
+
+    def test_submit(self):
+        futures = [self.pool.submit(self._args_and_kwargs, i,
+                                    kwargs=dict(mykw=self._mykw), jobid=i)
+                   for i in range(self._jobs)]
+        for i, f in enumerate(futures):
+            assert f.jobid == i
+            assert f.result() == (i, dict(mykw=self._mykw))
+            assert f.done()
+        # results from submit must not leak into the shared results queue
+        assert self.pool.get_results() == []
+        f = self.pool.submit(lambda x: x ** 2, '2', jobid='bad')
+        try:
+            f.result()
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            exc, tb_msg, jobid = e.exceptions[0]
+            assert jobid == 'bad'
+        assert self.pool._exception_queue.qsize() == 0
+
+    def test_imap_unordered(self):
+        r = 20
+        results = dict(self.pool.imap_unordered(lambda x: x ** 2, range(r),
+                                                jobid_fn=lambda x: 'j%d' % x))
+        assert results == dict([('j%d' % i, i ** 2) for i in range(r)])
+        seen = []
+        try:
+            for jobid, result in self.pool.imap_unordered(
+                    lambda x: x ** 2, range(r) + ['21']):
+                seen.append(jobid)
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            assert len(e.exceptions) == 1
+            assert e.exceptions[0][2] == r
+        assert sorted(seen) == range(r)
+
+    def test_job_graph(self):
+        order = []
+        graph = threadpool.JobGraph(self.pool)
+        graph.add_job('a', lambda: time.sleep(0.05) or order.append('a'))
+        graph.add_job('b', lambda: order.append('b') or 'b', deps=['a'])
+        graph.add_job('c', lambda: order.append('c'))
+        graph.add_job('d', lambda: graph.results['b'] * 2, deps=['b', 'c'])
+        results = graph.run()
+        assert order.index('a') < order.index('b')
+        assert results['d'] == 'bb'
+        assert len(results) == len(graph) == 4
+
+    def test_job_graph_failure(self):
+        graph = threadpool.JobGraph(self.pool)
+        graph.add_job('a', lambda x: x ** 2, ('2',))
+        graph.add_job('b', self._args_only, (1,), deps=['a'])
+        graph.add_job('c', self._args_only, (2,), deps=['b'])
+        graph.add_job('d', self._args_only, (3,))
+        try:
+            graph.run()
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            assert [exc[2] for exc in e.exceptions] == ['a']
+        assert graph.results == {'d': 3}
+
+    def test_job_graph_invalid(self):
+        graph = threadpool.JobGraph(self.pool)
+        graph.add_job('a', self._no_args, deps=['b'])
+        graph.add_job('b', self._no_args, deps=['a'])
+        self.assertRaises(ValueError, graph.run)
+        self.assertRaises(ValueError, graph.add_job, 'a', self._no_args)
+        graph = threadpool.JobGraph(self.pool)
+        graph.add_job('a', self._no_args, deps=['missing'])
+        self.assertRaises(ValueError, graph.run)
+
+    def test_job_timeout(self):
+        size = self.pool.size()
+        f = self.pool.submit(time.sleep, 2, jobid='slow', timeout=0.1)
+        try:
+            f.result()
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            exc, tb_msg, jobid = e.exceptions[0]
+            assert isinstance(exc, exception.JobTimeout)
+            assert jobid == 'slow'
+        assert self.pool.size() == size + 1
+        self.pool.simple_job(time.sleep, 2, jobid='slow2', timeout=0.1)
+        start = time.time()
+        try:
+            self.pool.wait(return_results=False)
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            assert e.exceptions[0][2] == 'slow2'
+        assert time.time() - start < 1
+
+    def test_shutdown_after_timeout(self):
+        pool = threadpool.get_thread_pool(2)
+        pool.progress_bar.fd = tempfile.TemporaryFile()
+        pool.simple_job(time.sleep, 3, jobid='stuck', timeout=0.5)
+        self.assertRaises(exception.ThreadPoolException, pool.wait)
+        shutdown = threading.Thread(target=pool.shutdown)
+        shutdown.daemon = True
+        shutdown.start()
+        shutdown.join(2)
+        assert not shutdown.is_alive()
+
+    def test_job_retry(self):
+        attempts = []
+
+        def flaky(fail_with, times):
+            attempts.append(1)
+            if len(attempts) <= times:
+                raise fail_with
+            return len(attempts)
+
+        retry = threadpool.RetryPolicy(tries=3, backoff=0.01)
+        transient = exception.SSHConnectionError('host', 22)
+        f = self.pool.submit(flaky, (transient, 2), retry=retry)
+        assert f.result() == 3
+        attempts[:] = []
+        f = self.pool.submit(flaky, (transient, 3), retry=retry)
+        self.assertRaises(exception.ThreadPoolException, f.result)
+        assert len(attempts) == 3
+        attempts[:] = []
+        f = self.pool.submit(flaky, (ValueError('boom'), 1), retry=retry)
+        self.assertRaises(exception.ThreadPoolException, f.result)
+        assert len(attempts) == 1
+
+    def test_job_cancel(self):
+        pool = threadpool.get_thread_pool(1)
+        pool.progress_bar.fd = tempfile.TemporaryFile()
+        event = threading.Event()
+        running = pool.submit(event.wait, 5)
+        queued = pool.submit(self._args_only, 1, jobid='queued')
+        assert queued.cancel()
+        event.set()
+        assert running.result() in (None, True)
+        assert not running.cancel()
+        try:
+            queued.result()
+            raise Exception("ThreadPoolException not raised")
+        except exception.ThreadPoolException, e:
+            assert isinstance(e.exceptions[0][0], exception.JobCancelled)
+        pool.shutdown()
+
+    def test_pool_size(self):
+        assert threadpool.get_pool_size(3) == (threadpool.MIN_POOL_SIZE,
+                                               threadpool.MIN_POOL_SIZE)
+        assert threadpool.get_pool_size(300) == (threadpool.DEFAULT_POOL_SIZE,
+                                                 threadpool.MAX_POOL_SIZE)
+        pool = threadpool.get_thread_pool(2, max_size=6)
+        pool.progress_bar.fd = tempfile.TemporaryFile()
+        pool.map(time.sleep, [0.6] * 2)
+        assert pool.size() == 2
+        pool.map(time.sleep, [0.6] * 8)
+        assert pool.size() == 6
+        pool.shutdown()
+
+    def test_host_limiter(self):
+        limiter = threadpool.HostLimiter()
+        limiter.set_limit('master', 2)
+        active = []
+        peak = []
+
+        def use_master():
+            with limiter.slot('master'):
+                active.append(1)
+                peak.append(len(active))
+                time.sleep(0.05)
+                active.pop()
+
+        self.pool.map(lambda i: use_master(), range(8))
+        assert max(peak) == 2
+        limiter.set_limit('master', None)
+        assert limiter.get_limit('master') is None
@@ -0,0 +1,258 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import shutil
+import tempfile
+
+import paramiko
+
+from starcluster import transfer
+from starcluster.tests.test_sshutils import _get_client, LocalTransport
+
+
+class LocalSFTPFile(object):
+    def __init__(self, sftp, path, mode):
+        self.sftp = sftp
+        self.f = open(path, mode)
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def read(self):
+        data = self.f.read()
+        self.sftp.read += len(data)
+        return data
+
+    def write(self, data):
+        self.sftp.written += len(data)
+        self.f.write(data)
+
+    def chown(self, uid, gid):
+        os.chown(self.f.name, uid, gid)
+
+    def chmod(self, mode):
+        os.chmod(self.f.name, mode)
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self.f.seek(offset)
+            data = self.f.read(length)
+            self.sftp.read += len(data)
+            yield data
+
+    def readlines(self):
+        return self.f.readlines()
+
+    def close(self):
+        self.f.close()
+
+
+class LocalSFTP(object):
+    """
+    Fake paramiko SFTPClient that operates on the local filesystem
+    """
+    closed = False
+    written = 0
+    read = 0
+
+    @property
+    def sock(self):
+        return self
+
+    def get_channel(self):
+        return self
+
+    def get_transport(self):
+        return LocalTransport()
+
+    def stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError, e:
+            # paramiko raises IOError for missing files
+            raise IOError(e.errno, e.strerror)
+
+    def truncate(self, path, size):
+        f = open(path, 'r+b')
+        f.truncate(size)
+        f.close()
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def utime(self, path, times):
+        os.utime(path, times)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def listdir_attr(self, path):
+        attrs = []
+        for filename in os.listdir(path):
+            attr = paramiko.SFTPAttributes.from_stat(
+                os.stat(os.path.join(path, filename)))
+            attr.filename = filename
+            attrs.append(attr)
+        return attrs
+
+    def open(self, path, mode):
+        return LocalSFTPFile(self, path, mode)
+
+    def close(self):
+        pass
+
+
+def _get_transfer(chunk_size):
+    ssh = _get_client()
+    ssh._sftp = LocalSFTP()
+    # the client's own session comes first followed by the sessions opened by
+    # the transfer (those with their own connection have new_connection set)
+    sessions = [ssh._sftp]
+
+    def open_sftp(new_connection=False):
+        sessions.append(LocalSFTP())
+        sessions[-1].new_connection = new_connection
+        return sessions[-1]
+    ssh.open_sftp = open_sftp
+    xfer = transfer.SFTPTransfer(ssh, chunk_size=chunk_size)
+    return xfer, sessions
+
+
+def _connections(sessions):
+    return len([s for s in sessions[1:] if s.new_connection])
+
+
+def _written(sessions):
+    return sum(s.written for s in sessions)
+
+
+def _read(sessions):
+    return sum(s.read for s in sessions)
+
+
+def test_sftp_transfer():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'sub', 'empty'))
+        big = os.path.join(src, 'sub', 'big')
+        data = os.urandom(5 * 1024 + 123)
+        open(big, 'wb').write(data)
+        open(os.path.join(src, 'small'), 'w').write('small')
+        os.chmod(big, 0750)
+        dest = os.path.join(tmpdir, 'dest')
+        os.makedirs(dest)
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([src], dest)
+        rbig = os.path.join(dest, 'src', 'sub', 'big')
+        assert open(rbig, 'rb').read() == data
+        assert stat.S_IMODE(os.stat(rbig).st_mode) == 0750
+        assert open(os.path.join(dest, 'src', 'small')).read() == 'small'
+        assert os.path.isdir(os.path.join(dest, 'src', 'sub', 'empty'))
+        # at most one connection per range of the big file and NUM_STREAMS
+        # in total
+        assert _connections(sessions) <= transfer.NUM_STREAMS - 1
+        assert len(sessions) <= transfer.NUM_STREAMS * 2 + 1
+        assert xfer._pool is None
+        # a single small file only uses the client's own session
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([os.path.join(src, 'small')], dest)
+        assert len(sessions) == 1 and _written(sessions) == 5
+        assert xfer._pool is None
+        # files with a single range share the client's connection
+        xfer, sessions = _get_transfer(8 * 1024)
+        xfer.put([src], dest)
+        assert _connections(sessions) == 0
+        xfer, sessions = _get_transfer(4 * 1024)
+        xfer.put([big], rbig)
+        assert _connections(sessions) <= 1
+        # only the corrupted chunk is sent again
+        f = open(rbig, 'r+b')
+        f.seek(2100)
+        f.write(chr(ord(data[2100]) ^ 0xff))
+        f.close()
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([src], dest)
+        assert open(rbig, 'rb').read() == data
+        assert _written(sessions) == 1024
+        # interrupted transfer resumes after the last complete chunk
+        xfer.ssh.sftp.truncate(rbig, 2500)
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([big], rbig)
+        assert open(rbig, 'rb').read() == data
+        assert _written(sessions) == len(data) - 2048
+        local = os.path.join(tmpdir, 'local')
+        xfer.get([os.path.join(dest, 'src')], local)
+        assert open(os.path.join(local, 'sub', 'big'), 'rb').read() == data
+        assert open(os.path.join(local, 'small')).read() == 'small'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sftp_sync():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        big = os.path.join(src, 'sub', 'big')
+        data = os.urandom(4 * 1024)
+        open(big, 'wb').write(data)
+        open(os.path.join(src, 'small'), 'w').write('small')
+        dest = os.path.join(tmpdir, 'dest')
+        os.makedirs(dest)
+        rsrc = os.path.join(dest, 'src')
+        rbig = os.path.join(rsrc, 'sub', 'big')
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([src], dest, sync=True)
+        assert _written(sessions) == len(data) + 5
+        # nothing changed
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([src], dest, sync=True)
+        assert _written(sessions) == 0
+        # only the changed block of the changed file is copied
+        data = data[:1500] + chr(ord(data[1500]) ^ 0xff) + data[1501:]
+        open(big, 'wb').write(data)
+        os.utime(big, (1000000, 1000000))
+        extra = os.path.join(rsrc, 'extra')
+        open(extra, 'w').write('extra')
+        xfer, sessions = _get_transfer(1024)
+        xfer.put([src], dest, sync=True, delete=True)
+        assert _written(sessions) == 1024
+        assert open(rbig, 'rb').read() == data
+        assert os.stat(rbig).st_mtime == 1000000
+        assert not os.path.exists(extra)
+        # and back again
+        local = os.path.join(tmpdir, 'local')
+        os.makedirs(local)
+        xfer, sessions = _get_transfer(1024)
+        xfer.get([rsrc], local, sync=True)
+        assert open(os.path.join(local, 'src', 'sub', 'big'),
+                    'rb').read() == data
+        assert open(os.path.join(local, 'src', 'small')).read() == 'small'
+        extra = os.path.join(local, 'src', 'extra')
+        open(extra, 'w').write('extra')
+        xfer, sessions = _get_transfer(1024)
+        xfer.get([rsrc], local, sync=True, delete=True)
+        assert _read(sessions) == 0
+        assert not os.path.exists(extra)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -20,15 +20,152 @@ ThreadPool module for StarCluster based on WorkerPool
 """
 import time
 import Queue
+import random
 import thread
+import threading
 import traceback
 import workerpool
+import contextlib
+
+from boto.exception import EC2ResponseError
 
 from starcluster import exception
 from starcluster import progressbar
 from starcluster.logger import log
 
 
+# EC2 error codes that indicate a request should be retried
+THROTTLING_ERROR_CODES = ['RequestLimitExceeded', 'Throttling',
+                          'ServiceUnavailable', 'Unavailable']
+
+# bounds used when sizing a pool from the number of nodes in a cluster
+MIN_POOL_SIZE = 10
+DEFAULT_POOL_SIZE = 20
+MAX_POOL_SIZE = 128
+# average job latency (in seconds) above which a pool adds workers for queued
+# jobs. slower jobs spend most of their time waiting on remote hosts so extra
+# threads increase throughput, faster jobs gain nothing from more threads
+GROW_LATENCY = 0.5
+# max number of concurrent ssh channels to the master node. sshd's default
+# MaxSessions is 10 channels per connection
+MASTER_CHANNEL_LIMIT = 8
+
+
+def is_transient_error(e):
+    """
+    Returns True if the exception e is a transient error that is likely to
+    succeed when retried (ssh connection failures and EC2 API throttling)
+    """
+    if isinstance(e, exception.SSHConnectionError):
+        return True
+    if isinstance(e, EC2ResponseError):
+        return e.error_code in THROTTLING_ERROR_CODES
+    return False
+
+
+class RetryPolicy(object):
+    """
+    Describes how a ThreadPool job should be retried when it fails
+
+    tries - maximum number of attempts (including the first)
+    backoff - seconds to wait before the first retry. the delay is doubled
+              after each subsequent retry
+    max_backoff - maximum number of seconds to wait between retries
+    jitter - fraction (0-1) of each delay to randomize in order to prevent
+             many jobs from retrying at the same time
+    retry_if - callable that returns True if a given exception should be
+               retried (defaults to is_transient_error)
+    """
+    def __init__(self, tries=3, backoff=1, max_backoff=30, jitter=0.5,
+                 retry_if=is_transient_error):
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_if = retry_if
+
+    def __repr__(self):
+        return '<RetryPolicy: tries=%d backoff=%s>' % (self.tries,
+                                                       self.backoff)
+
+    def should_retry(self, e, attempt):
+        """
+        Returns True if a job should be retried after failing attempt number
+        attempt (starting at 0) with exception e
+        """
+        return attempt + 1 < self.tries and self.retry_if(e)
+
+    def get_delay(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+
+class HostLimiter(object):
+    """
+    Limits the number of concurrent operations (e.g. ssh channels) per host
+
+    Hosts without a limit are not restricted. Waiting for a free slot uses a
+    timeout so that KeyboardInterrupt is still delivered to the main thread.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._limits = {}
+        self._active = {}
+
+    def set_limit(self, host, limit):
+        """
+        Allow at most limit concurrent operations on host (None removes the
+        limit)
+        """
+        self._cond.acquire()
+        try:
+            if limit:
+                self._limits[host] = limit
+            else:
+                self._limits.pop(host, None)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        log.debug("concurrency limit for host %s: %s" % (host, limit))
+
+    def get_limit(self, host):
+        return self._limits.get(host)
+
+    def acquire(self, host):
+        self._cond.acquire()
+        try:
+            while True:
+                limit = self._limits.get(host)
+                if not limit or self._active.get(host, 0) < limit:
+                    break
+                self._cond.wait(1)
+            self._active[host] = self._active.get(host, 0) + 1
+        finally:
+            self._cond.release()
+
+    def release(self, host):
+        self._cond.acquire()
+        try:
+            self._active[host] -= 1
+            if not self._active[host]:
+                self._active.pop(host)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    @contextlib.contextmanager
+    def slot(self, host):
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+
+# process-wide per-host limits shared by all ssh connections
+host_limits = HostLimiter()
+
+
 class DaemonWorker(workerpool.workers.Worker):
     """
     Improved Worker that sets daemon = True by default and also handles
@@ -44,32 +181,147 @@ class DaemonWorker(workerpool.workers.Worker):
         while 1:
             # Sleep until there is a job to perform.
             job = self.jobs.get()
+            if not self.jobs._start_job(job):
+                # job was cancelled before it started
+                self.jobs.task_done()
+                continue
             try:
                 job.run()
             except workerpool.exceptions.TerminationNotice:
+                self.jobs.task_done()
                 break
             except Exception, e:
-                tb_msg = traceback.format_exc()
-                jid = job.jobid or str(thread.get_ident())
-                self.jobs.store_exception([e, tb_msg, jid])
-            finally:
-                self.jobs.task_done()
+                if not getattr(job, 'cancelled', False):
+                    tb_msg = traceback.format_exc()
+                    jid = job.jobid
+                    if jid is None:
+                        jid = str(thread.get_ident())
+                    self.jobs.store_exception([e, tb_msg, jid])
+            if not self.jobs._finish_job(job):
+                # job timed out and this worker has already been replaced
+                break
+            self.jobs.task_done()
 
 
 def _worker_factory(parent):
     return DaemonWorker(parent)
 
 
+class Future(object):
+    """
+    Holds the eventual result of a job submitted via ThreadPool.submit()
+
+    result() blocks until the job finishes and either returns the job's return
+    value or raises exception.ThreadPoolException if the job failed.
+    """
+    def __init__(self, jobid=None):
+        self.jobid = jobid
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._job = None
+
+    def __repr__(self):
+        state = 'finished' if self.done() else 'pending'
+        return '<Future: %s (%s)>' % (self.jobid, state)
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout=None):
+        if timeout is None:
+            # wait in small increments so that KeyboardInterrupt is still
+            # delivered to the main thread
+            while not self._done.wait(1):
+                pass
+        elif not self._done.wait(timeout):
+            raise exception.ThreadPoolException(
+                "Timed out waiting for job (id=%s)" % self.jobid, [])
+
+    def exception(self, timeout=None):
+        """
+        Returns the [exception, traceback, jobid] triple for the job if it
+        failed otherwise None
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", [self._exception])
+        return self._result
+
+    def cancel(self):
+        """
+        Attempt to cancel the job. Returns False if the job has already
+        started running or finished, otherwise the job will never run and
+        result() will raise a ThreadPoolException containing a JobCancelled
+        error.
+        """
+        if not self._job or not self._job.cancel():
+            return False
+        self.set_exception([exception.JobCancelled(self.jobid), '',
+                            self.jobid])
+        return True
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) when the job finishes (or immediately if the job has
+        already finished)
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def _finish(self, result=None, exc=None):
+        self._lock.acquire()
+        try:
+            if self.done():
+                return
+            self._result = result
+            self._exception = exc
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exc):
+        self._finish(exc=exc)
+
+
 class SimpleJob(workerpool.jobs.SimpleJob):
     def __init__(self, method, args=[], kwargs={}, jobid=None,
-                 results_queue=None):
+                 results_queue=None, future=None, timeout=None, retry=None):
         self.method = method
         self.args = args
         self.kwargs = kwargs
         self.jobid = jobid
         self.results_queue = results_queue
+        self.future = future
+        self.timeout = timeout
+        self.retry = retry
+        self.started = None
+        self.finished = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+        if future:
+            future._job = self
 
-    def run(self):
+    def _call(self):
         if isinstance(self.args, list) or isinstance(self.args, tuple):
             if isinstance(self.kwargs, dict):
                 r = self.method(*self.args, **self.kwargs)
@@ -82,22 +334,155 @@ class SimpleJob(workerpool.jobs.SimpleJob):
                 r = self.method(self.args)
         else:
             r = self.method()
-        if self.results_queue:
+        return r
+
+    def _call_with_retry(self):
+        attempt = 0
+        while True:
+            try:
+                return self._call()
+            except Exception, e:
+                retry = self.retry
+                if not retry or self.cancelled:
+                    raise
+                if not retry.should_retry(e, attempt):
+                    raise
+                delay = retry.get_delay(attempt)
+                if self.timeout and self.started:
+                    if time.time() + delay > self.started + self.timeout:
+                        raise
+                log.debug("job %s failed with transient error: %s - retrying "
+                          "in %.1fs (attempt %d/%d)" %
+                          (self.jobid, e, delay, attempt + 1, retry.tries))
+                time.sleep(delay)
+                attempt += 1
+
+    def start(self):
+        """
+        Mark the job as started. Returns False if the job has been cancelled.
+        """
+        self._lock.acquire()
+        try:
+            if self.cancelled:
+                return False
+            self.started = time.time()
+            return True
+        finally:
+            self._lock.release()
+
+    def cancel(self, running=False):
+        """
+        Cancel the job so that its result is discarded. Only jobs that have
+        not started are cancelled unless running=True. Returns True if the job
+        was cancelled.
+        """
+        self._lock.acquire()
+        try:
+            if self.finished or self.cancelled:
+                return False
+            if self.started and not running:
+                return False
+            self.cancelled = True
+            return True
+        finally:
+            self._lock.release()
+
+    def _finish(self):
+        """
+        Mark the job as finished. Returns False if the job was cancelled in
+        which case its result should be discarded.
+        """
+        self._lock.acquire()
+        try:
+            if self.cancelled:
+                return False
+            self.finished = True
+            return True
+        finally:
+            self._lock.release()
+
+    def run(self):
+        try:
+            r = self._call_with_retry()
+        except Exception, e:
+            if not self._finish():
+                return
+            if self.future is None:
+                raise
+            jid = self.jobid
+            if jid is None:
+                jid = str(thread.get_ident())
+            self.future.set_exception([e, traceback.format_exc(), jid])
+            return
+        if not self._finish():
+            return
+        if self.future is not None:
+            self.future.set_result(r)
+        elif self.results_queue:
             return self.results_queue.put(r)
         return r
 
 
 class ThreadPool(workerpool.WorkerPool):
+    """
+    Pool of worker threads with support for futures, timeouts and retries
+
+    If max_size is greater than size the pool adds workers (up to max_size)
+    whenever jobs are queued and the average job latency exceeds
+    GROW_LATENCY seconds.
+    """
     def __init__(self, size=1, maxjobs=0, worker_factory=_worker_factory,
-                 disable_threads=False):
+                 disable_threads=False, max_size=None):
         self.disable_threads = disable_threads
+        self.max_size = max(size, max_size or 0)
+        self._latency = None
+        self._scale_lock = threading.Lock()
         self._exception_queue = Queue.Queue()
         self._results_queue = Queue.Queue()
         self._progress_bar = None
+        self._running = {}
+        # workers stuck running a timed out job (see _expire_job)
+        self._abandoned = 0
+        self._watchdog = None
+        self._watchdog_cond = threading.Condition(threading.Lock())
         if self.disable_threads:
             size = 0
+            self.max_size = 0
         workerpool.WorkerPool.__init__(self, size, maxjobs, worker_factory)
 
+    def put(self, job, block=True, timeout=None):
+        workerpool.WorkerPool.put(self, job, block, timeout)
+        if isinstance(job, SimpleJob):
+            self._autoscale()
+
+    def _autoscale(self):
+        """
+        Grow the pool by one worker per queued job (up to max_size) if the
+        average job latency is high enough to benefit from more workers
+        """
+        if self._size >= self.max_size or self._latency is None:
+            return
+        if self._latency < GROW_LATENCY:
+            return
+        self._scale_lock.acquire()
+        try:
+            num = min(self.qsize(), self.max_size - self._size)
+            if num <= 0:
+                return
+            for i in range(num):
+                self.grow()
+            log.debug("average job latency is %.2fs - grew pool to %d "
+                      "workers (max: %d)" % (self._latency, self._size,
+                                             self.max_size))
+        finally:
+            self._scale_lock.release()
+
+    def _record_latency(self, duration):
+        if self._latency is None:
+            self._latency = duration
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * duration
+
     @property
     def progress_bar(self):
         if not self._progress_bar:
@@ -110,10 +495,19 @@ class ThreadPool(workerpool.WorkerPool):
         return self._progress_bar
 
     def simple_job(self, method, args=[], kwargs={}, jobid=None,
-                   results_queue=None):
+                   results_queue=None, timeout=None, retry=None):
+        """
+        Schedule method(*args, **kwargs) to be run by the pool. Use wait() to
+        wait for all jobs to finish and collect their results.
+
+        timeout - number of seconds the job is allowed to run before being
+                  cancelled and reported as a JobTimeout error
+        retry - RetryPolicy used to retry the job on transient errors
+        """
         results_queue = results_queue or self._results_queue
         job = SimpleJob(method, args, kwargs, jobid,
-                        results_queue=results_queue)
+                        results_queue=results_queue, timeout=timeout,
+                        retry=retry)
         if not self.disable_threads:
             return self.put(job)
         else:
@@ -125,6 +519,82 @@ class ThreadPool(workerpool.WorkerPool):
             results.append(self._results_queue.get())
         return results
 
+    def submit(self, method, args=[], kwargs={}, jobid=None, timeout=None,
+               retry=None):
+        """
+        Schedule method(*args, **kwargs) to be run by the pool and return a
+        Future representing the job. The job's result (or exception) is only
+        available via the returned Future and is never added to the pool's
+        shared results/exception queues. This means several callers can submit
+        jobs to the same pool concurrently without seeing each other's results.
+
+        See simple_job() for the timeout and retry kwargs.
+        """
+        future = Future(jobid=jobid)
+        job = SimpleJob(method, args, kwargs, jobid, future=future,
+                        timeout=timeout, retry=retry)
+        if not self.disable_threads:
+            self.put(job)
+        else:
+            job.run()
+        return future
+
+    def _submit_seq(self, fn, seq, jobid_fn=None, timeout=None, retry=None):
+        futures = []
+        for i, item in enumerate(zip(*seq)):
+            jobid = i
+            if jobid_fn:
+                jobid = jobid_fn(*item)
+            futures.append(self.submit(fn, item, jobid=jobid,
+                                       timeout=timeout, retry=retry))
+        return futures
+
+    def as_completed(self, futures, numtasks=None):
+        """
+        Yield each future in futures as soon as it finishes while updating the
+        progress bar.
+        """
+        completed = Queue.Queue()
+        for future in futures:
+            future.add_done_callback(completed.put)
+        pbar = self.progress_bar.reset()
+        pbar.maxval = max(numtasks or 0, len(futures))
+        for i in range(len(futures)):
+            pbar.update(i)
+            while True:
+                try:
+                    # use a timeout so that KeyboardInterrupt is delivered
+                    future = completed.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            yield future
+        if pbar.maxval != 0:
+            pbar.finish()
+
+    def imap_unordered(self, fn, *seq, **kwargs):
+        """
+        Same as map() but returns an iterator that yields (jobid, result)
+        tuples as soon as each job finishes rather than waiting for all jobs to
+        finish. If jobid_fn is not specified the jobid is the index of the
+        item in the argument sequence(s). If any jobs fail a
+        ThreadPoolException containing all errors is raised once all
+        successful results have been yielded.
+        """
+        futures = self._submit_seq(fn, seq, jobid_fn=kwargs.get('jobid_fn'),
+                                   timeout=kwargs.get('timeout'),
+                                   retry=kwargs.get('retry'))
+        excs = []
+        for future in self.as_completed(futures):
+            exc = future.exception()
+            if exc:
+                excs.append(exc)
+                continue
+            yield future.jobid, future.result()
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+
     def map(self, fn, *seq, **kwargs):
         """
         Uses the threadpool to return a list of the results of applying the
@@ -132,41 +602,173 @@ class ThreadPool(workerpool.WorkerPool):
         sequence is given, the function is called with an argument list
         consisting of the corresponding item of each sequence. If more than one
         sequence is given with different lengths the argument list will be
-        truncated to the length of the smallest sequence.
+        truncated to the length of the smallest sequence. Results are returned
+        in the same order as the items in the argument sequence(s).
 
         If the kwarg jobid_fn is specified then each threadpool job will be
         assigned a jobid based on the return value of jobid_fn(item) for each
-        item in the map.
-        """
-        if self._results_queue.qsize() > 0:
-            self.get_results()
-        args = zip(*seq)
-        jobid_fn = kwargs.get('jobid_fn')
-        for seq in args:
-            jobid = None
-            if jobid_fn:
-                jobid = jobid_fn(*seq)
-            self.simple_job(fn, seq, jobid=jobid)
-        return self.wait(numtasks=len(args))
+        item in the map. The timeout and retry kwargs are passed to each job
+        (see simple_job).
+        """
+        futures = self._submit_seq(fn, seq, jobid_fn=kwargs.get('jobid_fn'),
+                                   timeout=kwargs.get('timeout'),
+                                   retry=kwargs.get('retry'))
+        excs = []
+        for future in self.as_completed(futures):
+            exc = future.exception()
+            if exc:
+                excs.append(exc)
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        return [f.result() for f in futures]
 
     def store_exception(self, e):
         self._exception_queue.put(e)
 
-    def shutdown(self):
-        log.info("Shutting down threads...")
-        workerpool.WorkerPool.shutdown(self)
-        self.wait(numtasks=self.size())
+    def _start_job(self, job):
+        """
+        Called by a worker before running job. Returns False if the job was
+        cancelled before it started.
+        """
+        if not isinstance(job, SimpleJob):
+            return True
+        if not job.start():
+            return False
+        if job.timeout:
+            self._watchdog_cond.acquire()
+            try:
+                self._running[job] = job.started + job.timeout
+                if not self._watchdog:
+                    self._watchdog = threading.Thread(target=self._watch)
+                    self._watchdog.daemon = True
+                    self._watchdog.start()
+                self._watchdog_cond.notify()
+            finally:
+                self._watchdog_cond.release()
+        return True
+
+    def _finish_job(self, job):
+        """
+        Called by a worker after running job. Returns False if the job timed
+        out in which case the watchdog has already accounted for the job and
+        replaced the worker.
+        """
+        if not isinstance(job, SimpleJob):
+            return True
+        if job.timeout:
+            self._watchdog_cond.acquire()
+            try:
+                self._running.pop(job, None)
+            finally:
+                self._watchdog_cond.release()
+        if job.cancelled:
+            self._size -= 1
+            self._abandoned -= 1
+            return False
+        if job.started:
+            self._record_latency(time.time() - job.started)
+            self._autoscale()
+        return True
+
+    def _watch(self):
+        """
+        Watchdog thread that cancels running jobs that exceed their timeout
+        """
+        while True:
+            self._watchdog_cond.acquire()
+            try:
+                now = time.time()
+                expired = [j for j in self._running
+                           if self._running[j] <= now]
+                for job in expired:
+                    self._running.pop(job)
+                if not expired:
+                    timeout = None
+                    if self._running:
+                        timeout = min(self._running.values()) - now
+                    self._watchdog_cond.wait(timeout)
+            finally:
+                self._watchdog_cond.release()
+            for job in expired:
+                self._expire_job(job)
+
+    def _expire_job(self, job):
+        if not job.cancel(running=True):
+            return
+        jid = job.jobid
+        log.error("job %s timed out after %s seconds - cancelling" %
+                  (jid, job.timeout))
+        exc = [exception.JobTimeout(jid, job.timeout), '', jid]
+        if job.future is not None:
+            job.future.set_exception(exc)
+        else:
+            self.store_exception(exc)
+        # the worker running this job is stuck until the job's method
+        # returns so replace it to keep the pool at full size
+        self._abandoned += 1
+        self.grow()
+        self.task_done()
+
+    def shutdown(self, wait=True):
+        """
+        Retire the workers. If wait is False the workers exit in the
+        background once they finish their current job.
+        """
+        if wait:
+            log.info("Shutting down threads...")
+        self.max_size = 0
+        # workers stuck in a timed out job exit on their own once the job
+        # returns and never pick up a SuicideJob so don't wait for them
+        num_workers = self._size - self._abandoned
+        for i in xrange(num_workers):
+            self.put(workerpool.SuicideJob())
+        if wait:
+            self.wait(numtasks=num_workers)
+
+    def task_done(self):
+        """
+        Same as Queue.task_done except that waiters on all_tasks_done are
+        notified every time a job finishes rather than only when the last job
+        finishes. This allows wait() to update the progress bar as soon as
+        each job completes without polling.
+        """
+        self.all_tasks_done.acquire()
+        try:
+            unfinished = self.unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks = unfinished
+            self.all_tasks_done.notify_all()
+        finally:
+            self.all_tasks_done.release()
+
+    def _wait_for_progress(self, unfinished=None):
+        """
+        Block until the number of unfinished tasks differs from unfinished and
+        return the new count. Returns immediately if unfinished is None.
+        """
+        self.all_tasks_done.acquire()
+        try:
+            while self.unfinished_tasks == unfinished:
+                # a timeout is used so that KeyboardInterrupt is still
+                # delivered to the main thread while waiting
+                self.all_tasks_done.wait(1)
+            return self.unfinished_tasks
+        finally:
+            self.all_tasks_done.release()
 
     def wait(self, numtasks=None, return_results=True):
         pbar = self.progress_bar.reset()
         pbar.maxval = self.unfinished_tasks
         if numtasks is not None:
             pbar.maxval = max(numtasks, self.unfinished_tasks)
-        while self.unfinished_tasks != 0:
-            finished = pbar.maxval - self.unfinished_tasks
-            pbar.update(finished)
-            log.debug("unfinished_tasks = %d" % self.unfinished_tasks)
-            time.sleep(1)
+        unfinished = self._wait_for_progress()
+        while unfinished != 0:
+            pbar.maxval = max(pbar.maxval, unfinished)
+            pbar.update(pbar.maxval - unfinished)
+            log.debug("unfinished_tasks = %d" % unfinished)
+            unfinished = self._wait_for_progress(unfinished)
         if pbar.maxval != 0:
             pbar.finish()
         self.join()
@@ -184,7 +786,183 @@ class ThreadPool(workerpool.WorkerPool):
         self.join()
 
 
+class JobGraph(object):
+    """
+    A set of jobs with dependencies between them that are run on a ThreadPool
+
+    Each job is submitted to the pool as soon as every job it depends on has
+    finished successfully rather than waiting for a global barrier. If a job
+    fails all jobs that (transitively) depend on it are skipped and a
+    ThreadPoolException containing every failure is raised once all runnable
+    jobs have finished.
+
+    Example:
+    graph = JobGraph(pool)
+    graph.add_job('a', do_a)
+    graph.add_job('b', do_b, (node,), deps=['a'])
+    results = graph.run()  # {'a': ..., 'b': ...}
+
+    The results of finished jobs are also available in graph.results while
+    the graph is running which allows a job to use the result of any job it
+    depends on.
+
+    The timeout and retry kwargs are used as defaults for every job added to
+    the graph (see ThreadPool.simple_job).
+    """
+    def __init__(self, pool, timeout=None, retry=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.retry = retry
+        self._jobs = {}
+        self._order = []
+        self.results = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def add_job(self, jobid, method, args=[], kwargs={}, deps=[],
+                timeout=None, retry=None):
+        """
+        Add a job to the graph that runs after all jobs in deps have finished
+        successfully. See ThreadPool.simple_job for the timeout and retry
+        kwargs (these default to the graph's timeout and retry settings).
+        """
+        if jobid in self._jobs:
+            raise ValueError("duplicate jobid: %s" % jobid)
+        timeout = timeout or self.timeout
+        retry = retry or self.retry
+        self._jobs[jobid] = (method, args, kwargs, list(set(deps)), timeout,
+                             retry)
+        self._order.append(jobid)
+        return jobid
+
+    def _get_dependents(self):
+        """
+        Returns a dictionary mapping each jobid to the list of jobids that
+        depend on it. Raises ValueError for unknown or circular dependencies.
+        """
+        dependents = dict([(jobid, []) for jobid in self._order])
+        for jobid in self._order:
+            for dep in self._jobs[jobid][3]:
+                if dep not in self._jobs:
+                    raise ValueError("job %s depends on unknown job %s" %
+                                     (jobid, dep))
+                dependents[dep].append(jobid)
+        pending = dict([(j, len(self._jobs[j][3])) for j in self._order])
+        ready = [j for j in self._order if pending[j] == 0]
+        visited = 0
+        while ready:
+            jobid = ready.pop()
+            visited += 1
+            for dep in dependents[jobid]:
+                pending[dep] -= 1
+                if pending[dep] == 0:
+                    ready.append(dep)
+        if visited != len(self._order):
+            raise ValueError("circular dependency between jobs: %s" %
+                             ', '.join([j for j in self._order if pending[j]]))
+        return dependents
+
+    def run(self):
+        """
+        Run all jobs in the graph and return a dictionary mapping each jobid to
+        its result.
+        """
+        dependents = self._get_dependents()
+        pending = dict([(j, len(self._jobs[j][3])) for j in self._order])
+        skipped = set()
+        lock = threading.Lock()
+        finished = Queue.Queue()
+        results = self.results = {}
+        excs = []
+
+        def submit(jobid):
+            method, args, kwargs, deps, timeout, retry = self._jobs[jobid]
+            future = self.pool.submit(method, args, kwargs, jobid=jobid,
+                                      timeout=timeout, retry=retry)
+            future.add_done_callback(on_done)
+
+        def skip(jobid):
+            for dep in dependents[jobid]:
+                if dep not in skipped:
+                    skipped.add(dep)
+                    finished.put(dep)
+                    skip(dep)
+
+        def on_done(future):
+            ready = []
+            lock.acquire()
+            try:
+                exc = future.exception()
+                if exc:
+                    excs.append(exc)
+                    skip(future.jobid)
+                else:
+                    results[future.jobid] = future.result()
+                    for dep in dependents[future.jobid]:
+                        pending[dep] -= 1
+                        if pending[dep] == 0 and dep not in skipped:
+                            ready.append(dep)
+            finally:
+                lock.release()
+            finished.put(future.jobid)
+            for jobid in ready:
+                submit(jobid)
+
+        for jobid in [j for j in self._order if pending[j] == 0]:
+            submit(jobid)
+        pbar = self.pool.progress_bar.reset()
+        pbar.maxval = len(self._order)
+        for i in range(len(self._order)):
+            pbar.update(i)
+            while True:
+                try:
+                    finished.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+        if pbar.maxval != 0:
+            pbar.finish()
+        if skipped:
+            log.debug("skipped jobs due to failed dependencies: %s" %
+                      ', '.join([j for j in self._order if j in skipped]))
+        if excs:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        return results
+
+
+def get_pool_size(num_nodes=None):
+    """
+    Returns a (size, max_size) tuple for a pool that operates on num_nodes
+    nodes. The pool starts with at most DEFAULT_POOL_SIZE workers and can grow
+    to one worker per node (up to MAX_POOL_SIZE) if jobs are slow. If
+    num_nodes is unknown the pool can grow up to MAX_POOL_SIZE.
+    """
+    if not num_nodes:
+        return DEFAULT_POOL_SIZE, MAX_POOL_SIZE
+    size = max(MIN_POOL_SIZE, min(num_nodes, DEFAULT_POOL_SIZE))
+    max_size = max(size, min(num_nodes, MAX_POOL_SIZE))
+    return size, max_size
+
+
 def get_thread_pool(size=10, worker_factory=_worker_factory,
-                    disable_threads=False):
+                    disable_threads=False, max_size=None):
     return ThreadPool(size=size, worker_factory=_worker_factory,
-                      disable_threads=disable_threads)
+                      disable_threads=disable_threads, max_size=max_size)
+
+
+def get_cluster_thread_pool(num_nodes=None, num_threads=None,
+                            disable_threads=False):
+    """
+    Returns a ThreadPool sized for a cluster with num_nodes nodes. If
+    num_threads is specified the pool has a fixed number of workers.
+    """
+    if num_threads:
+        size, max_size = num_threads, num_threads
+    else:
+        size, max_size = get_pool_size(num_nodes)
+    log.debug("thread pool for %s node(s): %d workers (max: %d)" %
+              (num_nodes or 'unknown', size, max_size))
+    return get_thread_pool(size, disable_threads=disable_threads,
+                           max_size=max_size)
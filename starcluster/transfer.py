@@ -0,0 +1,602 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parallel SFTP file transfers for StarCluster
+
+Files are split into CHUNK_SIZE ranges that are copied concurrently by a
+small thread pool. Each worker thread uses its own SFTP session. When a file
+has more than one range, up to one SSH connection per range (at most
+num_streams) is used to copy them so that a single large transfer is not
+limited to one TCP window and one cipher stream. Otherwise all sessions
+share the client's connection, and transfers consisting of a single job
+just use the client's own SFTP session. Writes are pipelined and reads are
+issued as batches of outstanding requests (readv) so that every session
+keeps the link busy.
+
+Partially transferred files are resumed: any range of the destination file
+whose checksum matches the source is skipped.
+
+In sync mode both trees are compared by size and mtime (the remote tree is
+listed with one find command) and only changed files are considered. Their
+remote block checksums are computed in batches and only blocks that differ
+are copied. Destination files missing from the source can optionally be
+deleted.
+"""
+import os
+import stat
+import errno
+import pipes
+import hashlib
+import threading
+import posixpath
+
+from starcluster import threadpool
+from starcluster.logger import log
+
+# size of the ranges large files are split into
+CHUNK_SIZE = 16 * 1024 * 1024
+# max number of concurrent SFTP sessions (worker threads) per transfer
+NUM_STREAMS = 4
+# max size of a single SFTP read/write request
+BLOCK_SIZE = 32768
+# max number of files handled by a single remote checksum/rm command
+CHECKSUM_BATCH = 200
+
+
+class SFTPTransfer(object):
+    """
+    Copies files and directory trees between the local host and the host
+    an SSHClient is connected to
+
+    ssh - sshutils.SSHClient to transfer files over
+    num_streams - max number of concurrent SFTP sessions to use
+    chunk_size - size of the ranges files are split into
+    progress - callback called with (filename, size, sent) as data is
+               transferred where size and sent are totals for the transfer
+    resume - skip ranges of existing destination files that already match
+    """
+    def __init__(self, ssh, num_streams=NUM_STREAMS, chunk_size=CHUNK_SIZE,
+                 progress=None, resume=True):
+        self.ssh = ssh
+        self.num_streams = num_streams
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.resume = resume
+        self._local = threading.local()
+        self._sessions = []
+        self._num_connections = 1
+        self._num_streams_opened = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._total = 0
+        self._sent = 0
+
+    @property
+    def pool(self):
+        if not self._pool:
+            self._pool = threadpool.get_thread_pool(
+                size=self.num_streams, max_size=self.num_streams)
+        return self._pool
+
+    def _open_session(self, new_connection=False):
+        sftp = self.ssh.open_sftp(new_connection=new_connection)
+        self._lock.acquire()
+        try:
+            self._sessions.append(sftp)
+        finally:
+            self._lock.release()
+        return sftp
+
+    def _get_sftp(self, stream=False):
+        """
+        Returns the calling thread's SFTP session. Sessions share the
+        client's connection unless stream is True (used when copying
+        ranges) in which case up to num_connections - 1 of the sessions get
+        their own SSH connection.
+        """
+        if stream:
+            sftp = getattr(self._local, 'stream', None)
+            if sftp is None:
+                self._lock.acquire()
+                try:
+                    index = self._num_streams_opened
+                    self._num_streams_opened += 1
+                finally:
+                    self._lock.release()
+                if 0 < index < self._num_connections:
+                    sftp = self._open_session(new_connection=True)
+                else:
+                    sftp = self._get_sftp()
+                self._local.stream = sftp
+            return sftp
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._open_session()
+            self._local.sftp = sftp
+        return sftp
+
+    def _close_sessions(self):
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        main_transport = self.ssh.transport
+        for sftp in self._sessions:
+            transport = sftp.get_channel().get_transport()
+            sftp.close()
+            if transport is not main_transport:
+                transport.close()
+        self._sessions = []
+        self._num_connections = 1
+        self._num_streams_opened = 0
+        self._local = threading.local()
+
+    def _update_progress(self, filename, nbytes):
+        self._lock.acquire()
+        try:
+            self._sent += nbytes
+            if self.progress and self._total:
+                self.progress(filename, self._total, self._sent)
+        finally:
+            self._lock.release()
+
+    def _get_ranges(self, size):
+        return [(offset, min(self.chunk_size, size - offset))
+                for offset in range(0, size, self.chunk_size)]
+
+    def _local_checksum(self, path, offset, length):
+        md5 = hashlib.md5()
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, 1024 * 1024))
+                if not data:
+                    break
+                md5.update(data)
+                length -= len(data)
+        finally:
+            f.close()
+        return md5.hexdigest()
+
+    def _remote_checksums(self, items):
+        """
+        Returns the md5 checksums of the given chunk-aligned ranges of each
+        remote file in items ((path, ranges) tuples). The checksums of up to
+        CHECKSUM_BATCH files are computed by a single remote command.
+        """
+        sums = []
+        for i in range(0, len(items), CHECKSUM_BATCH):
+            batch = items[i:i + CHECKSUM_BATCH]
+            script = []
+            for j, (path, ranges) in enumerate(batch):
+                chunks = ' '.join(str(offset / self.chunk_size)
+                                  for offset, length in ranges)
+                script.append(
+                    "for i in %s; do echo %d $(dd if=%s bs=%d skip=$i "
+                    "count=1 2>/dev/null | md5sum); done" %
+                    (chunks, j, pipes.quote(path), self.chunk_size))
+            output = self.ssh.execute('\n'.join(script), source_profile=False,
+                                      log_output=False)
+            batch_sums = [[] for item in batch]
+            for line in output:
+                j, md5 = line.split()[:2]
+                batch_sums[int(j)].append(md5)
+            sums.extend(batch_sums)
+        return sums
+
+    def _get_present_ranges(self, size, dest_size):
+        """
+        Returns the ranges of a file of the given size that are (at least
+        partially) present in a destination file of dest_size bytes
+        """
+        if not self.resume or not dest_size:
+            return []
+        return [r for r in self._get_ranges(size) if r[0] + r[1] <= dest_size]
+
+    def _get_stale_ranges(self, f, dest_size, upload, remote_sums=None):
+        """
+        Returns the ranges of file f that need to be copied because they
+        differ between source and destination
+        """
+        lpath, rpath, size, mode, mtime = f
+        ranges = self._get_ranges(size)
+        present = self._get_present_ranges(size, dest_size)
+        if not present:
+            return ranges
+        if remote_sums is None:
+            remote_sums = self._remote_checksums([(rpath, present)])[0]
+        stale = []
+        for (offset, length), rsum in zip(present, remote_sums):
+            if self._local_checksum(lpath, offset, length) != rsum:
+                stale.append((offset, length))
+        stale += ranges[len(present):]
+        skipped = size - sum(r[1] for r in stale)
+        if skipped:
+            log.debug("%s: %d of %d bytes are up to date" %
+                      (upload and rpath or lpath, skipped, size))
+        return stale
+
+    def _run_jobs(self, jobs):
+        """
+        Run (method, args) jobs on the pool and return their results. A
+        single job is run by the calling thread.
+        """
+        if len(jobs) == 1:
+            return [jobs[0][0](*jobs[0][1])]
+        futures = [self.pool.submit(method, args) for method, args in jobs]
+        return [future.result() for future in futures]
+
+    def _remote_isdir(self, path):
+        sftp = self.ssh.sftp
+        try:
+            return stat.S_ISDIR(sftp.stat(path).st_mode)
+        except IOError:
+            return False
+
+    def _list_remote(self, paths):
+        """
+        Returns a dictionary mapping every file and directory under the given
+        remote paths to a (type, size, mtime, mode) tuple using a single
+        remote command. type is 'f' for files and 'd' for directories.
+        """
+        cmd = 'find %s -printf "%%y %%s %%T@ %%m %%p\\n" 2>/dev/null || true'
+        output = self.ssh.execute(cmd % ' '.join(map(pipes.quote, paths)),
+                                  source_profile=False, log_output=False)
+        listing = {}
+        for line in output:
+            ftype, size, mtime, mode, path = line.split(' ', 4)
+            listing[path] = (ftype, int(size), int(float(mtime)),
+                             int(mode, 8))
+        return listing
+
+    def _transfer(self, files, upload, dest_sizes=None, preserve_mtime=False):
+        """
+        Copy (lpath, rpath, size, mode, mtime) files. Sizes, modes and mtimes
+        are those of the source files. dest_sizes are the sizes of the
+        existing destination files (0 if missing) when they are already known
+        in which case the remote checksums needed to compare them are computed
+        in batches rather than one remote command per file.
+        """
+        if not files:
+            return
+        self._total = sum(f[2] for f in files)
+        self._sent = 0
+        remote_sums = [None] * len(files)
+        if dest_sizes is None:
+            dest_sizes = [None] * len(files)
+        else:
+            items = [(i, (f[1], self._get_present_ranges(f[2], size)))
+                     for i, (f, size) in enumerate(zip(files, dest_sizes))]
+            items = [item for item in items if item[1][1]]
+            sums = self._remote_checksums([item for i, item in items])
+            for (i, item), item_sums in zip(items, sums):
+                remote_sums[i] = item_sums
+        # the calling thread uses the client's own session and the pool
+        # (see _close_sessions) only lives for the duration of the transfer
+        self._local.sftp = self.ssh.sftp
+        try:
+            plans = self._run_jobs([(self._plan_file, args) for args in
+                                    zip(files, [upload] * len(files),
+                                        dest_sizes, remote_sums)])
+            jobs = []
+            for f, ranges in zip(files, plans):
+                lpath, rpath, size, mode, mtime = f
+                self._update_progress(os.path.basename(lpath),
+                                      size - sum(r[1] for r in ranges))
+                method = upload and self._put_range or self._get_range
+                jobs += [(method, (lpath, rpath, offset, length))
+                         for offset, length in ranges]
+            self._num_connections = min(self.num_streams,
+                                        max([len(r) for r in plans]))
+            self._run_jobs(jobs)
+            self._run_jobs([(self._finish_file, (f, upload, preserve_mtime))
+                            for f in files])
+        finally:
+            self._close_sessions()
+
+    def _plan_file(self, f, upload, dest_size=None, remote_sums=None):
+        """
+        Create the destination file if needed and return the list of ranges
+        that need to be copied
+        """
+        lpath, rpath, size, mode, mtime = f
+        if dest_size is None:
+            try:
+                if upload:
+                    dest_size = self._get_sftp().stat(rpath).st_size
+                else:
+                    dest_size = os.path.getsize(lpath)
+            except (IOError, OSError):
+                dest_size = 0
+        if not dest_size:
+            if upload:
+                self._get_sftp().open(rpath, 'wb').close()
+            else:
+                open(lpath, 'wb').close()
+        ranges = self._get_stale_ranges(f, dest_size, upload,
+                                        remote_sums=remote_sums)
+        if dest_size > size:
+            # truncate before any ranges are written to the end of the file
+            if upload:
+                self._get_sftp().truncate(rpath, size)
+            else:
+                lfile = open(lpath, 'r+b')
+                lfile.truncate(size)
+                lfile.close()
+        return ranges
+
+    def _finish_file(self, f, upload, preserve_mtime=False):
+        lpath, rpath, size, mode, mtime = f
+        if upload:
+            sftp = self._get_sftp()
+            sftp.chmod(rpath, mode)
+            if preserve_mtime:
+                sftp.utime(rpath, (mtime, mtime))
+        else:
+            os.chmod(lpath, mode)
+            if preserve_mtime:
+                os.utime(lpath, (mtime, mtime))
+
+    def _put_range(self, lpath, rpath, offset, length):
+        sftp = self._get_sftp(stream=True)
+        lfile = open(lpath, 'rb')
+        rfile = sftp.open(rpath, 'r+b')
+        try:
+            rfile.set_pipelined(True)
+            lfile.seek(offset)
+            rfile.seek(offset)
+            name = os.path.basename(lpath)
+            while length > 0:
+                data = lfile.read(min(length, BLOCK_SIZE))
+                if not data:
+                    break
+                rfile.write(data)
+                length -= len(data)
+                self._update_progress(name, len(data))
+        finally:
+            # waits for the server to acknowledge all pipelined writes
+            rfile.close()
+            lfile.close()
+
+    def _get_range(self, lpath, rpath, offset, length):
+        sftp = self._get_sftp(stream=True)
+        rfile = sftp.open(rpath, 'rb')
+        lfile = open(lpath, 'r+b')
+        try:
+            lfile.seek(offset)
+            blocks = [(off, min(BLOCK_SIZE, offset + length - off))
+                      for off in range(offset, offset + length, BLOCK_SIZE)]
+            name = os.path.basename(rpath)
+            for data in rfile.readv(blocks):
+                lfile.write(data)
+                self._update_progress(name, len(data))
+        finally:
+            lfile.close()
+            rfile.close()
+
+    def _get_changed_files(self, files, dest_info, checksum=False):
+        """
+        Returns the files whose destination (a (size, mtime) tuple or None in
+        dest_info) differs in size or mtime together with the size of each
+        file's destination. If checksum is True files whose size and mtime
+        match are included as well so that their blocks are compared.
+        """
+        changed = []
+        dest_sizes = []
+        for f, info in zip(files, dest_info):
+            if info and info == (f[2], int(f[4])) and not checksum:
+                continue
+            changed.append(f)
+            dest_sizes.append(info and info[0] or 0)
+        log.debug("sync: %d of %d file(s) need to be compared or copied" %
+                  (len(changed), len(files)))
+        return changed, dest_sizes
+
+    def put(self, localpaths, remotepath='.', sync=False, checksum=False,
+            delete=False):
+        """
+        Copy local files and directories to remotepath. If remotepath is an
+        existing directory the files are copied into it, otherwise the
+        (single) local path is copied to remotepath.
+
+        sync - only copy files whose size or mtime differ from the remote
+               copy (and only their changed blocks) and preserve mtimes
+        checksum - with sync, also compare the blocks of files whose size and
+                   mtime match
+        delete - with sync, remove remote files that do not exist locally
+        """
+        remote_isdir = self._remote_isdir(remotepath)
+        dirs = []
+        roots = []
+        files = []
+        for lpath in localpaths:
+            lpath = lpath.rstrip(os.sep) or os.sep
+            dest = posixpath.normpath(remotepath)
+            if remote_isdir:
+                dest = posixpath.join(dest, os.path.basename(lpath))
+            if not os.path.isdir(lpath):
+                st = os.stat(lpath)
+                files.append((lpath, dest, st.st_size,
+                              stat.S_IMODE(st.st_mode), st.st_mtime))
+                continue
+            roots.append(dest)
+            for root, dirnames, filenames in os.walk(lpath):
+                rel = os.path.relpath(root, lpath)
+                rroot = dest
+                if rel != os.curdir:
+                    rroot = posixpath.join(dest, *rel.split(os.sep))
+                dirs.append(rroot)
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if not os.path.isfile(path):
+                        continue
+                    st = os.stat(path)
+                    files.append((path, posixpath.join(rroot, filename),
+                                  st.st_size, stat.S_IMODE(st.st_mode),
+                                  st.st_mtime))
+        if dirs:
+            # create the whole tree with one remote command
+            self.ssh.execute('mkdir -p %s' % ' '.join(map(pipes.quote, dirs)),
+                             source_profile=False)
+        if not sync:
+            self._transfer(files, upload=True)
+            return
+        listing = self._list_remote(roots + [f[1] for f in files
+                                             if f[1] not in roots])
+        dest_info = []
+        for f in files:
+            entry = listing.get(f[1])
+            dest_info.append(entry and entry[0] == 'f' and entry[1:3] or None)
+        changed, dest_sizes = self._get_changed_files(files, dest_info,
+                                                      checksum=checksum)
+        self._transfer(changed, upload=True, dest_sizes=dest_sizes,
+                       preserve_mtime=True)
+        if delete:
+            keep = set(f[1] for f in files)
+            extra = [rpath for rpath, info in listing.items()
+                     if info[0] == 'f' and rpath not in keep]
+            for i in range(0, len(extra), CHECKSUM_BATCH):
+                batch = extra[i:i + CHECKSUM_BATCH]
+                log.debug("sync: removing %s" % ', '.join(batch))
+                self.ssh.execute('rm -f %s' % ' '.join(map(pipes.quote,
+                                                           batch)),
+                                 source_profile=False)
+
+    def _walk_remote(self, path):
+        """
+        Yields (dirpath, [(filename, attrs), ...]) for a remote directory
+        tree
+        """
+        sftp = self.ssh.sftp
+        dirs = [path]
+        while dirs:
+            dirpath = dirs.pop(0)
+            files = []
+            for attrs in sftp.listdir_attr(dirpath):
+                if stat.S_ISDIR(attrs.st_mode):
+                    dirs.append(posixpath.join(dirpath, attrs.filename))
+                elif stat.S_ISREG(attrs.st_mode):
+                    files.append((attrs.filename, attrs))
+            yield dirpath, files
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _get_remote_tree(self, rpath, dest, listing=None):
+        """
+        Returns the (lpath, rpath, size, mode, mtime) files under the remote
+        directory rpath and creates the corresponding local directories
+        under dest. Uses listing (see _list_remote) if specified.
+        """
+        files = []
+        if listing is None:
+            for dirpath, filenames in self._walk_remote(rpath):
+                rel = posixpath.relpath(dirpath, rpath)
+                lroot = dest
+                if rel != posixpath.curdir:
+                    lroot = os.path.join(dest, *rel.split('/'))
+                self._makedirs(lroot)
+                for filename, attrs in filenames:
+                    files.append((os.path.join(lroot, filename),
+                                  posixpath.join(dirpath, filename),
+                                  attrs.st_size, stat.S_IMODE(attrs.st_mode),
+                                  attrs.st_mtime))
+            return files
+        prefix = rpath.rstrip('/') + '/'
+        for path in sorted(listing):
+            if path != rpath and not path.startswith(prefix):
+                continue
+            ftype, size, mtime, mode = listing[path]
+            rel = posixpath.relpath(path, rpath)
+            lpath = dest
+            if rel != posixpath.curdir:
+                lpath = os.path.join(dest, *rel.split('/'))
+            if ftype == 'd':
+                self._makedirs(lpath)
+            elif ftype == 'f':
+                files.append((lpath, path, size, mode, mtime))
+        return files
+
+    def get(self, remotepaths, localpath='', sync=False, checksum=False,
+            delete=False, attrs=None):
+        """
+        Copy remote files and directories to localpath. If localpath is an
+        existing directory the files are copied into it, otherwise the
+        (single) remote path is copied to localpath.
+
+        See put() for the sync, checksum and delete kwargs. attrs is an
+        optional dictionary of the remote paths' attributes (as returned by
+        SSHClient.stat_many) to avoid stat'ing them again.
+        """
+        localpath = localpath or os.getcwd()
+        local_isdir = os.path.isdir(localpath)
+        attrs = dict((posixpath.normpath(rpath), attr)
+                     for rpath, attr in (attrs or {}).items())
+        remotepaths = [posixpath.normpath(rpath) for rpath in remotepaths]
+        listing = None
+        if sync:
+            listing = self._list_remote(remotepaths)
+        sftp = self.ssh.sftp
+        roots = []
+        files = []
+        for rpath in remotepaths:
+            dest = localpath
+            if local_isdir:
+                dest = os.path.join(localpath, posixpath.basename(rpath))
+            if listing is not None:
+                isdir = listing.get(rpath, ('f',))[0] == 'd'
+                attr = None
+            else:
+                attr = attrs.get(rpath) or sftp.stat(rpath)
+                isdir = stat.S_ISDIR(attr.st_mode)
+            if isdir:
+                roots.append(dest)
+                files += self._get_remote_tree(rpath, dest, listing=listing)
+            elif attr:
+                files.append((dest, rpath, attr.st_size,
+                              stat.S_IMODE(attr.st_mode), attr.st_mtime))
+            else:
+                size, mtime, mode = listing[rpath][1:]
+                files.append((dest, rpath, size, mode, mtime))
+        if not sync:
+            self._transfer(files, upload=False)
+            return
+        dest_info = []
+        for f in files:
+            info = None
+            if os.path.isfile(f[0]):
+                st = os.stat(f[0])
+                info = (st.st_size, int(st.st_mtime))
+            dest_info.append(info)
+        changed, dest_sizes = self._get_changed_files(files, dest_info,
+                                                      checksum=checksum)
+        self._transfer(changed, upload=False, dest_sizes=dest_sizes,
+                       preserve_mtime=True)
+        if delete:
+            keep = set(f[0] for f in files)
+            for root in roots:
+                for dirpath, dirnames, filenames in os.walk(root):
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        if path not in keep:
+                            log.debug("sync: removing %s" % path)
+                            os.remove(path)